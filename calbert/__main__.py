@@ -1,31 +1,53 @@
-import hydra
+import argparse
+import importlib
 import logging
 import sys
-import argparse
-from pathlib import Path
-
-from calbert import tokenizer, training, download_data
 
 log = logging.getLogger(__name__)
 
-TASK_WITH_ARGS = (None, None)
-
-VALID_COMMANDS = ["tokenizer", "train", "download_data"]
-
-TASKS = {
-    "tokenizer": tokenizer.train,
-    "train": training.train,
-    "download_data": download_data.run,
+# Every command is implemented by a `task(args, cfg)` function next to an `arguments()`
+# parser in its own module, which is only imported when that command runs.
+COMMANDS = {
+    "tokenizer": ("calbert.tokenizer", "train"),
+    "train": ("calbert.training", "train"),
+    "download_data": ("calbert.download_data", "run"),
+    "benchmark": ("calbert.benchmark", "run"),
+    "tune": ("calbert.tune", "run"),
+    "distill": ("calbert.distill", "distill"),
+    "prune_vocab": ("calbert.vocab", "run"),
+    "prune": ("calbert.prune", "run"),
+    "index": ("calbert.index", "run"),
+    "evaluate": ("calbert.evaluation", "run"),
+    "shard": ("calbert.shards", "run"),
+    "stats": ("calbert.stats", "run"),
+    "serving_export": ("calbert.serving", "run"),
 }
-PARSERS = {
-    "tokenizer": tokenizer.arguments,
-    "train": training.arguments,
-    "download_data": download_data.arguments,
+
+# Commands that take their own command line and run without the Hydra configuration
+STANDALONE_COMMANDS = {
+    "launch": "calbert.launch",
 }
 
+VALID_COMMANDS = list(COMMANDS) + list(STANDALONE_COMMANDS)
+
+
+def usage() -> argparse.ArgumentParser:
+    "The top-level parser, only used to describe the commands"
+    parser = argparse.ArgumentParser(prog="python -m calbert")
+    parser.add_argument("command", choices=VALID_COMMANDS, help="The command to run")
+    parser.add_argument("args", nargs="...", help="The command's own arguments")
+    return parser
 
-def parse(command):
-    parser = PARSERS[command]()
+
+def load(command):
+    "Import the module implementing `command` and return its task and argument parser"
+    module_name, task = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    return getattr(module, task), module.arguments
+
+
+def parse(arguments):
+    parser = arguments()
     parser.add_argument("override", nargs="*", help="config overrides")
     args = parser.parse_args()
     override = args.override
@@ -33,16 +55,26 @@ def parse(command):
     return args, override
 
 
-@hydra.main(config_path="../config/config.yaml", strict=True)
-def main(cfg):
-    task, args = TASK_WITH_ARGS
-    task(args, cfg)
+def run(task, args):
+    import hydra
+
+    @hydra.main(config_path="../config/config.yaml", strict=True)
+    def main(cfg):
+        task(args, cfg)
+
+    main()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         log.error(f"Must provide valid command: {', '.join(VALID_COMMANDS)}")
         exit(-1)
+    if sys.argv[1] in ["-h", "--help"]:
+        usage().print_help()
+        exit(0)
+    if sys.argv[1] in STANDALONE_COMMANDS:
+        module = importlib.import_module(STANDALONE_COMMANDS[sys.argv[1]])
+        exit(module.main(sys.argv[2:]))
     gpu = None
     if sys.argv[1].startswith('--gpu'):  # distributed training
         gpu = sys.argv[1]
@@ -54,7 +86,7 @@ if __name__ == "__main__":
     del sys.argv[1]
     if gpu:
         sys.argv.append(gpu)
-    args, override = parse(cmd)
+    task, arguments = load(cmd)
+    args, override = parse(arguments)
     sys.argv = [sys.argv[0]] + override
-    TASK_WITH_ARGS = (TASKS[cmd], args)
-    main()
+    run(task, args)
@@ -0,0 +1,733 @@
+"Reproducible CPU benchmarks of calbert's hot paths"
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from transformers import AlbertForMaskedLM
+
+from calbert.dataset import (
+    IGNORE_INDEX,
+    Tokenize,
+    SentencePair,
+    mask_tokens,
+    packed_pairs,
+    sentence_pairs,
+)
+from calbert.index import IVFPQIndex, brute_force, normalized, recall_at_k
+from calbert.inference import EarlyExitAlbert, SlidingWindowEncoder
+from calbert.lamb import Lamb
+from calbert.model import HAS_SDPA, CalbertForMaskedLM
+from calbert.serving import export as export_serving, load as load_serving
+from calbert.tokenizer import load as load_tokenizer
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+MODEL_CONFIGS = Path(__file__).parent.parent / "config" / "model"
+
+Measurement = namedtuple("Measurement", ["samples", "unit", "higher_is_better"])
+
+WORDS = (
+    "la el els les un una de del a al en amb per que i o però no sí com quan on "
+    "casa ciutat país llengua gent temps any dia nit aigua terra mar muntanya riu "
+    "carrer escola llibre paraula història cultura música feina família amic "
+    "govern món vida camí porta finestra taula cadira pa vi sang cor mà peu "
+    "parlar escriure llegir anar venir fer dir veure saber poder voler tenir "
+    "ser estar viure menjar beure dormir treballar pensar cantar obrir tancar "
+    "gran petit nou vell bo dolent llarg curt alt baix català antic bonic "
+    "sempre mai avui demà ahir encara també molt poc massa aquí allà així"
+).split()
+
+
+def benchmark(
+    name: str, unit: str = None, higher_is_better: bool = True, default: bool = True
+):
+    """Register a benchmark.
+
+    It returns either one measurement (in `unit`) per repetition, or a dict of named
+    `Measurement`s for reports made of several metrics. Benchmarks that are not
+    `default` only run when asked for with `--only`.
+    """
+
+    def register(fn):
+        fn.unit = unit
+        fn.higher_is_better = higher_is_better
+        fn.default = default
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+
+def synthetic_text(n_lines: int, seed: int) -> List[str]:
+    "Deterministic Catalan-like lines of 1 to 6 sentences each"
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n_lines):
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            words = rng.choices(WORDS, k=rng.randint(4, 24))
+            sentences.append(
+                " ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!"])
+            )
+        lines.append(" ".join(sentences))
+    return lines
+
+
+def timed(fn: Callable, repeat: int, warmup: int = 1) -> List[float]:
+    "Wall-clock seconds of `repeat` calls of `fn`, after `warmup` untimed ones"
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _rss() -> int:
+    "Current resident set size in bytes"
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _pss() -> int:
+    "Current proportional set size in bytes: shared pages count divided by their sharers"
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _isolated_target(conn, fn, args):
+    try:
+        baseline = _rss()
+        result = fn(*args)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        conn.send((result, max(peak - baseline, 0), None))
+    except BaseException as e:
+        conn.send((None, 0, repr(e)))
+    finally:
+        conn.close()
+
+
+def isolated(fn: Callable, *args):
+    """Run `fn(*args)` in a forked process.
+
+    Returns its result and how much its peak RSS grew over the RSS it started with,
+    so memory measurements don't leak into each other. Raises `MemoryError` if the
+    process was killed or ran out of memory, and `RuntimeError` if `fn` failed.
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_isolated_target, args=(child, fn, args))
+    process.start()
+    child.close()
+    try:
+        result, peak, error = parent.recv()
+    except EOFError:  # killed, most likely by the OOM killer
+        process.join()
+        raise MemoryError(
+            f"Isolated benchmark was killed (exit code {process.exitcode})"
+        )
+    process.join()
+    if error is not None:
+        if error.startswith("MemoryError") or "out of memory" in error:
+            raise MemoryError(f"Isolated benchmark ran out of memory: {error}")
+        raise RuntimeError(f"Isolated benchmark failed: {error}")
+    return result, peak
+
+
+def model_config(name: str):
+    "The model section of `config/model/{name}.yaml`"
+    return OmegaConf.load(str(MODEL_CONFIGS / f"{name}.yaml")).model
+
+
+class Context:
+    "Everything the benchmarks share: arguments, config, tokenizer and a synthetic corpus"
+
+    def __init__(self, args, cfg):
+        self.args = args
+        self.cfg = cfg
+        self.tokenizer = load_tokenizer(cfg, normalize_path(args.tokenizer_path))
+        self.corpus = tempfile.NamedTemporaryFile(mode="w+", encoding="utf-8")
+        self.corpus.write("\n".join(synthetic_text(args.lines, args.seed)) + "\n")
+        self.corpus.flush()
+        self._batch = None
+
+    def pairs(self) -> List[SentencePair]:
+        return list(sentence_pairs(self.corpus.name))
+
+    def examples(self, items) -> torch.Tensor:
+        "Tokenized and masked `items`, of shape (len(items), 4, sequence length)"
+        tokenize = Tokenize(self.tokenizer, max_seq_len=self.args.seq_len)
+        examples = []
+        for item in items:
+            ids, attention_mask, token_type_ids = tokenize(item)
+            masked_ids, labels = mask_tokens(
+                ids,
+                tok=self.tokenizer,
+                ignore_index=IGNORE_INDEX,
+                probability=self.cfg.training.masked_lm_prob,
+            )
+            examples.append(
+                torch.stack([masked_ids, labels, attention_mask, token_type_ids])
+            )
+        return torch.stack(examples)
+
+    def batch(self) -> torch.Tensor:
+        "A tokenized and masked batch of shape (batch size, 4, sequence length)"
+        if self._batch is None:
+            self._batch = self.examples(self.pairs()[: self.args.batch_size])
+        return self._batch
+
+    def model(self, model_cfg=None) -> CalbertForMaskedLM:
+        from calbert.training import albert_config
+
+        cfg = self.cfg
+        if model_cfg is not None:
+            cfg = cfg.copy()
+            cfg.model = model_cfg
+        model = CalbertForMaskedLM(albert_config(cfg, self.args))
+        model.resize_token_embeddings(len(self.tokenizer))
+        return model
+
+    def close(self):
+        self.corpus.close()
+
+
+@benchmark("sentence_pairs", unit="lines/s")
+def bench_sentence_pairs(ctx: Context) -> List[float]:
+    times = timed(lambda: list(sentence_pairs(ctx.corpus.name)), ctx.args.repeat)
+    return [ctx.args.lines / t for t in times]
+
+
+@benchmark("tokenize", unit="examples/s")
+def bench_tokenize(ctx: Context) -> List[float]:
+    tokenize = Tokenize(ctx.tokenizer, max_seq_len=ctx.args.seq_len)
+    pairs = ctx.pairs()[: ctx.args.examples]
+    times = timed(lambda: [tokenize(p) for p in pairs], ctx.args.repeat)
+    return [len(pairs) / t for t in times]
+
+
+@benchmark("mask_tokens", unit="batches/s")
+def bench_mask_tokens(ctx: Context) -> List[float]:
+    ids = ctx.batch()[:, 0]
+    n = 50
+
+    def run():
+        for _ in range(n):
+            mask_tokens(
+                ids.clone(),
+                tok=ctx.tokenizer,
+                ignore_index=IGNORE_INDEX,
+                probability=ctx.cfg.training.masked_lm_prob,
+            )
+
+    return [n / t for t in timed(run, ctx.args.repeat)]
+
+
+@benchmark("model_step", unit="ms/step", higher_is_better=False)
+def bench_model_step(ctx: Context) -> List[float]:
+    model = ctx.model().train()
+    batch = ctx.batch()
+
+    def step():
+        model.zero_grad()
+        loss = model(batch)[0]
+        loss.backward()
+
+    return [t * 1000 for t in timed(step, ctx.args.repeat)]
+
+
+@benchmark("lamb_step", unit="ms/step", higher_is_better=False)
+def bench_lamb_step(ctx: Context) -> List[float]:
+    model = ctx.model()
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        p.grad = torch.randn_like(p) * 1e-3
+    opt = Lamb(params, lr=ctx.cfg.training.learning_rate)
+    return [t * 1000 for t in timed(opt.step, ctx.args.repeat)]
+
+
+@benchmark("packing")
+def bench_packing(ctx: Context) -> Dict[str, Measurement]:
+    "Real (non-padding) tokens/sec of training steps, one pair per example vs packed"
+    model = ctx.model().train()
+    n = ctx.args.batch_size * ctx.args.steps
+    pairs = ctx.pairs()
+    variants = {
+        "unpacked": pairs[:n],
+        "packed": list(packed_pairs(pairs, ctx.tokenizer, ctx.args.seq_len))[:n],
+    }
+
+    report = {}
+    for name, items in variants.items():
+        batches = ctx.examples(items).split(ctx.args.batch_size)
+        real_tokens = sum(b[:, 2].sum().item() for b in batches)
+        padding = 1 - real_tokens / sum(b[:, 2].numel() for b in batches)
+
+        def epoch():
+            for b in batches:
+                model.zero_grad()
+                model(b)[0].backward()
+
+        times = timed(epoch, ctx.args.repeat)
+        report[f"{name}.tokens_per_sec"] = Measurement(
+            [real_tokens / t for t in times], "tokens/s", True
+        )
+        report[f"{name}.padding"] = Measurement([padding * 100], "%", False)
+    return report
+
+
+@benchmark("activation_checkpointing", default=False)
+def bench_activation_checkpointing(ctx: Context) -> Dict[str, Measurement]:
+    "Peak memory growth and step time with and without checkpointing the shared layer"
+    batch = ctx.batch()
+
+    def run(model_cfg, checkpointed):
+        model = ctx.model(model_cfg).train()
+        if checkpointed:
+            model.checkpoint_activations()
+
+        def step():
+            model.zero_grad()
+            model(batch)[0].backward()
+
+        return [t * 1000 for t in timed(step, ctx.args.repeat)]
+
+    report = {}
+    for name in ctx.args.models.split(","):
+        for checkpointed in [False, True]:
+            key = f"{name}.{'checkpointed' if checkpointed else 'plain'}"
+            times, peak = isolated(run, model_config(name), checkpointed)
+            report[f"{key}.step"] = Measurement(times, "ms/step", False)
+            report[f"{key}.peak_memory"] = Measurement([peak / 2 ** 20], "MiB", False)
+    return report
+
+
+@benchmark("precision", default=False)
+def bench_precision(ctx: Context) -> Dict[str, Measurement]:
+    "Step time and peak memory growth in fp32 and bf16 autocast, with eager and fused attention"
+    batch = ctx.batch()
+
+    def run(model_cfg, precision, fused):
+        model = ctx.model(model_cfg).train()
+        if fused:
+            model.use_fused_attention()
+
+        def step():
+            model.zero_grad()
+            if precision == "bf16":
+                with torch.autocast("cpu", dtype=torch.bfloat16):
+                    loss = model(batch)[0]
+            else:
+                loss = model(batch)[0]
+            loss.backward()
+
+        return [t * 1000 for t in timed(step, ctx.args.repeat)]
+
+    precisions = ["fp32", "bf16"]
+    attentions = [False]
+    if HAS_SDPA:
+        attentions.append(True)
+    else:
+        log.warning("Fused attention needs torch>=2.0, only benchmarking eager")
+
+    report = {}
+    for name in ctx.args.models.split(","):
+        for precision in precisions:
+            for fused in attentions:
+                key = f"{name}.{precision}.{'fused' if fused else 'eager'}"
+                times, peak = isolated(run, model_config(name), precision, fused)
+                report[f"{key}.step"] = Measurement(times, "ms/step", False)
+                report[f"{key}.peak_memory"] = Measurement(
+                    [peak / 2 ** 20], "MiB", False
+                )
+    return report
+
+
+@benchmark("early_exit", default=False)
+def bench_early_exit(ctx: Context) -> Dict[str, Measurement]:
+    "Latency, masked token accuracy and mean depth of an exported model at fixed depths and exit thresholds"
+    args = ctx.args
+    if args.model_path is None or args.valid_path is None:
+        raise ValueError("The early_exit benchmark needs --model-path and --valid-path")
+    model = EarlyExitAlbert.from_pretrained(normalize_path(args.model_path))
+    pairs = list(sentence_pairs(normalize_path(args.valid_path), max_items=args.examples))
+    batches = ctx.examples(pairs).split(args.batch_size)
+    masked = [b[:, 1] != IGNORE_INDEX for b in batches]
+
+    layers = model.max_layers
+    settings = {
+        f"depth{d}": dict(depth=d)
+        for d in sorted({1, layers // 4, layers // 2, 3 * layers // 4, layers} - {0})
+    }
+    settings.update({f"confidence{c}": dict(confidence=c) for c in [0.5, 0.7, 0.9]})
+    settings.update({f"tolerance{t}": dict(tolerance=t) for t in [0.01, 0.05]})
+
+    report = {}
+    for name, setting in settings.items():
+        model.confidence = setting.get("confidence")
+        model.tolerance = setting.get("tolerance")
+
+        def run():
+            return [
+                model(b[:, 0], b[:, 2], b[:, 3], positions=m, depth=setting.get("depth"))
+                for b, m in zip(batches, masked)
+            ]
+
+        times = timed(run, args.repeat)
+        outputs = run()
+        correct = sum(
+            (scores.argmax(-1)[m] == b[:, 1][m]).sum().item()
+            for (scores, _), b, m in zip(outputs, batches, masked)
+        )
+        total = sum(m.sum().item() for m in masked)
+        depths = torch.cat([d for _, d in outputs]).float()
+        report[f"{name}.latency"] = Measurement(
+            [t * 1000 / len(batches) for t in times], "ms/batch", False
+        )
+        report[f"{name}.accuracy"] = Measurement(
+            [correct / max(total, 1) * 100], "%", True
+        )
+        report[f"{name}.depth"] = Measurement([depths.mean().item()], "layers", False)
+    return report
+
+
+@benchmark("long_documents", default=False)
+def bench_long_documents(ctx: Context) -> Dict[str, Measurement]:
+    "Documents/sec of sliding-window encoding, batched across documents and one at a time"
+    args = ctx.args
+    if args.model_path is not None:
+        path = normalize_path(args.model_path)
+        model = SlidingWindowEncoder.from_pretrained(path).model
+    else:
+        model = ctx.model()
+    encoder = SlidingWindowEncoder(
+        model,
+        ctx.tokenizer,
+        max_length=args.seq_len,
+        overlap=args.overlap,
+        batch_size=args.batch_size,
+    )
+    lines = synthetic_text(args.lines, args.seed)
+    documents = encoder.tokenize(
+        [" ".join(lines[i : i + 50]) for i in range(0, len(lines), 50)]
+    )
+
+    batched = timed(lambda: encoder(documents), args.repeat)
+    looped = timed(lambda: [encoder([ids]) for ids in documents], args.repeat)
+    return {
+        "batched": Measurement([len(documents) / t for t in batched], "docs/s", True),
+        "per_document": Measurement(
+            [len(documents) / t for t in looped], "docs/s", True
+        ),
+    }
+
+
+@benchmark("ann_index", default=False)
+def bench_ann_index(ctx: Context) -> Dict[str, Measurement]:
+    "Queries/sec and recall@10 of an IVF-PQ index against brute force, at several nprobe"
+    args = ctx.args
+    dim = ctx.cfg.model.hidden_size
+    rng = np.random.RandomState(args.seed)
+    means = rng.randn(256, dim)
+
+    def clustered(n):
+        return normalized(means[rng.randint(256, size=n)] + rng.randn(n, dim))
+
+    vectors, queries = clustered(args.vectors), clustered(args.examples)
+
+    m = next(m for m in [16, 8, 4, 2, 1] if dim % m == 0)
+    nlist = int(4 * np.sqrt(args.vectors))
+    sample = vectors[: max(nlist * 40, 10000)]
+    index = IVFPQIndex.train(sample, nlist, m, seed=args.seed)
+    index.add(vectors)
+
+    expected = brute_force(vectors, queries, 10)
+    times = timed(lambda: brute_force(vectors, queries, 10), args.repeat)
+    report = {
+        "brute_force.qps": Measurement(
+            [len(queries) / t for t in times], "queries/s", True
+        )
+    }
+    for nprobe in [1, 8, 32]:
+        times = timed(lambda: index.search(queries, 10, nprobe), args.repeat)
+        found, _ = index.search(queries, 10, nprobe)
+        report[f"nprobe{nprobe}.qps"] = Measurement(
+            [len(queries) / t for t in times], "queries/s", True
+        )
+        report[f"nprobe{nprobe}.recall"] = Measurement(
+            [recall_at_k(found, expected, 10) * 100], "%", True
+        )
+    return report
+
+
+def _serving_worker(conn, barrier, load, batch, started):
+    torch.set_num_threads(1)
+    model = load()
+    ids, _, attention_mask, token_type_ids = batch.permute(1, 0, 2)
+    with torch.no_grad():
+        model(
+            input_ids=ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+        )
+    cold_start = time.time() - started
+    # Every worker is loaded before any measures its share of memory, and stays until
+    # all have
+    barrier.wait(timeout=600)
+    conn.send((cold_start, _rss(), _pss()))
+    conn.close()
+    barrier.wait(timeout=600)
+
+
+def serving_workers(load: Callable, batch: torch.Tensor, n: int) -> List[tuple]:
+    "Cold start seconds, RSS and PSS of each of `n` forked workers loading a model with `load`"
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(n)
+    started = time.time()
+    workers = []
+    for _ in range(n):
+        parent, child = ctx.Pipe(duplex=False)
+        process = ctx.Process(
+            target=_serving_worker, args=(child, barrier, load, batch, started)
+        )
+        process.start()
+        child.close()
+        workers.append((process, parent))
+    try:
+        results = [parent.recv() for _, parent in workers]
+    except EOFError:
+        raise RuntimeError("A serving worker died before measuring its memory")
+    finally:
+        for process, _ in workers:
+            process.join()
+    return results
+
+
+@benchmark("serving_workers", default=False)
+def bench_serving_workers(ctx: Context) -> Dict[str, Measurement]:
+    "Cold start and memory per worker of 1, 8 and 32 serving workers loading a model"
+    from calbert.training import export
+
+    args = ctx.args
+    batch = ctx.batch().long()
+    report = {}
+
+    def measure(key: str, load: Callable, n: int):
+        results = serving_workers(load, batch, n)
+        for i, (name, unit, scale) in enumerate(
+            [("cold_start", "s", 1), ("rss", "MiB", 2 ** -20), ("pss", "MiB", 2 ** -20)]
+        ):
+            report[f"{key}.{n}_workers.{name}"] = Measurement(
+                [r[i] * scale for r in results], unit, False
+            )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        if args.model_path is not None:
+            model_path = normalize_path(args.model_path)
+        else:
+            model_path = tmp / "model"
+            export(ctx.model().eval(), ctx.tokenizer, model_path)
+        model = AlbertForMaskedLM.from_pretrained(str(model_path))
+        dtypes = ["fp32", "bf16"]
+        for dtype in dtypes:
+            export_serving(model, ctx.tokenizer, tmp / dtype, dtype)
+        del model
+
+        for n in [int(n) for n in args.workers.split(",")]:
+            # Every worker unpickles its own fp32 copy, as `from_pretrained` does
+            measure(
+                "pytorch_model",
+                lambda: AlbertForMaskedLM.from_pretrained(str(model_path)).eval(),
+                n,
+            )
+            for dtype in dtypes:
+                # Every worker maps the weights on its own
+                measure(f"mmap_{dtype}", lambda d=dtype: load_serving(tmp / d)[0], n)
+                # Workers forked after the parent mapped them only run the model
+                shared = load_serving(tmp / dtype)[0]
+                measure(f"forked_mmap_{dtype}", lambda s=shared: s, n)
+                del shared
+    return report
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> List[str]:
+    "Names of the benchmarks where `candidate` is worse than `baseline` by more than `threshold`"
+    regressions = []
+    for name, base in baseline["results"].items():
+        if name not in candidate["results"]:
+            continue
+        cand = candidate["results"][name]
+        if base["value"]:
+            change = (cand["value"] - base["value"]) / base["value"]
+        else:
+            # Any move away from a zero baseline is an unbounded relative change
+            change = math.copysign(math.inf, cand["value"]) if cand["value"] else 0.0
+        worse = -change if base["higher_is_better"] else change
+        flag = "REGRESSION" if worse > threshold else "ok"
+        log.info(
+            f"{name:>20}: {base['value']:10.2f} -> {cand['value']:10.2f} {base['unit']} ({change * 100:+.1f}%) {flag}"
+        )
+        if worse > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark calbert's hot paths on CPU")
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        default=Path("dist/tokenizer-uncased/ca.uncased.30000.model"),
+        help="The path to the sentencepiece *model* (ca.{uncased|cased}.VOCABSIZE.model)",
+    )
+    parser.add_argument(
+        "--out", type=Path, default=None, help="Where to write the JSON results",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        nargs=2,
+        default=None,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="Compare two result files instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown above which a benchmark is flagged as a regression",
+    )
+    parser.add_argument(
+        "--only", type=str, default=None, help="Comma-separated benchmarks to run",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--examples", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seq-len", type=int, default=128)
+    parser.add_argument(
+        "--steps", type=int, default=4, help="Training steps per repetition of step loops",
+    )
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument(
+        "--models",
+        type=str,
+        default="base,xxlarge",
+        help="Comma-separated model configs for the reports comparing model sizes",
+    )
+    parser.add_argument(
+        "--model-path",
+        type=Path,
+        default=None,
+        help="An exported model, for the early_exit and long_documents benchmarks",
+    )
+    parser.add_argument(
+        "--valid-path",
+        type=Path,
+        default=None,
+        help="Where the valid.txt file lives, for the early_exit benchmark",
+    )
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        default=32,
+        help="Tokens shared by consecutive windows, for the long_documents benchmark",
+    )
+    parser.add_argument(
+        "--vectors",
+        type=int,
+        default=50000,
+        help="Synthetic sentence embeddings to index, for the ann_index benchmark",
+    )
+    parser.add_argument(
+        "--workers",
+        type=str,
+        default="1,8,32",
+        help="Comma-separated numbers of workers, for the serving_workers benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    return parser
+
+
+def run(args, cfg) -> dict:
+    if args.compare:
+        baseline, candidate = [
+            json.loads(normalize_path(p).read_text()) for p in args.compare
+        ]
+        regressions = compare(baseline, candidate, args.threshold)
+        if regressions:
+            log.error(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+        return {}
+
+    torch.set_num_threads(args.threads)
+    if args.only:
+        names = args.only.split(",")
+    else:
+        names = [name for name, fn in BENCHMARKS.items() if fn.default]
+    ctx = Context(args, cfg)
+    results = {}
+    try:
+        for name in names:
+            fn = BENCHMARKS[name]
+            random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            measured = fn(ctx)
+            if not isinstance(measured, dict):
+                measured = {
+                    None: Measurement(measured, fn.unit, fn.higher_is_better)
+                }
+            for key, m in measured.items():
+                full_name = name if key is None else f"{name}.{key}"
+                results[full_name] = {
+                    "value": statistics.median(m.samples),
+                    "unit": m.unit,
+                    "higher_is_better": m.higher_is_better,
+                    "samples": m.samples,
+                }
+                log.info(f"{full_name:>20}: {results[full_name]['value']:10.2f} {m.unit}")
+    finally:
+        ctx.close()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "threads": args.threads,
+            "seed": args.seed,
+            "model": cfg.model.name,
+            "seq_len": args.seq_len,
+            "batch_size": args.batch_size,
+        },
+        "results": results,
+    }
+    if args.out:
+        out = normalize_path(args.out)
+        out.write_text(json.dumps(report, indent=2))
+        log.info(f"Wrote results to {out}")
+    return report
@@ -0,0 +1,174 @@
+"Sequence-length curriculum: train most steps on short sequences, then on full-length ones"
+
+__all__ = ["Phase", "phases", "examples_before", "CurriculumCallback"]
+
+import logging
+import time
+from collections import namedtuple
+from typing import Callable, List
+
+from fastai.basics import Callback
+from fastai.distributed import DistributedTrainer, num_distrib
+
+log = logging.getLogger(__name__)
+
+Phase = namedtuple("Phase", ["start", "end", "max_seq_length", "batch_size"])
+
+
+def phases(schedule, total_steps: int, max_seq_length: int, batch_size: int) -> List[Phase]:
+    """Split `total_steps` in the phases of `schedule`, a list of `fraction`/`max_seq_length`.
+
+    Each phase's batch size is scaled so every step sees as many token positions as a
+    step of `batch_size` sequences of `max_seq_length`. Fractions are normalized, and
+    the last phase runs until the end.
+    """
+    total_fraction = sum(p["fraction"] for p in schedule)
+    result, start, cumulative = [], 0, 0.0
+    for i, phase in enumerate(schedule):
+        cumulative += phase["fraction"]
+        end = (
+            total_steps
+            if i == len(schedule) - 1
+            else round(total_steps * cumulative / total_fraction)
+        )
+        length = phase["max_seq_length"]
+        if length > max_seq_length:
+            raise ValueError(
+                f"Curriculum phase length {length} exceeds max_seq_length {max_seq_length}"
+            )
+        bs = max(batch_size * max_seq_length // length, 1)
+        if end > start:
+            result.append(Phase(start, end, length, bs))
+        start = end
+    return result
+
+
+def examples_before(phases: List[Phase], step: int, world_size: int = 1) -> int:
+    "The examples all `world_size` ranks train on in the steps of `phases` before `step`"
+    return world_size * sum(
+        (min(step, p.end) - p.start) * p.batch_size for p in phases if p.start < step
+    )
+
+
+def _forever(dl):
+    while True:
+        yield from dl
+
+
+class CurriculumDL:
+    "The `n` training batches of an epoch starting at global step `start`, each from its phase's loader"
+
+    def __init__(self, curriculum: "CurriculumCallback", start: int, n: int):
+        self.curriculum = curriculum
+        self.start = start
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for step in range(self.start, self.start + self.n):
+            yield next(self.curriculum.batches(step))
+
+
+class CurriculumCallback(Callback):
+    """A `Callback` training on sequences whose length follows a schedule.
+
+    `make_dl(max_seq_len, batch_size, start)` builds the training loader of each phase
+    when it starts, from the `start`th example on, where the previous phases left off.
+    Phases are laid out over the steps the training loader would have taken, so an
+    "epoch" is that many steps rather than a pass over the data; the loader of each
+    phase cycles over its data as needed. Throughput is logged per phase.
+    """
+
+    # After the `DistributedTrainer` shards the loader, before progress bars are made of it
+    order = DistributedTrainer.order + 1
+
+    def __init__(self, schedule, make_dl: Callable, max_seq_length: int, batch_size: int):
+        self.schedule = schedule
+        self.make_dl = make_dl
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+
+    def before_fit(self):
+        self.steps_per_epoch = len(self.dls.train)
+        self.phases = phases(
+            self.schedule,
+            self.n_epoch * self.steps_per_epoch,
+            self.max_seq_length,
+            self.batch_size,
+        )
+        self.phase, self.iterator, self.mark = None, None, None
+        log.info(
+            "Sequence length curriculum: "
+            + ", ".join(
+                f"{p.end - p.start} steps at {p.max_seq_length} tokens (batch size {p.batch_size})"
+                for p in self.phases
+            )
+        )
+
+    def before_train(self):
+        self.learn.dl = CurriculumDL(
+            self, self.epoch * self.steps_per_epoch, self.steps_per_epoch
+        )
+
+    def batches(self, step: int):
+        "The iterator over the batches of the phase `step` belongs to"
+        if self.phase is None or step >= self.phase.end:
+            self._end_phase()
+            self.phase = next(p for p in self.phases if p.start <= step < p.end)
+            start = examples_before(self.phases, step, max(num_distrib(), 1))
+            dl = self.make_dl(self.phase.max_seq_length, self.phase.batch_size, start)
+            self.iterator = _forever(self._wrap(dl))
+            self.steps, self.tokens, self.real_tokens = 0, 0, 0
+            self.elapsed, self.mark = 0.0, None
+        return self.iterator
+
+    def _wrap(self, dl):
+        "Shard the phase's loader like the `DistributedTrainer` shards the others"
+        trainer = next(
+            (cb for cb in self.learn.cbs if isinstance(cb, DistributedTrainer)), None
+        )
+        return trainer._wrap_dl(dl) if trainer is not None else dl
+
+    def before_batch(self):
+        if self.training and self.mark is None:
+            self.mark = time.perf_counter()
+
+    def after_batch(self):
+        if not self.training or self.phase is None:
+            return
+        attention_mask = self.xb[0][:, 2]
+        self.steps += 1
+        self.tokens += attention_mask.numel()
+        # Accumulated on the device, so it only synchronizes at the end of the phase
+        self.real_tokens = self.real_tokens + attention_mask.sum()
+
+    def after_train(self):
+        # Validation doesn't count towards the phase's throughput
+        if self.mark is not None:
+            self.elapsed += time.perf_counter() - self.mark
+            self.mark = None
+
+    def after_fit(self):
+        self.after_train()
+        self._end_phase()
+
+    def _end_phase(self):
+        if self.phase is None:
+            return
+        if self.mark is not None:
+            self.elapsed += time.perf_counter() - self.mark
+            self.mark = None
+        if self.steps and self.elapsed:
+            real = float(self.real_tokens)
+            log.info(
+                f"Curriculum phase at {self.phase.max_seq_length} tokens "
+                f"(batch size {self.phase.batch_size}): {self.steps} steps, "
+                f"{self.steps / self.elapsed:.2f} steps/s, "
+                f"{self.tokens / self.elapsed:.0f} tokens/s "
+                f"({real / self.elapsed:.0f} real), "
+                f"{(1 - real / self.tokens) * 100:.1f}% padding"
+            )
+        self.iterator.close()
+        self.phase, self.iterator = None, None
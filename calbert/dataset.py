@@ -1,18 +1,24 @@
 from pathlib import Path
-from typing import Tuple
+from typing import Iterator, List, Tuple
 import itertools
+import json
 import re
+import struct
+import zlib
 
 import torch
-from fastai2.basics import Transform, to_device, default_device
-from fastai2.text.data import TensorText
-from fastai2.data.core import TfmdDL, DataLoaders, Datasets
+from fastai.basics import Transform, to_device, default_device
+from fastai.text.data import TensorText
+from fastai.data.core import TfmdDL, DataLoaders, Datasets
 from torch.utils.data import Dataset, TensorDataset, IterableDataset, DataLoader
 from tqdm import tqdm, trange
 from transformers import AlbertTokenizer
 from collections import namedtuple
 
+from calbert.utils import ordered_map
+
 SentencePair = namedtuple("SentencePair", ["first", "second"])
+PackedPairs = namedtuple("PackedPairs", ["input_ids", "token_type_ids"])
 
 IGNORE_INDEX = -100  # Pytorch CrossEntropyLoss defaults to ignoring -100
 
@@ -20,19 +26,129 @@ IGNORE_INDEX = -100  # Pytorch CrossEntropyLoss defaults to ignoring -100
 punctuation = re.compile(r"[\.!\?]+")
 
 
-def sentence_pairs(filename, min_length=8, max_items=None):
+def line_pairs(line: str, min_length=8):
+    "The pairs of consecutive sentences of a line of text"
+    sentences = [
+        s.strip() for s in punctuation.split(line) if len(s) >= min_length and " " in s
+    ]
+    for a, b in itertools.zip_longest(sentences[:-1], sentences[1:]):
+        yield SentencePair(a + ".", b + ".")
+
+
+SHARD_MAGIC = b"CALBSHD1"
+# A shard ends with the length of its JSON block index and the magic
+SHARD_TRAILER = struct.Struct("<Q8s")
+
+
+def codec(name: str, level: int = 3):
+    "The (compress, decompress) functions of codec `name`: zstd (needs zstandard) or zlib"
+    if name == "zlib":
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "This shard is compressed with zstd: pip install zstandard"
+            ) from e
+        # Neither is safe to share between threads, so each call makes its own
+        return (
+            lambda data: zstandard.ZstdCompressor(level=level).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data),
+        )
+    raise ValueError(f"Unknown codec {name}")
+
+
+def is_shard(path: Path) -> bool:
+    "Whether `path` is a compressed corpus shard rather than plain text"
+    with open(path, "rb") as f:
+        return f.read(len(SHARD_MAGIC)) == SHARD_MAGIC
+
+
+class ShardReader:
+    """Random access to the independently compressed blocks of lines of a corpus shard.
+
+    A shard (written by `python -m calbert shard`) is the magic bytes, the compressed
+    blocks, a JSON index of the blocks and a trailer with the index's length. Each
+    block holds whole lines, and its index entry its offset, compressed and raw sizes
+    and its number of sentence pairs.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+                raise ValueError(f"{path} is not a corpus shard")
+            f.seek(-SHARD_TRAILER.size, 2)
+            length, magic = SHARD_TRAILER.unpack(f.read(SHARD_TRAILER.size))
+            if magic != SHARD_MAGIC:
+                raise ValueError(f"{path} is truncated")
+            f.seek(-SHARD_TRAILER.size - length, 2)
+            index = json.loads(f.read(length).decode("utf-8"))
+        self.codec = index["codec"]
+        self.min_length = index["min_length"]
+        self.blocks = [tuple(block) for block in index["blocks"]]
+        self._decompress = codec(self.codec)[1]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def pair_counts(self) -> List[int]:
+        "The number of sentence pairs (of at least `min_length` sentences) in each block"
+        return [pairs for _, _, _, pairs in self.blocks]
+
+    def read(self, block: int) -> List[str]:
+        "The lines of `block`"
+        offset, size = self.blocks[block][:2]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        return self._decompress(data).decode("utf-8").splitlines()
+
+    def lines(self, blocks=None, threads: int = 2) -> Iterator[List[str]]:
+        "The lines of each of `blocks` (all of them by default), decompressed on `threads` threads"
+        if blocks is None:
+            blocks = range(len(self.blocks))
+        return ordered_map(self.read, blocks, threads)
+
+
+def _lines(filename) -> Iterator[str]:
+    if is_shard(filename):
+        for lines in ShardReader(filename).lines():
+            yield from lines
+        return
     with open(filename, encoding="utf-8") as f:
-        counter = 0
-        for line in f:
-            sentences = [
-                s.strip()
-                for s in punctuation.split(line)
-                if len(s) >= min_length and " " in s
-            ]
-            for a, b in itertools.zip_longest(sentences[:-1], sentences[1:]):
-                if (not max_items) or (max_items and counter < max_items):
-                    counter += 1
-                    yield SentencePair(a + ".", b + ".")
+        yield from f
+
+
+def sentence_pairs(filename, min_length=8, max_items=None):
+    "The sentence pairs of a text file, or of a corpus shard"
+    counter = 0
+    for line in _lines(filename):
+        for pair in line_pairs(line, min_length=min_length):
+            if (not max_items) or (max_items and counter < max_items):
+                counter += 1
+                yield pair
+
+
+def packed_pairs(pairs, tokenizer: AlbertTokenizer, max_seq_len: int):
+    """Greedily concatenate consecutive encoded pairs into sequences of up to `max_seq_len` tokens.
+
+    Every pair keeps its own `[CLS] first [SEP] second [SEP]` layout and token types,
+    so the only padding left is at the tail of each sequence.
+    """
+    input_ids, token_type_ids = [], []
+    for pair in pairs:
+        encoded = tokenizer.encode_plus(
+            pair.first, pair.second, add_special_tokens=True, max_length=max_seq_len,
+        )
+        if input_ids and len(input_ids) + len(encoded["input_ids"]) > max_seq_len:
+            yield PackedPairs(input_ids, token_type_ids)
+            input_ids, token_type_ids = [], []
+        input_ids = input_ids + encoded["input_ids"]
+        token_type_ids = token_type_ids + encoded["token_type_ids"]
+    if input_ids:
+        yield PackedPairs(input_ids, token_type_ids)
 
 
 class Tokenize(Transform):
@@ -60,6 +176,20 @@ class Tokenize(Transform):
             )
         )
 
+    # fastai dispatches `encodes` on the annotated input type, so redefining it adds
+    # the packed case rather than replacing the single-pair one
+    def encodes(self, inp: PackedPairs) -> TensorText:  # noqa: F811
+        padding = self.max_seq_len - len(inp.input_ids)
+        return TensorText(
+            torch.tensor(
+                [
+                    inp.input_ids + [self.tokenizer.pad_token_id] * padding,
+                    [1] * len(inp.input_ids) + [0] * padding,
+                    inp.token_type_ids + [0] * padding,
+                ]
+            )
+        )
+
     def decodes(self, encoded: TensorText):
         enc = encoded if encoded.ndim == 1 else encoded[0]
         return self.tokenizer.decode(
@@ -67,20 +197,66 @@ class Tokenize(Transform):
         )
 
 
+def rotated(examples: Iterator, start: int) -> Iterator:
+    "`examples` from the `start`th on, followed by the ones before it (modulo their number)"
+    if not start:
+        return examples
+    examples = iter(examples)
+    skipped = list(itertools.islice(examples, start))
+    if len(skipped) < start:  # fewer than `start` examples in all
+        start %= max(len(skipped), 1)
+        return iter(skipped[start:] + skipped[:start])
+    return itertools.chain(examples, skipped)
+
+
 class CalbertDataset(IterableDataset):
-    def __init__(self, dataset_path: Path, max_items=None):
+    "The sentence pairs of a corpus, from the `start`th one round to the one before it"
+
+    def __init__(self, dataset_path: Path, max_items=None, start: int = 0):
         super(CalbertDataset, self).__init__()
         self.path = dataset_path
         self.max_items = max_items
+        self.start = start
 
     def __iter__(self):
+        return rotated(self._pairs(), self.start)
+
+    def _pairs(self):
         return sentence_pairs(self.path, max_items=self.max_items)
 
 
+class PackedCalbertDataset(CalbertDataset):
+    "A `CalbertDataset` packing consecutive sentence pairs into full-length sequences"
+
+    def __init__(
+        self,
+        dataset_path: Path,
+        tokenizer: AlbertTokenizer,
+        max_seq_len: int,
+        max_items=None,
+        start: int = 0,
+    ):
+        super(PackedCalbertDataset, self).__init__(
+            dataset_path, max_items=max_items, start=start
+        )
+        self.tokenizer = tokenizer
+        self.max_seq_len = max_seq_len
+
+    def __iter__(self):
+        # `start` counts packed sequences
+        packed = packed_pairs(self._pairs(), self.tokenizer, self.max_seq_len)
+        return rotated(packed, self.start)
+
+
 def mask_tokens(
-    inputs: torch.Tensor, tok: AlbertTokenizer, ignore_index: int, probability: float,
+    inputs: torch.Tensor,
+    tok: AlbertTokenizer,
+    ignore_index: int,
+    probability: float,
+    generator: torch.Generator = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+    """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+    Draws from `generator`, if given, instead of the global random state. """
     special_tokens_mask = (
         (inputs == tok.cls_token_id)
         | (inputs == tok.pad_token_id)
@@ -92,24 +268,27 @@ def mask_tokens(
     probability_matrix = torch.full(labels.shape, probability)
     probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
     probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
-    masked_indices = torch.bernoulli(probability_matrix).bool()
+    masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
     labels[~masked_indices] = ignore_index  # We only compute loss on masked tokens
 
     # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
     indices_replaced = (
-        torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        torch.bernoulli(torch.full(labels.shape, 0.8), generator=generator).bool()
+        & masked_indices
     )
     inputs[indices_replaced] = tok.mask_token_id
 
     # 10% of the time, we replace masked input tokens with random word
     indices_random = (
-        torch.bernoulli(torch.full(labels.shape, 0.5)).bool()
+        torch.bernoulli(torch.full(labels.shape, 0.5), generator=generator).bool()
         & masked_indices
         & ~indices_replaced
     )
 
     le = len(tok)
-    random_words = torch.randint(le, labels.shape, dtype=torch.long)
+    random_words = torch.randint(
+        le, labels.shape, dtype=torch.long, generator=generator
+    )
     inputs[indices_random] = random_words[indices_random]
 
     # The rest of the time (10% of the time) we keep the masked input tokens unchanged
@@ -139,30 +318,44 @@ class Ignore(Transform):
         return 0
 
 
-def dataloaders(
-    args, cfg, tokenizer: AlbertTokenizer, tds: CalbertDataset, vds: CalbertDataset,
-) -> DataLoaders:
-    tfms = [
-        Tokenize(tokenizer, max_seq_len=cfg.training.max_seq_length),
+def transforms(tokenizer: AlbertTokenizer, cfg, max_seq_len: int = None) -> list:
+    "Tokenize and mask examples to `max_seq_len` tokens (defaults to `training.max_seq_length`)"
+    return [
+        Tokenize(tokenizer, max_seq_len=max_seq_len or cfg.training.max_seq_length),
         Mask(tok=tokenizer, probability=cfg.training.masked_lm_prob),
     ]
 
-    train_ds = Datasets(tds, tfms=[tfms, [Ignore()]])
-    valid_ds = Datasets(vds, tfms=[tfms, [Ignore()]])
+
+def loader_options(cfg) -> dict:
+    "The loader workers and batches prefetched by each of them, from the `data` config"
+    data = cfg.get("data", {})
+    return dict(
+        num_workers=data.get("num_workers", 4), prefetch_factor=data.get("prefetch_factor", 2)
+    )
+
+
+def dataloader(
+    ds: CalbertDataset, tfms: list, batch_size: int, num_workers=4, prefetch_factor=2
+) -> TfmdDL:
+    dl = TfmdDL(
+        Datasets(ds, tfms=[tfms, [Ignore()]]),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        device=default_device(),
+        pin_memory=True,
+    )
+    # Read by torch's multi-process loader iterator
+    dl.fake_l.prefetch_factor = prefetch_factor
+    return dl
+
+
+def dataloaders(
+    args, cfg, tokenizer: AlbertTokenizer, tds: CalbertDataset, vds: CalbertDataset,
+) -> DataLoaders:
+    tfms = transforms(tokenizer, cfg)
+    options = loader_options(cfg)
 
     return DataLoaders(
-        TfmdDL(
-            train_ds,
-            batch_size=args.train_batch_size,
-            num_workers=4,
-            device=default_device(),
-            pin_memory=True,
-        ),
-        TfmdDL(
-            valid_ds,
-            batch_size=args.eval_batch_size,
-            num_workers=4,
-            device=default_device(),
-            pin_memory=True,
-        ),
+        dataloader(tds, tfms, batch_size=args.train_batch_size, **options),
+        dataloader(vds, tfms, batch_size=args.eval_batch_size, **options),
     )
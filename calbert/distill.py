@@ -0,0 +1,400 @@
+"""Distill a big exported calbert model (the teacher) into a smaller one (the student).
+
+The training set is tokenized and masked once (with the run's seed), so the teacher's
+predictions for every masked token can be computed once, cached on disk, and reused
+across epochs and runs. Only the teacher's `top_k` logits per masked token are kept
+(and, optionally, its last hidden state there), which bounds the cache size.
+
+The student learns from the true masked tokens and from the teacher's temperature
+softened distribution over them, and optionally matches the teacher's hidden states
+through a linear projection (which is not exported).
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import statistics
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from fastai.basics import Callback, Learner, default_device
+from fastai.callback.fp16 import MixedPrecision
+from fastai.data.core import DataLoaders, TfmdDL
+from transformers import AlbertForMaskedLM
+
+from calbert.benchmark import timed
+from calbert.dataset import IGNORE_INDEX
+from calbert.model import CalbertForMaskedLM
+from calbert.precision import PRECISIONS, to_precision
+from calbert.tokenizer import load as load_tokenizer
+from calbert.training import export, initialize_model, optimizer
+from calbert.utils import normalize_path
+from calbert.validation import (
+    DevicePerplexity,
+    EvalSet,
+    cached_eval_set,
+    eval_dataloader,
+)
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Distill an exported calbert model into a smaller ALBERT"
+    )
+    parser.add_argument(
+        "--teacher-path",
+        required=True,
+        type=Path,
+        help="The directory of the teacher, as exported by `train --export-path`",
+    )
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        required=True,
+        help="The path to the sentencepiece *model* the teacher was trained with",
+    )
+    parser.add_argument(
+        "--train-path", required=True, type=Path, help="Where the train.txt file lives",
+    )
+    parser.add_argument(
+        "--valid-path", required=True, type=Path, help="Where the valid.txt file lives",
+    )
+    parser.add_argument(
+        "--export-path",
+        default=None,
+        type=Path,
+        help="The optional output directory where to save the student in HuggingFace format",
+    )
+    parser.add_argument(
+        "--train-batch-size",
+        default=None,
+        type=int,
+        help="Batch size for training (defaults to training.batch_size)",
+    )
+    parser.add_argument("--eval-batch-size", default=128, type=int)
+    parser.add_argument("--epochs", default=1, type=int)
+    parser.add_argument(
+        "--max-items",
+        default=None,
+        type=int,
+        help="Sentence pairs to distill on (defaults to distillation.max_items)",
+    )
+    parser.add_argument("--precision", default="fp32", choices=PRECISIONS)
+    parser.add_argument(
+        "--repeat", default=10, type=int, help="Timed forward passes for the speed-up",
+    )
+    return parser
+
+
+def load_teacher(path: Path, output_hidden_states: bool = False) -> CalbertForMaskedLM:
+    "The exported model at `path`, frozen and taking calbert's batches"
+    teacher = AlbertForMaskedLM.from_pretrained(
+        str(path), output_hidden_states=output_hidden_states
+    )
+    teacher.__class__ = CalbertForMaskedLM
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    return teacher.eval()
+
+
+def masked_offsets(examples: torch.Tensor) -> np.ndarray:
+    "Where the masked tokens of each of `examples` start in a flat array of all of them"
+    counts = (examples[:, 1] != IGNORE_INDEX).sum(1).numpy()
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+class TeacherTargets:
+    "The teacher's cached top-k logits (and hidden states) at the masked tokens of each example"
+
+    def __init__(self, directory: Path):
+        self.offsets = np.load(directory / "offsets.npy")
+        self.values = np.load(directory / "values.npy", mmap_mode="r")
+        self.indices = np.load(directory / "indices.npy", mmap_mode="r")
+        hidden = directory / "hidden.npy"
+        self.hidden = np.load(hidden, mmap_mode="r") if hidden.exists() else None
+
+    def _rows(self, array: np.ndarray, items) -> np.ndarray:
+        return np.concatenate(
+            [array[self.offsets[i] : self.offsets[i + 1]] for i in items]
+        )
+
+    def batch(self, items, device):
+        "Teacher logits, token ids and hidden states (or `None`) of the masked tokens of `items`, in order"
+        values = torch.from_numpy(self._rows(self.values, items)).to(device)
+        indices = torch.from_numpy(self._rows(self.indices, items)).long().to(device)
+        hidden = None
+        if self.hidden is not None:
+            hidden = torch.from_numpy(self._rows(self.hidden, items)).to(device)
+        return values, indices, hidden
+
+
+def _digest(examples: torch.Tensor, teacher_path: Path, top_k: int, hidden: bool) -> str:
+    digest = hashlib.sha1(examples.numpy().tobytes())
+    weights = os.stat(Path(teacher_path) / "pytorch_model.bin")
+    settings = (str(Path(teacher_path).resolve()), weights.st_size, weights.st_mtime)
+    digest.update(repr(settings + (top_k, hidden)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def cached_teacher_targets(
+    teacher: CalbertForMaskedLM,
+    teacher_path: Path,
+    examples: torch.Tensor,
+    cache_dir: Path,
+    top_k: int,
+    hidden: bool = False,
+    batch_size: int = 64,
+) -> TeacherTargets:
+    """The teacher's targets for `examples`, computed once and cached in `cache_dir`.
+
+    Keyed by the examples, the teacher's weights and the settings.
+    """
+    key = _digest(examples, teacher_path, top_k, hidden)
+    directory = Path(cache_dir) / f"teacher-{key}"
+    if directory.exists():
+        log.info(f"Loading the teacher's targets from {directory}")
+        return TeacherTargets(directory)
+
+    offsets = masked_offsets(examples)
+    total = int(offsets[-1])
+    log.info(
+        f"Caching the teacher's top {top_k} logits of {total} masked tokens in {directory}"
+    )
+    tmp = Path(f"{directory}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True)
+    np.save(tmp / "offsets.npy", offsets)
+    open_memmap = np.lib.format.open_memmap
+    values = open_memmap(tmp / "values.npy", "w+", np.float16, (total, top_k))
+    indices = open_memmap(tmp / "indices.npy", "w+", np.int32, (total, top_k))
+    states = None
+    if hidden:
+        states = open_memmap(
+            tmp / "hidden.npy", "w+", np.float16, (total, teacher.config.hidden_size)
+        )
+    device = next(teacher.parameters()).device
+    with torch.no_grad():
+        for start in range(0, len(examples), batch_size):
+            x = examples[start : start + batch_size].long().to(device)
+            outputs = teacher(x)
+            masked = x[:, 1] != IGNORE_INDEX
+            top = outputs[1][masked].float().topk(top_k, dim=-1)
+            a, b = offsets[start], offsets[start + len(x)]
+            values[a:b] = top.values.cpu().numpy()
+            indices[a:b] = top.indices.cpu().numpy()
+            if hidden:
+                states[a:b] = outputs[2][-1][masked].float().cpu().numpy()
+    for array in [values, indices, states]:
+        if array is not None:
+            array.flush()
+    del values, indices, states
+    try:
+        os.rename(tmp, directory)
+    except OSError:  # another process cached it first
+        shutil.rmtree(tmp)
+    return TeacherTargets(directory)
+
+
+def distillation_loss(
+    scores: torch.Tensor, values: torch.Tensor, indices: torch.Tensor, temperature: float
+) -> torch.Tensor:
+    """KL divergence from the teacher's softened distribution over its top tokens to the student's.
+
+    Both distributions are renormalized over the teacher's top tokens, which hold nearly
+    all of its probability mass.
+    """
+    student = torch.gather(scores.float(), -1, indices) / temperature
+    teacher = values.float() / temperature
+    kl = F.kl_div(F.log_softmax(student, -1), F.softmax(teacher, -1), reduction="batchmean")
+    return kl * temperature ** 2
+
+
+class DistillSet(EvalSet):
+    "Pre-masked examples whose target is their index, to look up the teacher's targets"
+
+    def __getitem__(self, i):
+        return self.examples[i].long(), i
+
+
+class DistillationCallback(Callback):
+    """A `Callback` mixing the student's masked LM loss with matching the teacher.
+
+    The loss becomes `alpha` times the masked LM loss plus `1 - alpha` times the
+    distillation loss at `temperature`, plus `hidden_weight` times the mean squared
+    error between the projected last hidden states of the student and the teacher's.
+    """
+
+    order = MixedPrecision.order - 1  # which scales the loss
+
+    def __init__(
+        self,
+        targets: TeacherTargets,
+        temperature: float,
+        alpha: float,
+        hidden_weight: float = 0.0,
+    ):
+        self.targets = targets
+        self.temperature = temperature
+        self.alpha = alpha
+        self.hidden_weight = hidden_weight
+
+    def after_loss(self):
+        if not self.training:
+            return
+        x = self.xb[0]
+        masked = x[:, 1] != IGNORE_INDEX
+        values, indices, hidden = self.targets.batch(self.yb[0].tolist(), x.device)
+        loss = self.alpha * self.learn.loss + (1 - self.alpha) * distillation_loss(
+            self.pred[1][masked], values, indices, self.temperature
+        )
+        if self.hidden_weight:
+            student = getattr(self.learn.model, "module", self.learn.model)
+            projected = student.distill_projection(self.pred[2][-1][masked])
+            loss = loss + self.hidden_weight * F.mse_loss(projected.float(), hidden.float())
+        self.learn.loss = loss
+
+
+def masked_accuracy(model: CalbertForMaskedLM, dl) -> float:
+    "Share of the masked tokens of `dl` that `model` predicts right"
+    model.eval()
+    device = next(model.parameters()).device
+    correct, total = 0, 0
+    with torch.no_grad():
+        for xb, _ in dl:
+            xb = xb.to(device)
+            labels = xb[:, 1]
+            masked = labels != IGNORE_INDEX
+            predicted = model(xb)[1].argmax(-1)
+            correct = correct + (predicted[masked] == labels[masked]).sum()
+            total = total + masked.sum()
+    return (correct.float() / total).item() if torch.is_tensor(total) and total.item() else 0.0
+
+
+def latency(model: CalbertForMaskedLM, batch: torch.Tensor, repeat: int) -> float:
+    "Median milliseconds of a forward pass of `model` over `batch`"
+    model.eval()
+    batch = batch.to(next(model.parameters()).device)
+
+    def forward():
+        with torch.no_grad():
+            model(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+
+    return statistics.median(timed(forward, repeat)) * 1000
+
+
+def distill(args, cfg) -> dict:
+    args.teacher_path = normalize_path(args.teacher_path)
+    args.tokenizer_path = normalize_path(args.tokenizer_path)
+    args.train_path = normalize_path(args.train_path)
+    args.valid_path = normalize_path(args.valid_path)
+    if args.train_batch_size is None:
+        args.train_batch_size = cfg.training.get("batch_size", 128)
+    settings = cfg.distillation
+    cache_dir = normalize_path(Path(cfg.validation.cache_dir))
+    hidden = settings.hidden_weight > 0
+
+    tokenizer = load_tokenizer(cfg, args.tokenizer_path)
+    teacher = load_teacher(args.teacher_path, output_hidden_states=hidden)
+    if teacher.config.vocab_size != len(tokenizer):
+        raise ValueError(
+            f"The teacher has {teacher.config.vocab_size} tokens but the tokenizer "
+            f"{len(tokenizer)}: distill with the tokenizer the teacher was trained with"
+        )
+    teacher.to(default_device())
+
+    def examples(path, max_items, stratified):
+        return cached_eval_set(
+            path,
+            tokenizer,
+            cache_dir=cache_dir,
+            max_seq_len=cfg.training.max_seq_length,
+            probability=cfg.training.masked_lm_prob,
+            max_items=max_items,
+            stratified=stratified,
+            seed=cfg.seed,
+        )
+
+    # The examples are masked and held in memory whole, so by default they are bounded
+    max_items = settings.get("max_items") if args.max_items is None else args.max_items
+    train_examples = examples(args.train_path, max_items, False)
+    valid_examples = examples(
+        args.valid_path, cfg.validation.max_items, cfg.validation.stratified
+    )
+    targets = cached_teacher_targets(
+        teacher,
+        args.teacher_path,
+        train_examples,
+        cache_dir,
+        top_k=settings.top_k,
+        hidden=hidden,
+        batch_size=args.eval_batch_size,
+    )
+
+    student = initialize_model(cfg, args, tokenizer, output_hidden_states=hidden)
+    if hidden:
+        student.distill_projection = nn.Linear(
+            student.config.hidden_size, teacher.config.hidden_size
+        ).to(default_device())
+    dls = DataLoaders(
+        TfmdDL(
+            DistillSet(train_examples),
+            batch_size=args.train_batch_size,
+            shuffle=True,
+            drop_last=True,
+            device=default_device(),
+            pin_memory=True,
+        ),
+        eval_dataloader(valid_examples, batch_size=args.eval_batch_size),
+    )
+    learn = Learner(
+        dls,
+        student,
+        loss_func=lambda out, _: out[0],
+        opt_func=optimizer(cfg),
+        metrics=[DevicePerplexity()],
+        cbs=[
+            DistillationCallback(
+                targets,
+                temperature=settings.temperature,
+                alpha=settings.alpha,
+                hidden_weight=settings.hidden_weight,
+            )
+        ],
+    )
+    learn = to_precision(learn, args.precision)
+    log.info(
+        f"Distilling {args.teacher_path} ({teacher.num_parameters()} parameters) into "
+        f"model {cfg.model.name} ({student.num_parameters()} parameters)"
+    )
+    learn.fit_one_cycle(args.epochs, lr_max=cfg.training.learning_rate)
+
+    valid_dl = eval_dataloader(valid_examples, batch_size=args.eval_batch_size)
+    batch = valid_examples[: args.eval_batch_size].long()
+    report = dict(
+        teacher_accuracy=masked_accuracy(teacher, valid_dl),
+        student_accuracy=masked_accuracy(student, valid_dl),
+        teacher_ms=latency(teacher, batch, args.repeat),
+        student_ms=latency(student, batch, args.repeat),
+    )
+    report["speedup"] = report["teacher_ms"] / report["student_ms"]
+    log.info(
+        f"Masked token accuracy: teacher {report['teacher_accuracy'] * 100:.2f}%, "
+        f"student {report['student_accuracy'] * 100:.2f}%. Forward pass of "
+        f"{len(batch)} sequences: teacher {report['teacher_ms']:.1f} ms, student "
+        f"{report['student_ms']:.1f} ms ({report['speedup']:.1f}x faster)"
+    )
+
+    if args.export_path:
+        if hidden:
+            del student.distill_projection
+        student.config.output_hidden_states = False
+        export(student, tokenizer, normalize_path(args.export_path))
+    return report
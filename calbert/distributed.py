@@ -0,0 +1,238 @@
+"Data-parallel training over NCCL on GPUs, or over gloo on CPUs"
+
+__all__ = [
+    "CommStats",
+    "COMM_HOOKS",
+    "CPUDistributedDL",
+    "DDPTrainer",
+    "setup",
+    "distrib_ctx",
+]
+
+import logging
+import time
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from fastai.basics import Learner, noop
+from fastai.callback.progress import ProgressCallback
+from fastai.distributed import (
+    DistributedDL,
+    DistributedTrainer,
+    rank_distrib,
+    num_distrib,
+)
+
+log = logging.getLogger(__name__)
+
+
+COMM_HOOKS = ["none", "fp16", "bf16", "powersgd"]
+
+
+class CommStats:
+    "Bytes each rank sends and seconds spent in gradient all-reduce during the current step"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes = 0
+        self.seconds = 0.0
+
+
+def _allreduce_hook(stats: CommStats, dtype=None):
+    "A hook averaging gradients like DDP does, optionally sending them as `dtype`"
+
+    def hook(process_group, bucket):
+        group = process_group if process_group is not None else dist.group.WORLD
+        buffer = bucket.buffer()
+        tensor = buffer if dtype is None else buffer.to(dtype)
+        tensor.div_(dist.get_world_size(group))
+        stats.bytes += tensor.numel() * tensor.element_size()
+        fut = dist.all_reduce(tensor, group=group, async_op=True).get_future()
+
+        def decompress(fut):
+            if dtype is not None:
+                buffer.copy_(fut.value()[0])
+            return buffer
+
+        return fut.then(decompress)
+
+    return hook
+
+
+def _powersgd_hook(stats: CommStats, rank: int, start_iter: int):
+    "PowerSGD low-rank compression, counting what it sends"
+    from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook as powersgd
+
+    state = powersgd.PowerSGDState(
+        process_group=None,
+        matrix_approximation_rank=rank,
+        start_powerSGD_iter=start_iter,
+    )
+
+    def hook(_, bucket):
+        buffer = bucket.buffer()
+        size = buffer.element_size()
+        if state.iter < state.start_powerSGD_iter:
+            stats.bytes += buffer.numel() * size
+        else:
+            # Matrices are sent as their two rank-`rank` factors, the rest as is
+            for grad in bucket.gradients():
+                n, m = grad.shape[0], grad.numel() // max(grad.shape[0], 1)
+                compressed = (n + m) * rank
+                if grad.dim() > 1 and compressed * state.min_compression_rate < n * m:
+                    stats.bytes += compressed * size
+                else:
+                    stats.bytes += grad.numel() * size
+        return powersgd.powerSGD_hook(state, bucket)
+
+    return hook
+
+
+def _timed(hook, stats: CommStats):
+    "Wrap a communication hook to add the time until its result is ready to `stats`"
+
+    def timed(state, bucket):
+        start = time.perf_counter()
+
+        def done(fut):
+            stats.seconds += time.perf_counter() - start
+            return fut.value()
+
+        return hook(state, bucket).then(done)
+
+    return timed
+
+
+class CPUDistributedDL(DistributedDL):
+    "A `DistributedDL` that broadcasts the order of the examples over gloo as well as NCCL"
+
+    def __init__(self, dl, rank=None, world_size=None):
+        super().__init__(dl, rank, world_size)
+        # fastai builds a new fake loader, which would prefetch the default 2 batches
+        self.fake_l.prefetch_factor = dl.fake_l.prefetch_factor
+
+    def _broadcast(self, t, rank):
+        if dist.get_backend() == "nccl":
+            return super()._broadcast(t, rank)
+        t = torch.LongTensor(t)
+        dist.broadcast(t, rank)
+        return t.tolist()
+
+
+class DDPTrainer(DistributedTrainer):
+    """A `DistributedTrainer` that also trains on CPU when `cuda_id` is `None`.
+
+    Gradients are all-reduced through a communication hook: plain fp32 (`"none"`),
+    cast to fp16 or bf16, or PowerSGD low-rank compression of rank `powersgd_rank`
+    once `powersgd_start_iter` steps have run uncompressed. The bytes sent and the
+    all-reduce time of every step are kept in `stats` and summarized each epoch.
+    """
+
+    def __init__(
+        self,
+        cuda_id=None,
+        comm_hook: str = "none",
+        powersgd_rank: int = 4,
+        powersgd_start_iter: int = 10,
+        bucket_cap_mb: int = 25,
+    ):
+        if comm_hook not in COMM_HOOKS:
+            raise ValueError(
+                f"Invalid comm_hook {comm_hook}: must be one of {', '.join(COMM_HOOKS)}"
+            )
+        super().__init__(cuda_id)
+        self.comm_hook = comm_hook
+        self.powersgd_rank = powersgd_rank
+        self.powersgd_start_iter = powersgd_start_iter
+        self.bucket_cap_mb = bucket_cap_mb
+        self.stats = CommStats()
+
+    def before_fit(self):
+        opt_kwargs = (
+            {"find_unused_parameters": DistributedTrainer.fup}
+            if DistributedTrainer.fup is not None
+            else {}
+        )
+        if self.cuda_id is not None:
+            opt_kwargs.update(device_ids=[self.cuda_id], output_device=self.cuda_id)
+        self.learn.model = DistributedDataParallel(
+            self.model, bucket_cap_mb=self.bucket_cap_mb, **opt_kwargs
+        )
+        self._register_comm_hook()
+        self.old_dls = list(self.dls)
+        self.learn.dls.loaders = [self._wrap_dl(dl) for dl in self.dls]
+        if rank_distrib() > 0:
+            self.learn.logger = noop
+
+    def _wrap_dl(self, dl):
+        # Loaders fed by the node's data producer are already sharded
+        if getattr(dl, "sharded", False) or isinstance(dl, DistributedDL):
+            return dl
+        return CPUDistributedDL(dl)
+
+    def _register_comm_hook(self):
+        if self.comm_hook == "powersgd":
+            hook = _powersgd_hook(
+                self.stats, self.powersgd_rank, self.powersgd_start_iter
+            )
+        else:
+            dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(self.comm_hook)
+            hook = _allreduce_hook(self.stats, dtype)
+        self.learn.model.register_comm_hook(None, _timed(hook, self.stats))
+
+    def before_epoch(self):
+        self.epoch_bytes, self.epoch_seconds, self.epoch_steps = 0, 0.0, 0
+
+    def before_batch(self):
+        self.stats.reset()
+
+    def after_batch(self):
+        if self.training:
+            self.epoch_bytes += self.stats.bytes
+            self.epoch_seconds += self.stats.seconds
+            self.epoch_steps += 1
+
+    def after_epoch(self):
+        if self.epoch_steps and rank_distrib() == 0:
+            log.info(
+                f"All-reduce ({self.comm_hook}): "
+                f"{self.epoch_bytes / self.epoch_steps / 2 ** 20:.1f}MiB sent and "
+                f"{self.epoch_seconds / self.epoch_steps * 1000:.1f}ms per step"
+            )
+
+
+def setup(cuda_id=None) -> bool:
+    "Join the process group described by the environment: NCCL on `cuda_id`, or gloo on CPU"
+    if cuda_id is not None:
+        torch.cuda.set_device(cuda_id)
+    if num_distrib() <= 1 or dist.is_initialized():
+        return False
+    backend = "nccl" if cuda_id is not None else "gloo"
+    dist.init_process_group(backend=backend, init_method="env://")
+    log.info(
+        f"Joined {backend} process group as rank {rank_distrib()} of {num_distrib()}"
+    )
+    return True
+
+
+@contextmanager
+def distrib_ctx(learn: Learner, cuda_id=None, **kwargs):
+    """Like fastai's `Learner.distrib_ctx`, but training on CPU over gloo when `cuda_id` is `None`.
+
+    `kwargs` configure the `DDPTrainer`.
+    """
+    cleanup = setup(cuda_id)
+    try:
+        if num_distrib() > 1:
+            learn.add_cb(DDPTrainer(cuda_id, **kwargs))
+            if rank_distrib() > 0:
+                learn.remove_cb(ProgressCallback)
+        yield learn
+    finally:
+        learn.detach_distributed()
+        if cleanup:
+            dist.destroy_process_group()
@@ -0,0 +1,205 @@
+"""Evaluate the checkpoints of a training run as it writes them, outside of it.
+
+Train with `validation.mode=external` so that the training ranks only take optimizer
+steps and save checkpoints, and run `python -m calbert evaluate --watch DIR` on the
+run's models directory in another process (or on another machine sharing it). Every
+new `model_{epoch}.pth`, and then `final.pth`, is evaluated on the cached validation
+set and its metrics appended to a JSONL file.
+"""
+
+import argparse
+import json
+import logging
+import math
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List
+
+import torch
+
+from calbert.dataset import IGNORE_INDEX
+from calbert.tokenizer import load as load_tokenizer
+from calbert.utils import normalize_path
+from calbert.validation import cached_eval_set
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT = re.compile(r"^model_(\d+)\.pth$")
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Evaluate the checkpoints of a training run as they are written"
+    )
+    parser.add_argument(
+        "--watch",
+        required=True,
+        type=Path,
+        help="The models directory of the training run (its output directory/models)",
+    )
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        required=True,
+        help="The path to the sentencepiece *model* (ca.{uncased|cased}.VOCABSIZE.model)",
+    )
+    parser.add_argument(
+        "--valid-path", required=True, type=Path, help="Where the valid.txt file lives",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        default=None,
+        help="Where to append the metrics (defaults to WATCH/metrics.jsonl)",
+    )
+    parser.add_argument("--eval-batch-size", default=128, type=int)
+    parser.add_argument(
+        "--interval", type=float, default=30, help="Seconds between looks for checkpoints",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Evaluate the checkpoints already there and exit, without waiting for more",
+    )
+    return parser
+
+
+def checkpoints(directory: Path) -> List[Path]:
+    "The checkpoints in `directory`, by epoch, and the final one last"
+    epochs = []
+    for path in Path(directory).glob("model_*.pth"):
+        match = CHECKPOINT.match(path.name)
+        if match:
+            epochs.append((int(match.group(1)), path))
+    epochs.sort()
+    final = Path(directory) / "final.pth"
+    return [path for _, path in epochs] + ([final] if final.exists() else [])
+
+
+def _evaluated(metrics_file: Path) -> set:
+    "The checkpoints (name and modification time) the metrics file already has"
+    if not metrics_file.exists():
+        return set()
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {(r["checkpoint"], r["mtime"]) for r in records}
+
+
+def evaluate(model, examples: torch.Tensor, batch_size: int) -> dict:
+    "Masked LM loss, perplexity and accuracy of `model` over the masked tokens of `examples`"
+    model.eval()
+    device = next(model.parameters()).device
+    loss, correct, count = 0.0, 0, 0
+    with torch.no_grad():
+        for start in range(0, len(examples), batch_size):
+            x = examples[start : start + batch_size].long().to(device)
+            labels = x[:, 1]
+            masked = labels != IGNORE_INDEX
+            n = masked.sum().item()
+            if not n:
+                continue
+            batch_loss, scores = model(x)[:2]
+            loss += batch_loss.item() * n
+            correct += (scores.argmax(-1)[masked] == labels[masked]).sum().item()
+            count += n
+    loss = loss / count if count else math.nan
+    return dict(
+        loss=loss,
+        perplexity=math.exp(loss),
+        accuracy=correct / count if count else math.nan,
+        tokens=count,
+    )
+
+
+def load_checkpoint(model, path: Path):
+    "Load the weights of a checkpoint saved by `Learner.save` or `CheckpointCallback`"
+    state = torch.load(path, map_location="cpu")
+    model.load_state_dict(state.get("model", state))
+    return model
+
+
+def watch(
+    directory: Path,
+    evaluate_checkpoint: Callable[[Path], dict],
+    metrics_file: Path,
+    interval: float = 30,
+    once: bool = False,
+) -> List[dict]:
+    """Evaluate every checkpoint of `directory` not in `metrics_file` yet, appending to it.
+
+    Waits for new ones every `interval` seconds until `final.pth` is evaluated, or, if
+    `once`, returns after those already there. A checkpoint is only evaluated once its
+    size and modification time hold still for an interval, so that it's fully written.
+    """
+    done = _evaluated(metrics_file)
+    seen, records = {}, []
+    while True:
+        for path in checkpoints(directory):
+            stat = path.stat()
+            if (path.name, stat.st_mtime) in done:
+                continue
+            if not once and seen.get(path) != (stat.st_size, stat.st_mtime):
+                seen[path] = (stat.st_size, stat.st_mtime)
+                continue
+            try:
+                start = time.perf_counter()
+                metrics = evaluate_checkpoint(path)
+            except (RuntimeError, EOFError, OSError) as e:
+                log.warning(f"Couldn't evaluate {path}, retrying later: {e}")
+                seen.pop(path, None)
+                continue
+            match = CHECKPOINT.match(path.name)
+            record = dict(
+                checkpoint=path.name,
+                epoch=int(match.group(1)) if match else None,
+                mtime=stat.st_mtime,
+                evaluated_at=datetime.now().isoformat(timespec="seconds"),
+                seconds=time.perf_counter() - start,
+                **metrics,
+            )
+            with open(metrics_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            done.add((path.name, stat.st_mtime))
+            records.append(record)
+            log.info(
+                f"{path.name}: "
+                + ", ".join(f"{k} {v:.4f}" for k, v in metrics.items() if k != "tokens")
+            )
+            if path.name == "final.pth" and not once:
+                return records
+        if once:
+            return records
+        time.sleep(interval)
+
+
+def run(args, cfg) -> List[dict]:
+    from calbert.training import initialize_model
+
+    directory = normalize_path(args.watch)
+    metrics_file = normalize_path(args.metrics_file or directory / "metrics.jsonl")
+    tokenizer = load_tokenizer(cfg, normalize_path(args.tokenizer_path))
+    validation = cfg.get("validation", {})
+    examples = cached_eval_set(
+        normalize_path(args.valid_path),
+        tokenizer,
+        cache_dir=normalize_path(Path(validation.get("cache_dir", "cache"))),
+        max_seq_len=cfg.training.max_seq_length,
+        probability=cfg.training.masked_lm_prob,
+        max_items=validation.get("max_items", None),
+        stratified=validation.get("stratified", True),
+        seed=cfg.seed,
+    )
+    model = initialize_model(cfg, args, tokenizer)
+
+    def evaluate_checkpoint(path: Path) -> dict:
+        return evaluate(load_checkpoint(model, path), examples, args.eval_batch_size)
+
+    log.info(
+        f"Evaluating the checkpoints of {directory} on {len(examples)} pairs "
+        f"into {metrics_file}"
+    )
+    return watch(
+        directory, evaluate_checkpoint, metrics_file, args.interval, once=args.once
+    )
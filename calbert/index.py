@@ -0,0 +1,365 @@
+"""Approximate nearest-neighbour search over calbert sentence embeddings.
+
+Sentences are embedded as the mean of an exported model's last hidden states over
+their tokens, normalized to unit length (so the nearest ones by L2 distance are the
+most similar by cosine). `IVFPQIndex` is an inverted file with product quantization,
+in plain NumPy: vectors are assigned to the nearest of `nlist` k-means centroids, and
+their residuals are compressed to `m` one-byte codes, one per subspace. A query only
+scans the lists of its `nprobe` nearest centroids, computing approximate distances
+from per-subspace lookup tables.
+
+Added vectors go to a new segment, so an index saved on disk only ever has files
+appended to it, and is loaded memory-mapped.
+"""
+
+__all__ = ["IVFPQIndex", "brute_force", "embed", "kmeans", "normalized", "recall_at_k"]
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from calbert.inference import SlidingWindowEncoder
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Index sentence embeddings for semantic search, and query them"
+    )
+    parser.add_argument(
+        "--model-path",
+        required=True,
+        type=Path,
+        help="The directory of the model, as exported by `train --export-path`",
+    )
+    parser.add_argument(
+        "--index-dir", required=True, type=Path, help="Where the index lives",
+    )
+    parser.add_argument(
+        "--add",
+        type=Path,
+        default=None,
+        help="A text file whose lines to add to the index (creating it if needed)",
+    )
+    parser.add_argument(
+        "--query", type=str, action="append", default=[], help="Text to search for",
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--nprobe", type=int, default=16, help="Lists scanned for every query",
+    )
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=1024,
+        help="Lists of a new index (k-means centroids)",
+    )
+    parser.add_argument(
+        "--subquantizers",
+        type=int,
+        default=16,
+        help="Bytes per vector of a new index, dividing the hidden size",
+    )
+    parser.add_argument(
+        "--train-size",
+        type=int,
+        default=100000,
+        help="Vectors to train a new index's centroids and codebooks on",
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    return parser
+
+
+def embed(encoder: SlidingWindowEncoder, texts: List[str]) -> np.ndarray:
+    "Unit-length sentence embeddings of `texts`: mean last hidden states over their tokens"
+    outputs = encoder.encode(texts)
+    dim = encoder.model.config.hidden_size
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, output in enumerate(outputs):
+        if len(output):
+            vectors[i] = output.mean(0).numpy()
+    return normalized(vectors)
+
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    "`vectors` scaled to unit length"
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def _sq_distances(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    "Squared L2 distances between every row of `x` and every row of `y`"
+    d = (x ** 2).sum(1)[:, None] - 2 * x @ y.T + (y ** 2).sum(1)[None, :]
+    return np.maximum(d, 0)
+
+
+def nearest(x: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+    "The index of the nearest of `centroids` to every row of `x`"
+    if not len(x):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(
+        [
+            _sq_distances(x[i : i + chunk], centroids).argmin(1)
+            for i in range(0, len(x), chunk)
+        ]
+    )
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int = 20, seed: int = 42) -> np.ndarray:
+    "`k` centroids of the rows of `x` by Lloyd's algorithm, reseeding empty clusters"
+    rng = np.random.RandomState(seed)
+    x = x.astype(np.float32)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+    return centroids
+
+
+class IVFPQIndex:
+    """An inverted file index over product-quantized residuals.
+
+    Build one with `train`, then `add` vectors (with their ids, by default counting
+    from the number of vectors already in) any number of times, and `search` for the
+    `k` nearest of a batch of queries.
+    """
+
+    def __init__(self, centroids: np.ndarray, codebooks: np.ndarray):
+        self.centroids = centroids  # (nlist, dim)
+        self.codebooks = codebooks  # (m, ksub, dim / m)
+        self.segments = []
+        self.saved = 0
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def m(self) -> int:
+        return len(self.codebooks)
+
+    def __len__(self) -> int:
+        return sum(len(segment["ids"]) for segment in self.segments)
+
+    @classmethod
+    def train(
+        cls, vectors: np.ndarray, nlist: int, m: int, ksub: int = 256, seed: int = 42
+    ) -> "IVFPQIndex":
+        "An empty index with centroids and codebooks learnt from `vectors`"
+        n, dim = vectors.shape
+        if dim % m:
+            raise ValueError(f"{m} subquantizers don't divide {dim} dimensions")
+        if n < nlist:
+            raise ValueError(f"Training {nlist} lists needs at least as many vectors")
+        vectors = vectors.astype(np.float32)
+        centroids = kmeans(vectors, nlist, seed=seed)
+        residuals = vectors - centroids[nearest(vectors, centroids)]
+        sub = residuals.reshape(n, m, dim // m)
+        ksub = min(ksub, n, 256)
+        codebooks = np.stack(
+            [kmeans(sub[:, j], ksub, seed=seed + j) for j in range(m)]
+        )
+        return cls(centroids, codebooks)
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        "The list of every vector, and the codes of its residual"
+        lists = nearest(vectors, self.centroids)
+        residuals = vectors - self.centroids[lists]
+        sub = residuals.reshape(len(vectors), self.m, -1)
+        codes = np.stack(
+            [nearest(sub[:, j], self.codebooks[j]) for j in range(self.m)], axis=1
+        ).astype(np.uint8)
+        return lists, codes
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray = None) -> np.ndarray:
+        "Add `vectors` in a new segment, returning their ids"
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        ids = np.asarray(ids, dtype=np.int64)
+        lists, codes = self.encode(vectors.astype(np.float32))
+        order = np.argsort(lists, kind="stable")
+        offsets = np.searchsorted(lists[order], np.arange(self.nlist + 1))
+        self.segments.append(
+            dict(codes=codes[order], ids=ids[order], offsets=offsets.astype(np.int64))
+        )
+        return ids
+
+    def _tables(self, queries: np.ndarray, probes: np.ndarray) -> np.ndarray:
+        "Squared distances from each query's residual to each probed list to every codeword"
+        residuals = queries[:, None, :] - self.centroids[probes]  # (nq, nprobe, dim)
+        sub = residuals.reshape(*probes.shape, self.m, -1)
+        dots = np.einsum("qpmd,mkd->qpmk", sub, self.codebooks)
+        return (
+            (sub ** 2).sum(-1)[..., None]
+            - 2 * dots
+            + (self.codebooks ** 2).sum(-1)[None, None]
+        )
+
+    def search(
+        self, queries: np.ndarray, k: int = 10, nprobe: int = 16, batch_size: int = 64
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The ids and approximate squared distances of the `k` nearest of every query.
+
+        Missing neighbours (with fewer than `k` vectors in the probed lists) have the
+        id -1 and an infinite distance.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe, self.nlist)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        subspaces = np.arange(self.m)
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start : start + batch_size]
+            coarse = _sq_distances(batch, self.centroids)
+            probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+            tables = self._tables(batch, probes)
+            for q in range(len(batch)):
+                candidates, scores = [], []
+                for p, l in enumerate(probes[q]):
+                    for segment in self.segments:
+                        a, b = segment["offsets"][l], segment["offsets"][l + 1]
+                        if a == b:
+                            continue
+                        codes = np.asarray(segment["codes"][a:b])
+                        scores.append(tables[q, p][subspaces, codes].sum(1))
+                        candidates.append(segment["ids"][a:b])
+                if not candidates:
+                    continue
+                scores, candidates = np.concatenate(scores), np.concatenate(candidates)
+                top = np.arange(len(scores))
+                if len(scores) > k:
+                    top = np.argpartition(scores, k - 1)[:k]
+                top = top[np.argsort(scores[top])]
+                ids[start + q, : len(top)] = candidates[top]
+                distances[start + q, : len(top)] = scores[top]
+        return ids, distances
+
+    def save(self, directory: Path):
+        "Write the index into `directory`, adding only the segments added since the last save"
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        if not self.saved:  # also over those of a first add that was interrupted
+            np.save(directory / "centroids.npy", self.centroids)
+            np.save(directory / "codebooks.npy", self.codebooks)
+        for i in range(self.saved, len(self.segments)):
+            for name, array in self.segments[i].items():
+                np.save(directory / f"segment-{i:05d}.{name}.npy", array)
+        self.saved = len(self.segments)
+        meta = dict(segments=self.saved, count=len(self), nlist=self.nlist, m=self.m)
+        # Written last and atomically: segments it doesn't list yet are never loaded
+        tmp = directory / f"index.json.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, directory / "index.json")
+
+    @classmethod
+    def load(cls, directory: Path) -> "IVFPQIndex":
+        "The index saved in `directory`, with its codes and ids memory-mapped"
+        directory = Path(directory)
+        meta = json.loads((directory / "index.json").read_text())
+        index = cls(
+            np.load(directory / "centroids.npy"), np.load(directory / "codebooks.npy")
+        )
+        for i in range(meta["segments"]):
+            index.segments.append(
+                {
+                    name: np.load(
+                        directory / f"segment-{i:05d}.{name}.npy",
+                        mmap_mode=None if name == "offsets" else "r",
+                    )
+                    for name in ["codes", "ids", "offsets"]
+                }
+            )
+        index.saved = meta["segments"]
+        return index
+
+
+def brute_force(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    "The exact `k` nearest rows of `vectors` to every query"
+    distances = _sq_distances(queries.astype(np.float32), vectors.astype(np.float32))
+    k = min(k, len(vectors))
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, 1).argsort(1)
+    return np.take_along_axis(top, order, 1)
+
+
+def recall_at_k(found: np.ndarray, expected: np.ndarray, k: int) -> float:
+    "Share of the true `k` nearest neighbours among the `k` found, over all queries"
+    hits = sum(
+        len(set(f[:k].tolist()) & set(e[:k].tolist())) for f, e in zip(found, expected)
+    )
+    return hits / (len(expected) * k)
+
+
+def _lines(path: Path) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def _keep_lines(path: Path, n: int):
+    "Truncate `path` to its first `n` lines, if it exists"
+    if not path.exists():
+        return
+    with open(path, "r+b") as f:
+        for _ in range(n):
+            f.readline()
+        f.truncate()
+
+
+def run(args, cfg):
+    index_dir = normalize_path(args.index_dir)
+    encoder = SlidingWindowEncoder.from_pretrained(
+        normalize_path(args.model_path), batch_size=args.batch_size
+    )
+    if torch.cuda.is_available():
+        encoder.model.cuda()
+    texts = index_dir / "texts.txt"
+
+    if args.add:
+        lines = _lines(normalize_path(args.add))
+        log.info(f"Embedding {len(lines)} lines of {args.add}")
+        vectors = np.concatenate(
+            [
+                embed(encoder, lines[i : i + 4096])
+                for i in range(0, len(lines), 4096)
+            ]
+        )
+        if (index_dir / "index.json").exists():
+            index = IVFPQIndex.load(index_dir)
+        else:
+            rng = np.random.RandomState(cfg.get("seed", 42))
+            sample = vectors[rng.permutation(len(vectors))[: args.train_size]]
+            nlist = min(args.nlist, len(sample))
+            log.info(f"Training {nlist} lists and {args.subquantizers} codebooks")
+            index = IVFPQIndex.train(sample, nlist, args.subquantizers)
+        # Ids are line numbers of texts.txt, so drop the lines of an interrupted add,
+        # appended before the index could be saved
+        _keep_lines(texts, len(index))
+        index.add(vectors)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        with open(texts, "a", encoding="utf-8") as f:
+            f.writelines(f"{line}\n" for line in lines)
+        index.save(index_dir)
+        log.info(f"The index in {index_dir} holds {len(index)} sentences")
+
+    if args.query:
+        index = IVFPQIndex.load(index_dir)
+        corpus = _lines(texts)
+        ids, distances = index.search(embed(encoder, args.query), args.k, args.nprobe)
+        for query, hits, dists in zip(args.query, ids, distances):
+            log.info(f"{query}:")
+            for i, d in zip(hits, dists):
+                if i >= 0:
+                    log.info(f"  {1 - d / 2:.3f} {corpus[i]}")
@@ -0,0 +1,245 @@
+"""Inference with exported calbert models.
+
+ALBERT shares its layers (with `num_hidden_groups: 1` every layer is the same one), so
+how many times the shared layer runs can be chosen at inference time. `EarlyExitAlbert`
+stops running it for each example as soon as its predictions are confident enough, or
+its representation stops changing, and can also run a fixed number of layers to meet a
+latency budget.
+
+`SlidingWindowEncoder` runs a model over documents longer than its
+`max_position_embeddings`, in overlapping windows batched across documents.
+"""
+
+__all__ = ["EarlyExitAlbert", "SlidingWindowEncoder"]
+
+import logging
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+from transformers import AlbertForMaskedLM, AlbertTokenizer
+
+log = logging.getLogger(__name__)
+
+
+class EarlyExitAlbert(nn.Module):
+    """Masked LM predictions of `model`, running its shared layer only as many times as needed.
+
+    An example exits once all its tokens of interest are predicted with a probability of
+    at least `confidence`, or once the shared layer changes its token representations by
+    less than `tolerance` (relative to their norm), whichever comes first, and after at
+    least `min_layers` layers. Without either criterion, or with a `depth`, every example
+    runs `depth` (or `max_layers`, by default the trained number of) layers.
+    """
+
+    def __init__(
+        self,
+        model: AlbertForMaskedLM,
+        confidence: float = None,
+        tolerance: float = None,
+        min_layers: int = 1,
+        max_layers: int = None,
+    ):
+        super().__init__()
+        self.model = model.eval()
+        self.confidence = confidence
+        self.tolerance = tolerance
+        self.min_layers = min_layers
+        self.max_layers = max_layers or model.config.num_hidden_layers
+
+    @classmethod
+    def from_pretrained(cls, path: Path, **kwargs) -> "EarlyExitAlbert":
+        "Load a model exported by `train --export-path` (or `distill --export-path`)"
+        return cls(AlbertForMaskedLM.from_pretrained(str(path)), **kwargs)
+
+    def layer(self, i: int) -> nn.Module:
+        "The layer group computing layer `i`, which is always the same one with a single group"
+        config = self.model.config
+        group = i * config.num_hidden_groups // config.num_hidden_layers
+        return self.model.albert.encoder.albert_layer_groups[
+            min(group, config.num_hidden_groups - 1)
+        ]
+
+    def _exits(self, before, after, positions, attention_mask) -> torch.Tensor:
+        "Which examples meet an exit criterion after a layer turned `before` into `after`"
+        done = torch.zeros(len(after), dtype=torch.bool, device=after.device)
+        if self.confidence is not None:
+            probabilities = self.model.predictions(after[positions]).softmax(-1)
+            confidence = torch.ones(positions.shape, device=after.device)
+            confidence[positions] = probabilities.max(-1)[0].to(confidence.dtype)
+            done |= confidence.min(1)[0] >= self.confidence
+        if self.tolerance is not None:
+            change = (after - before).norm(dim=-1) / before.norm(dim=-1).clamp_min(1e-6)
+            mask = attention_mask.to(change.dtype)
+            change = (change * mask).sum(1) / mask.sum(1).clamp_min(1)
+            done |= change < self.tolerance
+        return done
+
+    @torch.no_grad()
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        token_type_ids: torch.Tensor = None,
+        positions: torch.Tensor = None,
+        depth: int = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Prediction scores for every token, and how many layers each example ran.
+
+        `positions` flags the tokens whose predictions the confidence criterion looks at
+        (all attended tokens by default), and `depth` fixes the number of layers.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        if positions is None:
+            positions = attention_mask.bool()
+        albert = self.model.albert
+        hidden = albert.embeddings(input_ids, token_type_ids=token_type_ids)
+        hidden = albert.encoder.embedding_hidden_mapping_in(hidden)
+        extended_mask = attention_mask[:, None, None, :].to(hidden.dtype)
+        extended_mask = (1.0 - extended_mask) * -10000.0
+        head_mask = [None] * self.model.config.inner_group_num
+
+        adaptive = depth is None and (
+            self.confidence is not None or self.tolerance is not None
+        )
+        n_layers = depth or self.max_layers
+        depths = torch.full((len(input_ids),), n_layers, dtype=torch.long)
+        active = torch.arange(len(input_ids), device=input_ids.device)
+        for i in range(n_layers):
+            before = hidden[active]
+            after = self.layer(i)(before, extended_mask[active], head_mask)[0]
+            hidden[active] = after
+            if not adaptive or i + 1 < self.min_layers or i + 1 == n_layers:
+                continue
+            done = self._exits(before, after, positions[active], attention_mask[active])
+            if done.any():
+                # Exited examples keep their representation and skip the next layers
+                depths[active[done].cpu()] = i + 1
+                active = active[~done]
+                if len(active) == 0:
+                    break
+        return self.model.predictions(hidden), depths
+
+
+def spans(n_tokens: int, size: int, stride: int) -> List[Tuple[int, int]]:
+    "Start and end of windows of at most `size` tokens every `stride`, covering `n_tokens`"
+    start, result = 0, []
+    while True:
+        end = min(start + size, n_tokens)
+        result.append((start, end))
+        if end == n_tokens:
+            return result
+        start += stride
+
+
+def owners(n_tokens: int, windows: List[Tuple[int, int]]) -> torch.Tensor:
+    """For each token, the window where it has the most context on its scarcer side.
+
+    The document's own edges don't count as missing context.
+    """
+    positions = torch.arange(n_tokens)
+    best = torch.full((n_tokens,), -1, dtype=torch.long)
+    owner = torch.zeros(n_tokens, dtype=torch.long)
+    for k, (start, end) in enumerate(windows):
+        edge = torch.full_like(positions, n_tokens)
+        left = positions - start if start > 0 else edge
+        right = end - 1 - positions if end < n_tokens else edge
+        context = torch.min(left, right)
+        inside = (positions >= start) & (positions < end) & (context > best)
+        best[inside], owner[inside] = context[inside], k
+    return owner
+
+
+class SlidingWindowEncoder:
+    """Per-token outputs of `model` for documents of any length.
+
+    Each document is tokenized once and cut into windows of `max_length` tokens (with
+    `[CLS]` and `[SEP]`), each sharing `overlap` tokens with the next. The windows of
+    all the documents are batched together, `batch_size` at a time, and each token
+    takes its output from the window where it has the most context. Outputs are the
+    last hidden states, or the masked LM scores with `scores=True`.
+    """
+
+    def __init__(
+        self,
+        model: AlbertForMaskedLM,
+        tokenizer: AlbertTokenizer,
+        max_length: int = None,
+        overlap: int = 128,
+        batch_size: int = 32,
+        scores: bool = False,
+    ):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_length = max_length or model.config.max_position_embeddings
+        if not 0 <= overlap < self.max_length - 2:
+            raise ValueError(
+                f"The overlap must be below the {self.max_length - 2} tokens of a window"
+            )
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.scores = scores
+
+    @classmethod
+    def from_pretrained(cls, path: Path, **kwargs) -> "SlidingWindowEncoder":
+        "Load a model and its tokenizer exported by `train --export-path`"
+        return cls(
+            AlbertForMaskedLM.from_pretrained(str(path)),
+            AlbertTokenizer.from_pretrained(str(path)),
+            **kwargs,
+        )
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        "The token ids of each of `texts`, without special tokens or truncation"
+        tok = self.tokenizer
+        return [tok.convert_tokens_to_ids(tok.tokenize(text)) for text in texts]
+
+    def encode(self, texts: List[str]) -> List[torch.Tensor]:
+        "The per-token outputs of each of `texts`"
+        return self(self.tokenize(texts))
+
+    def _run(self, batch: List[List[int]]) -> torch.Tensor:
+        tok = self.tokenizer
+        device = next(self.model.parameters()).device
+        length = max(len(ids) for ids in batch) + 2
+        input_ids = torch.full((len(batch), length), tok.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, ids in enumerate(batch):
+            input_ids[i, : len(ids) + 2] = torch.tensor(
+                [tok.cls_token_id] + ids + [tok.sep_token_id]
+            )
+            attention_mask[i, : len(ids) + 2] = 1
+        hidden = self.model.albert(
+            input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            token_type_ids=torch.zeros_like(input_ids).to(device),
+        )[0]
+        return self.model.predictions(hidden) if self.scores else hidden
+
+    @torch.no_grad()
+    def __call__(self, documents: List[List[int]]) -> List[torch.Tensor]:
+        "The per-token outputs, on the CPU, of each of the tokenized `documents`"
+        size = self.max_length - 2
+        windows, document_owners = [], []
+        for d, ids in enumerate(documents):
+            document_windows = spans(len(ids), size, size - self.overlap)
+            document_owners.append(owners(len(ids), document_windows))
+            windows.extend((d, k, s, e) for k, (s, e) in enumerate(document_windows))
+        # Longest first, so that only the last batches hold short windows
+        windows.sort(key=lambda w: w[3] - w[2], reverse=True)
+
+        outputs = [None] * len(documents)
+        for i in range(0, len(windows), self.batch_size):
+            batch = windows[i : i + self.batch_size]
+            result = self._run([documents[d][s:e] for d, _, s, e in batch])
+            result = result.float().cpu()
+            for (d, k, s, e), out in zip(batch, result):
+                if outputs[d] is None:
+                    outputs[d] = torch.empty(len(documents[d]), out.shape[-1])
+                owned = document_owners[d][s:e] == k
+                outputs[d][s:e][owned] = out[1 : 1 + e - s][owned]
+        return outputs
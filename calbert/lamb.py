@@ -1,14 +1,30 @@
-"""Lamb optimizer. (from https://github.com/cybertronai/pytorch-lamb)"""
+"""Lamb optimizers: pytorch-lamb's (from https://github.com/cybertronai/pytorch-lamb),
+and fastai's with its state sharded across data-parallel ranks."""
 
 import collections
 import math
+from functools import partial
+from typing import TYPE_CHECKING
 
 import torch
-from tensorboardX import SummaryWriter
+import torch.distributed as dist
+from fastai.optimizer import Optimizer as FastaiOptimizer
+from fastai.optimizer import (
+    _update,
+    average_grad,
+    average_sqr_grad,
+    l2_reg,
+    lamb_step,
+    step_stat,
+    weight_decay,
+)
 from torch.optim import Optimizer
 
+if TYPE_CHECKING:
+    from tensorboardX import SummaryWriter
 
-def log_lamb_rs(optimizer: Optimizer, event_writer: SummaryWriter, token_count: int):
+
+def log_lamb_rs(optimizer: Optimizer, event_writer: "SummaryWriter", token_count: int):
     """Log a histogram of trust ratio scalars in across layers."""
     results = collections.defaultdict(list)
     for group in optimizer.param_groups:
@@ -124,3 +140,103 @@ class Lamb(Optimizer):
                 p.data.add_(-step_size * trust_ratio, adam_step)
 
         return loss
+
+
+
+def partition(sizes, n):
+    "Greedily split indices of `sizes` in `n` bins of balanced total size, biggest first"
+    bins, totals = [[] for _ in range(n)], [0] * n
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        smallest = totals.index(min(totals))
+        bins[smallest].append(i)
+        totals[smallest] += sizes[i]
+    return [sorted(b) for b in bins]
+
+
+class ShardedOptimizer(FastaiOptimizer):
+    r"""A fastai `Optimizer` with its state sharded across data-parallel ranks (as in ZeRO stage 1).
+
+    Each rank owns a balanced partition of whole parameters: it only runs `cbs` on
+    those, so it only keeps their state, and all ranks then all-gather the updated
+    parameters. Gradients must already be averaged across ranks, as
+    `DistributedDataParallel` does, so the result is the same as the unsharded
+    `Optimizer`'s while each rank holds about 1 / world size of the state.
+
+    Shards across `process_group` (default: the whole world; without a process group it
+    behaves like `Optimizer`). `state_dict` only holds the state of the parameters
+    owned by this rank, the others' being empty.
+    """
+
+    def __init__(self, params, cbs, process_group=None, **defaults):
+        super(ShardedOptimizer, self).__init__(params, cbs, **defaults)
+        self.process_group = process_group
+        distributed = dist.is_available() and dist.is_initialized()
+        self.world_size = dist.get_world_size(process_group) if distributed else 1
+        self.rank = dist.get_rank(process_group) if distributed else 0
+
+        self.params = [p for p, *_ in self.all_params()]
+        if len({p.dtype for p in self.params}) > 1:
+            raise ValueError("ShardedOptimizer needs all parameters to share one dtype")
+        shards = partition([p.numel() for p in self.params], self.world_size)
+        self.shards = [[self.params[i] for i in shard] for shard in shards]
+        self.owned = {id(p) for p in self.shards[self.rank]}
+        self.shard_size = max(sum(p.numel() for p in shard) for shard in self.shards)
+
+    def step(self):
+        "Update this rank's parameters and share the result"
+        for p, pg, state, hyper in self.all_params(with_grad=True):
+            if id(p) not in self.owned:
+                continue
+            for cb in self.cbs:
+                state = _update(state, cb(p, **{**state, **hyper}))
+            self.state[p] = state
+
+        if self.world_size > 1:
+            self._all_gather()
+
+    def _all_gather(self):
+        "Send the parameters this rank updated to every other rank, and receive theirs"
+        flat = self.params[0].data.new_zeros(self.shard_size)
+        offset = 0
+        for p in self.shards[self.rank]:
+            flat[offset : offset + p.numel()].copy_(p.data.view(-1))
+            offset += p.numel()
+        gathered = [torch.empty_like(flat) for _ in range(self.world_size)]
+        dist.all_gather(gathered, flat, group=self.process_group)
+        for rank, (shard, buffer) in enumerate(zip(self.shards, gathered)):
+            if rank == self.rank:
+                continue
+            offset = 0
+            for p in shard:
+                p.data.copy_(buffer[offset : offset + p.numel()].view_as(p))
+                offset += p.numel()
+
+
+def ShardedLamb(
+    params,
+    lr,
+    mom=0.9,
+    sqr_mom=0.99,
+    eps=1e-5,
+    wd=0.0,
+    decouple_wd=True,
+    process_group=None,
+):
+    "fastai's `Lamb`, the optimizer training uses, with its state sharded across ranks"
+    cbs = [weight_decay] if decouple_wd else [l2_reg]
+    cbs += [
+        partial(average_grad, dampening=True),
+        average_sqr_grad,
+        step_stat,
+        lamb_step,
+    ]
+    return ShardedOptimizer(
+        params,
+        cbs,
+        process_group=process_group,
+        lr=lr,
+        mom=mom,
+        sqr_mom=sqr_mom,
+        eps=eps,
+        wd=wd,
+    )
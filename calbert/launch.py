@@ -0,0 +1,140 @@
+"""Launch a calbert command as several data-parallel processes on this host.
+
+Every process gets the `RANK`, `WORLD_SIZE`, `LOCAL_RANK`, `MASTER_ADDR` and
+`MASTER_PORT` variables `torch.distributed` expects, its own share of the CPU
+threads (and cores, when pinning is possible) so ranks don't oversubscribe the
+host, and the command line that follows the launcher's own options:
+
+    python -m calbert launch --nproc-per-node 4 train --tokenizer-path ... model=tiny
+
+Run the same launch on every host, changing `--node-rank`, to span several hosts.
+"""
+
+import argparse
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Launch data-parallel processes of a calbert command"
+    )
+    parser.add_argument(
+        "--nproc-per-node", type=int, default=2, help="Processes to start on this host",
+    )
+    parser.add_argument(
+        "--nnodes", type=int, default=1, help="Number of hosts taking part",
+    )
+    parser.add_argument(
+        "--node-rank", type=int, default=0, help="Index of this host among them",
+    )
+    parser.add_argument(
+        "--master-addr",
+        type=str,
+        default="127.0.0.1",
+        help="Address of the host with node rank 0",
+    )
+    parser.add_argument("--master-port", type=int, default=29500)
+    parser.add_argument(
+        "--threads-per-proc",
+        type=int,
+        default=None,
+        help="CPU threads per process (defaults to an even split of the available cores)",
+    )
+    parser.add_argument(
+        "--no-pin",
+        action="store_true",
+        help="Don't pin each process to its own set of cores",
+    )
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER, help="The calbert command to launch",
+    )
+    return parser
+
+
+def _cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def spawn(
+    argv: List[str],
+    nproc_per_node: int,
+    nnodes: int = 1,
+    node_rank: int = 0,
+    master_addr: str = "127.0.0.1",
+    master_port: int = 29500,
+    threads_per_proc: Optional[int] = None,
+    pin: bool = True,
+) -> int:
+    """Run `argv` as `nproc_per_node` ranks of a process group and wait for them.
+
+    If any rank fails, the others are terminated and its exit code is returned.
+    """
+    cpus = _cpus()
+    threads = threads_per_proc or max(len(cpus) // nproc_per_node, 1)
+    pin = pin and hasattr(os, "sched_setaffinity") and threads * nproc_per_node <= len(cpus)
+
+    # Shared by the ranks of this launch, for them to tell its data producer's rings
+    # from the ones of an earlier run
+    run_id = str(random.getrandbits(63))
+    processes = []
+    for local_rank in range(nproc_per_node):
+        env = dict(
+            os.environ,
+            RANK=str(node_rank * nproc_per_node + local_rank),
+            WORLD_SIZE=str(nnodes * nproc_per_node),
+            LOCAL_RANK=str(local_rank),
+            LOCAL_WORLD_SIZE=str(nproc_per_node),
+            MASTER_ADDR=master_addr,
+            MASTER_PORT=str(master_port),
+            CALBERT_RUN_ID=run_id,
+            OMP_NUM_THREADS=str(threads),
+            MKL_NUM_THREADS=str(threads),
+        )
+        cores = cpus[local_rank * threads : (local_rank + 1) * threads]
+        preexec_fn = (lambda cores=cores: os.sched_setaffinity(0, cores)) if pin else None
+        processes.append(subprocess.Popen(argv, env=env, preexec_fn=preexec_fn))
+
+    try:
+        while True:
+            codes = [p.poll() for p in processes]
+            failed = [c for c in codes if c not in (None, 0)]
+            if failed:
+                log.error(f"A process exited with code {failed[0]}, stopping the rest")
+                return failed[0]
+            if all(c == 0 for c in codes):
+                return 0
+            time.sleep(0.2)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+
+
+def main(argv: List[str]) -> int:
+    logging.basicConfig(level=logging.INFO)
+    args = arguments().parse_args(argv)
+    if not args.command:
+        log.error("Must provide a command to launch")
+        return -1
+    return spawn(
+        [sys.executable, "-m", "calbert"] + args.command,
+        nproc_per_node=args.nproc_per_node,
+        nnodes=args.nnodes,
+        node_rank=args.node_rank,
+        master_addr=args.master_addr,
+        master_port=args.master_port,
+        threads_per_proc=args.threads_per_proc,
+        pin=not args.no_pin,
+    )
@@ -1,11 +1,103 @@
+import logging
+from functools import partial
+
 import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers import AlbertForMaskedLM
+from transformers.modeling_albert import AlbertAttention, AlbertLayerGroup
+
+log = logging.getLogger(__name__)
+
+# torch>=2.0 fuses attention into one kernel (flash or memory-efficient where possible)
+HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
+
+class CheckpointedAlbertLayerGroup(AlbertLayerGroup):
+    "An `AlbertLayerGroup` that recomputes its activations during backward instead of keeping them"
+
+    def forward(self, hidden_states, attention_mask=None, head_mask=None):
+        if not (
+            self.training
+            and torch.is_grad_enabled()
+            and not self.output_hidden_states
+            and not self.output_attentions
+        ):
+            return super().forward(hidden_states, attention_mask, head_mask)
+        # Non-reentrant so DDP sees the shared layer's parameters used once per forward
+        return checkpoint(
+            partial(super().forward, head_mask=head_mask),
+            hidden_states,
+            attention_mask,
+            use_reentrant=False,
+        )
+
+
+class FusedAlbertAttention(AlbertAttention):
+    """An `AlbertAttention` computing attention with `scaled_dot_product_attention`.
+
+    The additive padding mask is passed as the attention mask, so the attention
+    probabilities are never materialized. Falls back to the eager implementation
+    when they are asked for (`output_attentions`) or heads are masked.
+    """
+
+    def forward(self, input_ids, attention_mask=None, head_mask=None):
+        if not HAS_SDPA or self.output_attentions or head_mask is not None:
+            return super().forward(input_ids, attention_mask, head_mask)
+
+        query_layer = self.transpose_for_scores(self.query(input_ids))
+        key_layer = self.transpose_for_scores(self.key(input_ids))
+        value_layer = self.transpose_for_scores(self.value(input_ids))
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(query_layer.dtype)
+
+        context_layer = F.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+
+        w = (
+            self.dense.weight.t()
+            .view(self.num_attention_heads, self.attention_head_size, self.hidden_size)
+            .to(context_layer.dtype)
+        )
+        b = self.dense.bias.to(context_layer.dtype)
+        projected_context_layer = torch.einsum("bfnd,ndh->bfh", context_layer, w) + b
+        projected_context_layer_dropout = self.dropout(projected_context_layer)
+        layernormed_context_layer = self.LayerNorm(
+            input_ids + projected_context_layer_dropout
+        )
+        return (layernormed_context_layer,)
 
 
 class CalbertForMaskedLM(AlbertForMaskedLM):
     def __init__(self, config):
         super().__init__(config)
 
+    def checkpoint_activations(self):
+        """Checkpoint every application of the (shared) ALBERT layer groups.
+
+        With `num_hidden_groups: 1` the same group runs `num_hidden_layers` times, so
+        activations, not parameters, dominate memory: only each layer's input is kept
+        and the rest is recomputed in the backward pass.
+        """
+        for group in self.albert.encoder.albert_layer_groups:
+            group.__class__ = CheckpointedAlbertLayerGroup
+        return self
+
+    def use_fused_attention(self):
+        "Compute self-attention with torch's fused `scaled_dot_product_attention`"
+        if not HAS_SDPA:
+            log.warning("Fused attention needs torch>=2.0, using eager attention")
+        for group in self.albert.encoder.albert_layer_groups:
+            for layer in group.albert_layers:
+                layer.attention.__class__ = FusedAlbertAttention
+        return self
+
     def forward(self, input):
         input_ids, masked_lm_labels, attention_mask, token_type_ids = input.permute(
             1, 0, 2
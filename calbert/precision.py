@@ -0,0 +1,58 @@
+"Mixed precision training on CPUs and GPUs"
+
+__all__ = ["PRECISIONS", "AutocastCallback", "to_precision"]
+
+import logging
+
+import torch
+from fastai.basics import Callback, Learner
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+class AutocastCallback(Callback):
+    """A `Callback` running the forward pass and the loss under `torch.autocast` in `dtype`.
+
+    Weights, gradients and the optimizer stay in fp32. There is no loss scaling, so
+    this is meant for bf16, which has the range of fp32.
+    """
+
+    def __init__(self, dtype=torch.bfloat16):
+        self.dtype = dtype
+        self.context = None
+
+    def before_fit(self):
+        self.device_type = next(self.model.parameters()).device.type
+
+    def before_batch(self):
+        self.context = torch.autocast(self.device_type, dtype=self.dtype)
+        self.context.__enter__()
+
+    def after_loss(self):
+        self._exit()
+
+    def after_batch(self):
+        # Also leave autocast for batches cancelled before the loss
+        self._exit()
+
+    def _exit(self):
+        if self.context is not None:
+            self.context.__exit__(None, None, None)
+            self.context = None
+
+
+def to_precision(learn: Learner, precision: str) -> Learner:
+    "Train `learn` in `precision`: fp32, bf16 autocast (on CPU or GPU), or fastai's mixed fp16"
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Invalid precision {precision}: must be one of {', '.join(PRECISIONS)}"
+        )
+    if precision == "fp16":
+        if not torch.cuda.is_available():
+            log.warning("fp16 training is meant for GPUs, bf16 is usually faster on CPU")
+        return learn.to_fp16()
+    if precision == "bf16":
+        learn.add_cb(AutocastCallback(torch.bfloat16))
+    return learn
@@ -0,0 +1,397 @@
+"""A node-local producer tokenizing and masking the training set once for all the ranks on a host.
+
+The producer process reads the corpus, shards it across hosts and local ranks, and
+publishes ready batches into one shared-memory ring per local rank. Each rank reads
+its ring through a `SharedBatchDL` instead of running its own loader workers. When a
+ring is full the producer waits for its rank to catch up.
+
+Rings are files in `/dev/shm` mapped by both sides (which also works on Python 3.7,
+unlike `multiprocessing.shared_memory`). Each ring is written by exactly one process
+and read by exactly one other, so two counters are enough to coordinate them. Its
+header carries the nonce of the run it belongs to, so that ranks never attach to a
+ring a crashed run left behind before their producer replaces it.
+"""
+
+__all__ = ["Ring", "ring_path", "run_nonce", "start_producer", "SharedBatchDL"]
+
+import atexit
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from calbert.dataset import Mask, Tokenize
+
+log = logging.getLogger(__name__)
+
+MAGIC = 0xCA1BE127
+HEADER_SIZE = 128
+# Offsets of the 8-byte header fields
+FIELDS = dict(
+    magic=0,
+    n_slots=8,
+    slot_bytes=16,
+    head=24,
+    tail=32,
+    closed=40,
+    batches_per_epoch=48,
+    itemsize=56,
+    seq_len=64,
+    nonce=72,
+)
+SLOT_HEADER = 8  # rows in the batch, 0 marking the end of an epoch
+
+
+def ring_path(name: str, local_rank: int, directory: Path = None) -> Path:
+    "Where the ring of `local_rank` of job `name` lives"
+    if directory is None:
+        directory = Path("/dev/shm") if Path("/dev/shm").is_dir() else Path(tempfile.gettempdir())
+    return Path(directory) / f"{name}-rank{local_rank}.ring"
+
+
+def run_nonce() -> int:
+    "An id the ranks of a run on this host share: their launcher's, or its pid"
+    return int(os.environ.get("CALBERT_RUN_ID", os.getppid()))
+
+
+def _wait(condition, timeout: float, what: str):
+    "Poll `condition` with a growing backoff until it holds or `timeout` seconds pass"
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 1e-4
+    while not condition():
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for {what}")
+        time.sleep(delay)
+        delay = min(delay * 2, 1e-2)
+
+
+class Ring:
+    "A single-producer single-consumer ring of fixed-size batch slots in a memory-mapped file"
+
+    def __init__(self, path: Path, mm: mmap.mmap):
+        self.path = Path(path)
+        self.mm = mm
+        self.n_slots = self._get("n_slots")
+        self.slot_bytes = self._get("slot_bytes")
+        self.dtype = {2: np.int16, 4: np.int32}[self._get("itemsize")]
+        self.seq_len = self._get("seq_len")
+
+    @classmethod
+    def create(
+        cls, path: Path, n_slots: int, max_rows: int, seq_len: int, dtype, nonce: int = 0
+    ) -> "Ring":
+        "Create the ring file of run `nonce`, atomically, so consumers never see it half initialized"
+        itemsize = np.dtype(dtype).itemsize
+        slot_bytes = SLOT_HEADER + max_rows * 4 * seq_len * itemsize
+        slot_bytes += -slot_bytes % 64  # keep slots cache-line aligned
+        size = HEADER_SIZE + n_slots * slot_bytes
+        tmp = Path(f"{path}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.truncate(size)
+        with open(tmp, "r+b") as f:
+            mm = mmap.mmap(f.fileno(), size)
+        for field, value in dict(
+            magic=MAGIC,
+            n_slots=n_slots,
+            slot_bytes=slot_bytes,
+            itemsize=itemsize,
+            seq_len=seq_len,
+            nonce=nonce,
+        ).items():
+            struct.pack_into("<Q", mm, FIELDS[field], value)
+        os.replace(tmp, path)
+        return cls(path, mm)
+
+    @classmethod
+    def attach(cls, path: Path, timeout: float = 600, nonce: int = None) -> "Ring":
+        "Map the ring at `path` (of run `nonce`, if given), waiting for its producer to create it"
+        mapped = []
+
+        def created():
+            try:
+                with open(path, "r+b") as f:
+                    mm = mmap.mmap(f.fileno(), 0)
+            except FileNotFoundError:
+                return False
+            if struct.unpack_from("<Q", mm, FIELDS["magic"])[0] != MAGIC:
+                raise ValueError(f"{path} is not a calbert batch ring")
+            stale = struct.unpack_from("<Q", mm, FIELDS["nonce"])[0] != nonce
+            if nonce is not None and stale:
+                # Left behind by another run, until our producer replaces it
+                mm.close()
+                return False
+            mapped.append(mm)
+            return True
+
+        _wait(created, timeout, f"the data producer to create {path}")
+        return cls(path, mapped[0])
+
+    def _get(self, field: str) -> int:
+        return struct.unpack_from("<Q", self.mm, FIELDS[field])[0]
+
+    def _set(self, field: str, value: int):
+        struct.pack_into("<Q", self.mm, FIELDS[field], value)
+
+    def _slot(self, counter: int) -> int:
+        return HEADER_SIZE + (counter % self.n_slots) * self.slot_bytes
+
+    @property
+    def closed(self) -> bool:
+        return bool(self._get("closed"))
+
+    def close(self):
+        "Tell the other side that this ring won't be used anymore"
+        self._set("closed", 1)
+
+    @property
+    def batches_per_epoch(self) -> int:
+        return self._get("batches_per_epoch")
+
+    def put(self, batch: np.ndarray = None, timeout: float = None):
+        "Publish `batch` (or the end of an epoch if `None`), waiting for a free slot"
+        head = self._get("head")
+        _wait(
+            lambda: head - self._get("tail") < self.n_slots or self.closed,
+            timeout,
+            f"a free slot in {self.path}",
+        )
+        if self.closed:
+            return
+        offset = self._slot(head)
+        rows = 0 if batch is None else len(batch)
+        if batch is not None:
+            data = np.ascontiguousarray(batch, dtype=self.dtype).tobytes()
+            self.mm[offset + SLOT_HEADER : offset + SLOT_HEADER + len(data)] = data
+        struct.pack_into("<Q", self.mm, offset, rows)
+        # Only publish the slot once it is completely written
+        self._set("head", head + 1)
+
+    def get(self, timeout: float = None):
+        "The next batch, or `None` at the end of an epoch, waiting for one to be published"
+        tail = self._get("tail")
+        _wait(
+            lambda: self._get("head") > tail or self.closed,
+            timeout,
+            f"a batch in {self.path}",
+        )
+        if self._get("head") <= tail:
+            raise EOFError(f"{self.path} was closed by the data producer")
+        offset = self._slot(tail)
+        rows = struct.unpack_from("<Q", self.mm, offset)[0]
+        batch = None
+        if rows:
+            batch = np.frombuffer(
+                self.mm,
+                dtype=self.dtype,
+                count=rows * 4 * self.seq_len,
+                offset=offset + SLOT_HEADER,
+            ).reshape(rows, 4, self.seq_len).copy()
+        self._set("tail", tail + 1)
+        return batch
+
+
+# Set in the producer before forking its workers, so they share them without pickling
+_items, _tokenize, _mask, _dtype = None, None, None, None
+
+
+def _encode(task) -> np.ndarray:
+    epoch, index, rows = task
+    # Masks differ across batches and epochs, whichever worker draws them
+    torch.manual_seed(epoch * 1_000_003 + index)
+    return np.stack([_mask(_tokenize(_items[i])).numpy().astype(_dtype) for i in rows])
+
+
+def _publish(ring: Ring, batch, parent: int):
+    "Put `batch` in `ring` unless its rank closed it or our parent exited"
+    while not ring.closed and os.getppid() == parent:
+        try:
+            return ring.put(batch, timeout=1)
+        except TimeoutError:
+            continue
+
+
+def _produce(
+    dataset,
+    tokenizer,
+    name: str,
+    directory: Path,
+    max_seq_len: int,
+    probability: float,
+    batch_size: int,
+    local_world: int,
+    node_rank: int,
+    nnodes: int,
+    slots: int,
+    workers: int,
+    parent: int,
+    nonce: int,
+):
+    global _items, _tokenize, _mask, _dtype
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    items = list(dataset)
+    world_size = local_world * nnodes
+    # Every rank of every host gets the same number of batches, or DDP would hang
+    per_rank = len(items) // (batch_size * world_size)
+    if per_rank == 0:
+        raise ValueError(
+            f"{len(items)} items are not enough for a batch of {batch_size} per rank"
+        )
+    _items = items[node_rank::nnodes][: per_rank * batch_size * local_world]
+    _tokenize = Tokenize(tokenizer, max_seq_len=max_seq_len)
+    _mask = Mask(tok=tokenizer, probability=probability)
+    _dtype = np.int16 if len(tokenizer) <= np.iinfo(np.int16).max else np.int32
+
+    rings = [
+        Ring.create(
+            ring_path(name, local_rank, directory),
+            slots,
+            batch_size,
+            max_seq_len,
+            _dtype,
+            nonce=nonce,
+        )
+        for local_rank in range(local_world)
+    ]
+    for ring in rings:
+        ring._set("batches_per_epoch", per_rank)
+
+    batches = [
+        list(range(start, start + batch_size))
+        for start in range(0, len(_items), batch_size)
+    ]
+    pool = multiprocessing.Pool(workers) if workers else None
+    try:
+        epoch = 0
+        while True:
+            tasks = [(epoch, i, rows) for i, rows in enumerate(batches)]
+            encoded = pool.imap(_encode, tasks) if pool else map(_encode, tasks)
+            for i, batch in enumerate(encoded):
+                _publish(rings[i % local_world], batch, parent)
+                if all(r.closed for r in rings) or os.getppid() != parent:
+                    return
+            for ring in rings:
+                _publish(ring, None, parent)
+            epoch += 1
+    finally:
+        if pool:
+            pool.terminate()
+        # Ranks keep their mappings, the memory goes away with the last one
+        for ring in rings:
+            if ring.path.exists():
+                ring.path.unlink()
+
+
+def start_producer(
+    dataset,
+    tokenizer,
+    name: str,
+    max_seq_len: int,
+    probability: float,
+    batch_size: int,
+    local_world: int = 1,
+    node_rank: int = 0,
+    nnodes: int = 1,
+    slots: int = 8,
+    workers: int = 0,
+    directory: Path = None,
+    nonce: int = 0,
+) -> multiprocessing.Process:
+    """Start the producer of job `name` for the `local_world` ranks of this host.
+
+    It batches `dataset` in `batch_size` items of `max_seq_len` tokens masked with
+    `probability`, each ring holding up to `slots` batches, with `workers` processes
+    tokenizing and masking. It stops when its parent exits or every ring is closed.
+    The rings are marked with the run's `nonce`, for its ranks to attach to.
+    """
+    for local_rank in range(local_world):
+        stale = ring_path(name, local_rank, directory)
+        if stale.exists():
+            stale.unlink()
+    process = multiprocessing.Process(
+        target=_produce,
+        args=(
+            dataset,
+            tokenizer,
+            name,
+            directory,
+            max_seq_len,
+            probability,
+            batch_size,
+            local_world,
+            node_rank,
+            nnodes,
+            slots,
+            workers,
+            os.getpid(),
+            nonce,
+        ),
+        name=f"{name}-producer",
+    )
+    process.start()
+    # Not daemonic, as it may have a pool of workers, so stop it ourselves on exit
+    atexit.register(_stop, process)
+    return process
+
+
+def _stop(process: multiprocessing.Process):
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+
+class SharedBatchDL:
+    """Training batches of this rank, read from its ring in the node's producer.
+
+    Quacks like the fastai loaders the `Learner` needs. Its batches are already
+    sharded, so the `DDPTrainer` leaves it alone.
+    """
+
+    sharded = True
+    n_inp = 1
+    dataset = None
+
+    def __init__(self, path: Path, device=None, timeout: float = 600, nonce: int = None):
+        self.ring = Ring.attach(path, timeout=timeout, nonce=nonce)
+        self.device = device
+        self.timeout = timeout
+        self.in_epoch = False
+        _wait(
+            lambda: self.ring.batches_per_epoch > 0,
+            timeout,
+            "the data producer to load the corpus",
+        )
+
+    def __len__(self):
+        return self.ring.batches_per_epoch
+
+    def to(self, device):
+        self.device = device
+        return self
+
+    def __iter__(self):
+        if self.in_epoch:
+            # The last epoch was cut short: skip its remaining batches
+            while self.ring.get(self.timeout) is not None:
+                pass
+        self.in_epoch = True
+        while True:
+            batch = self.ring.get(self.timeout)
+            if batch is None:
+                break
+            x = torch.from_numpy(batch).long()
+            if self.device is not None:
+                x = x.to(self.device, non_blocking=True)
+            yield x, torch.zeros(len(x), dtype=torch.long, device=x.device)
+        self.in_epoch = False
+
+    def close(self):
+        self.ring.close()
@@ -0,0 +1,209 @@
+"Step-level profiling and throughput instrumentation for the training loop"
+
+__all__ = ["ProfilingCallback"]
+
+import json
+import logging
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import torch
+from fastai.basics import Callback, Recorder, to_device
+from fastai.distributed import rank_distrib
+
+from calbert.distributed import DDPTrainer
+from calbert.utils import rss
+
+log = logging.getLogger(__name__)
+
+PHASES = ["data", "h2d", "forward", "loss", "backward", "allreduce", "optimizer"]
+
+
+def _on_cuda(device) -> bool:
+    return device is not None and torch.device(device).type == "cuda"
+
+
+def _sync(device):
+    if _on_cuda(device):
+        torch.cuda.synchronize(device)
+
+
+def _reset_peak_memory(device):
+    if _on_cuda(device):
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+class ProfilingCallback(Callback):
+    """A `Callback` that times every phase of a training step and captures profiler traces.
+
+    Each step records the data-wait, host-to-device copy, forward, loss, backward,
+    all-reduce and optimizer time, plus tokens/sec, padding fraction and peak memory:
+    the most allocated on the GPU, or on CPU the largest RSS sampled between phases.
+    Records (and periodic summaries) are appended to `out_dir/rank{N}.jsonl`.
+    CUDA is synchronized between phases, which costs a little overlap but makes the
+    numbers honest.
+    """
+
+    order = Recorder.order + 1
+
+    def __init__(
+        self, out_dir: Path, log_every: int = 100, trace_start: int = 10, trace_steps: int = 0
+    ):
+        self.out_dir = Path(out_dir)
+        self.log_every = log_every
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+
+    def before_fit(self):
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.rank = rank_distrib()
+        self.records = open(self.out_dir / f"rank{self.rank}.jsonl", "a")
+        self.window = defaultdict(list)
+        self.step = 0
+        self.trace = None
+
+        # Take over the host-to-device copy from the loaders so it can be timed
+        self.target_device = self.dls.device
+        self.learn.dls.device = None
+        # All-reduce bytes and time come from the communication hooks, if distributed
+        trainer = next((cb for cb in self.learn.cbs if isinstance(cb, DDPTrainer)), None)
+        self.comm = trainer.stats if trainer is not None else None
+        self._start_trace()
+
+    def before_train(self):
+        self.mark = time.perf_counter()
+
+    def before_batch(self):
+        start = time.perf_counter()
+        self.learn.xb = to_device(self.xb, self.target_device)
+        self.learn.yb = to_device(self.yb, self.target_device)
+        if not self.training:
+            return
+        _sync(self.target_device)
+        _reset_peak_memory(self.target_device)
+        self.peak_rss = 0
+        self._sample_memory()
+        self.times = {"data": start - self.mark}
+        self.last = time.perf_counter()
+        self.times["h2d"] = self.last - start
+
+    def _lap(self, phase):
+        if self.training:
+            _sync(self.target_device)
+            now = time.perf_counter()
+            self.times[phase] = now - self.last
+            self.last = now
+            self._sample_memory()
+
+    def _sample_memory(self):
+        if not _on_cuda(self.target_device):
+            self.peak_rss = max(self.peak_rss, rss())
+
+    def _peak_memory(self) -> int:
+        "Peak bytes allocated on the GPU during the step, or the largest RSS sampled on CPU"
+        if _on_cuda(self.target_device):
+            return torch.cuda.max_memory_allocated(self.target_device)
+        self._sample_memory()
+        return self.peak_rss
+
+    def after_pred(self):
+        self._lap("forward")
+
+    def after_loss(self):
+        self._lap("loss")
+
+    def after_backward(self):
+        self._lap("backward")
+
+    def after_step(self):
+        self._lap("optimizer")
+
+    def after_batch(self):
+        if not self.training or not hasattr(self, "times"):
+            return
+        now = time.perf_counter()
+        batch = self.xb[0]
+        attention_mask = batch[:, 2]
+        real_tokens = attention_mask.sum().item()
+        total_tokens = attention_mask.numel()
+        step_time = now - self.mark
+
+        record = {
+            **{k: self.times.get(k, 0.0) for k in PHASES},
+            "allreduce": self.comm.seconds if self.comm is not None else 0.0,
+            "allreduce_bytes": self.comm.bytes if self.comm is not None else 0,
+            "step": step_time,
+            "tokens_per_sec": real_tokens / step_time,
+            "padding": 1 - real_tokens / total_tokens,
+            "peak_memory": self._peak_memory(),
+        }
+        self._write({"type": "step", "iter": self.step, **record})
+        for k, v in record.items():
+            self.window[k].append(v)
+
+        self.step += 1
+        if self.step % self.log_every == 0:
+            self._summarize()
+        self._advance_trace()
+        del self.times
+        self.mark = time.perf_counter()
+
+    def after_fit(self):
+        if self.window:
+            self._summarize()
+        self._stop_trace()
+        self.records.close()
+        self.learn.dls.device = self.target_device
+
+    def _summarize(self):
+        summary = {k: sum(v) / len(v) for k, v in self.window.items()}
+        data_share = summary["data"] / summary["step"]
+        summary["data_share"] = data_share
+        summary["bound"] = "input" if data_share > 0.2 else "compute"
+        self._write({"type": "summary", "iter": self.step, **summary})
+        phases = ", ".join(f"{k} {summary[k] * 1000:.1f}ms" for k in PHASES)
+        log.info(
+            f"[profile rank {self.rank} step {self.step}] {phases} | "
+            f"{summary['tokens_per_sec']:.0f} tokens/s, "
+            f"{summary['padding'] * 100:.1f}% padding, "
+            f"{summary['allreduce_bytes'] / 2 ** 20:.1f}MiB all-reduced, "
+            f"peak memory {summary['peak_memory'] / 2 ** 20:.0f}MiB, "
+            f"{data_share * 100:.1f}% waiting for data ({summary['bound']}-bound)"
+        )
+        self.window = defaultdict(list)
+
+    def _write(self, record):
+        self.records.write(json.dumps(record) + "\n")
+        self.records.flush()
+
+    def _start_trace(self):
+        if not self.trace_steps:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if _on_cuda(self.target_device):
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=max(self.trace_start - 1, 0),
+                warmup=min(self.trace_start, 1),
+                active=self.trace_steps,
+                repeat=1,
+            ),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                str(self.out_dir), worker_name=f"rank{self.rank}"
+            ),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.trace.__enter__()
+
+    def _advance_trace(self):
+        if self.trace is not None:
+            self.trace.step()
+
+    def _stop_trace(self):
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
@@ -0,0 +1,257 @@
+"""Structured pruning of the attention heads and feed-forward width of an exported model.
+
+With `num_hidden_groups: 1` every layer is the same ALBERT layer, so removing one of its
+heads or feed-forward neurons removes it at every depth. Each unit is scored by the
+first-order Taylor estimate of how much the masked LM loss changes without it,
+`|sum(weight * gradient)|` over its parameters, accumulated over a calibration slice of
+`valid.txt`. The lowest scoring ones are removed from the weights, and the exported
+`AlbertConfig` records the smaller `intermediate_size` and the `pruned_heads`.
+"""
+
+import argparse
+import logging
+import math
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+from fastai.basics import default_device
+from transformers import AlbertForMaskedLM
+from transformers.modeling_utils import prune_linear_layer
+
+from calbert.dataset import IGNORE_INDEX
+from calbert.distill import latency
+from calbert.model import CalbertForMaskedLM
+from calbert.tokenizer import load as load_tokenizer
+from calbert.utils import normalize_path
+from calbert.validation import cached_eval_set
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Remove the least important attention heads and FFN neurons of a model"
+    )
+    parser.add_argument(
+        "--model-path",
+        required=True,
+        type=Path,
+        help="The directory of the model, as exported by `train --export-path`",
+    )
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        required=True,
+        help="The path to the sentencepiece *model* the model was trained with",
+    )
+    parser.add_argument(
+        "--valid-path", required=True, type=Path, help="Where the valid.txt file lives",
+    )
+    parser.add_argument(
+        "--export-path",
+        required=True,
+        type=Path,
+        help="Where to export the pruned model in HuggingFace format",
+    )
+    parser.add_argument(
+        "--keep-heads",
+        type=float,
+        default=0.5,
+        help="Share of the attention heads of each layer to keep",
+    )
+    parser.add_argument(
+        "--keep-ffn",
+        type=float,
+        default=0.5,
+        help="Share of the feed-forward neurons of each layer to keep",
+    )
+    parser.add_argument(
+        "--calibration-items",
+        type=int,
+        default=512,
+        help="Sentence pairs of valid.txt to score heads and neurons on",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--repeat", default=10, type=int, help="Timed forward passes for the speed-up",
+    )
+    return parser
+
+
+def load(path: Path) -> CalbertForMaskedLM:
+    "The exported model at `path`, taking calbert's batches"
+    model = AlbertForMaskedLM.from_pretrained(str(path))
+    model.__class__ = CalbertForMaskedLM
+    return model
+
+
+def albert_layers(model: CalbertForMaskedLM) -> Dict[int, nn.Module]:
+    "The distinct ALBERT layers of `model`, by the index `prune_heads` knows them by"
+    inner_group_num = model.config.inner_group_num
+    return {
+        g * inner_group_num + i: layer
+        for g, group in enumerate(model.albert.encoder.albert_layer_groups)
+        for i, layer in enumerate(group.albert_layers)
+    }
+
+
+def _taylor(linear: nn.Linear) -> Tuple[torch.Tensor, torch.Tensor]:
+    return linear.weight * linear.weight.grad, linear.bias * linear.bias.grad
+
+
+def head_scores(attention: nn.Module) -> torch.Tensor:
+    "The Taylor score of each of the heads of `attention`, from its current gradients"
+    heads, size = attention.num_attention_heads, attention.attention_head_size
+    scores = torch.zeros(heads, device=attention.dense.weight.device)
+    for linear in [attention.query, attention.key, attention.value]:
+        weight, bias = _taylor(linear)
+        scores += weight.view(heads, size, -1).sum((1, 2))
+        scores += bias.view(heads, size).sum(1)
+    weight, _ = _taylor(attention.dense)
+    return scores + weight.view(-1, heads, size).sum((0, 2))
+
+
+def neuron_scores(layer: nn.Module) -> torch.Tensor:
+    "The Taylor score of each feed-forward neuron of `layer`, from its current gradients"
+    weight, bias = _taylor(layer.ffn)
+    output, _ = _taylor(layer.ffn_output)
+    return weight.sum(1) + bias + output.sum(0)
+
+
+def importance(
+    model: CalbertForMaskedLM, examples: torch.Tensor, batch_size: int
+) -> Tuple[Dict[int, torch.Tensor], Dict[int, torch.Tensor]]:
+    "Head and neuron scores of every ALBERT layer of `model`, accumulated over `examples`"
+    model.eval()
+    device = next(model.parameters()).device
+    layers = albert_layers(model)
+    heads = {i: 0.0 for i in layers}
+    neurons = {i: 0.0 for i in layers}
+    for start in range(0, len(examples), batch_size):
+        x = examples[start : start + batch_size].long().to(device)
+        if not (x[:, 1] != IGNORE_INDEX).any():
+            continue
+        model.zero_grad()
+        model(x)[0].backward()
+        with torch.no_grad():
+            for i, layer in layers.items():
+                heads[i] = heads[i] + head_scores(layer.attention).abs()
+                neurons[i] = neurons[i] + neuron_scores(layer).abs()
+    model.zero_grad()
+    return heads, neurons
+
+
+def lowest(scores: torch.Tensor, keep: float) -> List[int]:
+    "The indices of the lowest `scores`, keeping (at least one of) a `keep` share of them"
+    n_keep = max(1, int(round(len(scores) * keep)))
+    return sorted(scores.argsort()[: len(scores) - n_keep].tolist())
+
+
+def prune_ffn(layer: nn.Module, neurons: List[int]):
+    "Remove `neurons` from the feed-forward block of `layer`"
+    dropped = set(neurons)
+    kept = [i for i in range(layer.ffn.out_features) if i not in dropped]
+    index = torch.tensor(kept, dtype=torch.long, device=layer.ffn.weight.device)
+    layer.ffn = prune_linear_layer(layer.ffn, index, dim=0)
+    layer.ffn_output = prune_linear_layer(layer.ffn_output, index, dim=1)
+
+
+def prune(
+    model: CalbertForMaskedLM,
+    heads: Dict[int, torch.Tensor],
+    neurons: Dict[int, torch.Tensor],
+    keep_heads: float,
+    keep_ffn: float,
+) -> CalbertForMaskedLM:
+    "Remove the lowest scoring heads and neurons of every ALBERT layer of `model`, in place"
+    all_heads = range(model.config.num_attention_heads)
+    to_prune = {}
+    for i, layer in albert_layers(model).items():
+        # `prune_heads` takes the heads' original indices, so map the remaining ones back
+        remaining = [h for h in all_heads if h not in layer.attention.pruned_heads]
+        pruned = [remaining[h] for h in lowest(heads[i], keep_heads)]
+        if pruned:
+            to_prune[i] = pruned
+        prune_ffn(layer, lowest(neurons[i], keep_ffn))
+    model.prune_heads(to_prune)
+    model.config.intermediate_size = layer.ffn.out_features
+    return model
+
+
+def perplexity(
+    model: CalbertForMaskedLM, examples: torch.Tensor, batch_size: int
+) -> float:
+    "Perplexity of `model` on the masked tokens of `examples`"
+    model.eval()
+    device = next(model.parameters()).device
+    loss, count = 0.0, 0
+    with torch.no_grad():
+        for start in range(0, len(examples), batch_size):
+            x = examples[start : start + batch_size].long().to(device)
+            masked = (x[:, 1] != IGNORE_INDEX).sum().item()
+            if masked:
+                loss += model(x)[0].item() * masked
+                count += masked
+    return math.exp(loss / max(count, 1))
+
+
+def _parameters(model: CalbertForMaskedLM) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
+def run(args, cfg) -> dict:
+    from calbert.training import export
+
+    if not (0 < args.keep_heads <= 1 and 0 < args.keep_ffn <= 1):
+        raise ValueError("--keep-heads and --keep-ffn are shares between 0 and 1")
+    tokenizer = load_tokenizer(cfg, normalize_path(args.tokenizer_path))
+    model = load(normalize_path(args.model_path)).to(default_device())
+    validation = cfg.get("validation", {})
+    examples = cached_eval_set(
+        normalize_path(args.valid_path),
+        tokenizer,
+        cache_dir=normalize_path(Path(validation.get("cache_dir", "cache"))),
+        max_seq_len=cfg.training.max_seq_length,
+        probability=cfg.training.masked_lm_prob,
+        max_items=validation.get("max_items", None),
+        seed=cfg.seed,
+    )
+    # Score on the first pairs and report on the rest, which pruning never looked at
+    calibration, held_out = (
+        examples[: args.calibration_items],
+        examples[args.calibration_items :],
+    )
+    if not len(held_out):
+        raise ValueError(
+            f"valid.txt has only {len(examples)} pairs: lower --calibration-items "
+            "to keep some to evaluate the pruned model on"
+        )
+    batch = held_out[: args.batch_size].long()
+
+    report = dict(
+        parameters=_parameters(model),
+        perplexity=perplexity(model, held_out, args.batch_size),
+        ms=latency(model, batch, args.repeat),
+    )
+    log.info(
+        f"Scoring {model.config.num_attention_heads} heads and "
+        f"{model.config.intermediate_size} FFN neurons on {len(calibration)} pairs"
+    )
+    heads, neurons = importance(model, calibration, args.batch_size)
+    prune(model, heads, neurons, args.keep_heads, args.keep_ffn)
+    report.update(
+        pruned_parameters=_parameters(model),
+        pruned_perplexity=perplexity(model, held_out, args.batch_size),
+        pruned_ms=latency(model, batch, args.repeat),
+    )
+    report["speedup"] = report["ms"] / report["pruned_ms"]
+    log.info(
+        f"Parameters {report['parameters']} -> {report['pruned_parameters']}, "
+        f"perplexity {report['perplexity']:.2f} -> {report['pruned_perplexity']:.2f}, "
+        f"forward pass of {len(batch)} sequences {report['ms']:.1f} -> "
+        f"{report['pruned_ms']:.1f} ms ({report['speedup']:.1f}x faster)"
+    )
+    export(model, tokenizer, normalize_path(args.export_path))
+    return report
@@ -2,18 +2,21 @@ import deepkit
 import torch
 import math
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from fastai2.basics import Recorder, Callback, random
-from fastai2.distributed import rank_distrib, num_distrib
-from calbert.tokenizer import AlbertTokenizer
+from fastai.basics import Recorder, Callback, random
+from fastai.distributed import rank_distrib, num_distrib
+from transformers import AlbertTokenizer
 from calbert.model import CalbertForMaskedLM
+from calbert.dataset import IGNORE_INDEX
+from calbert.lamb import ShardedOptimizer
 
 log = logging.getLogger(__name__)
 
 
 class DeepkitCallback(Callback):
     "A `Callback` to report metrics to Deepkit"
-    run_after = Recorder
+    order = Recorder.order + 1  # logs the smoothed loss it has just updated
 
     def __init__(self, args, cfg, tokenizer: AlbertTokenizer):
         super(DeepkitCallback).__init__()
@@ -24,24 +27,27 @@ class DeepkitCallback(Callback):
         self.tokenizer = tokenizer
         self.n_preds = 4
 
-    def begin_fit(self):
+    def before_fit(self):
         self.run = rank_distrib() == 0
         # FIXME: look into why it doesn't work
         # self.experiment.watch_torch_model(self.learn.model)
         if self.run:
-            self.total_examples = len(self.dls.train_ds)
-            self.total_batches = math.floor(
-                self.total_examples / self.args.train_batch_size / self.gpus
-            )
-            self.log_every_batches = self.total_batches / 25
-            self.valid_dl = self.dls.valid.new(
-                self.dls.valid_ds,
-                bs=self.n_preds,
-                rank=rank_distrib(),
-                world_size=num_distrib(),
-            )
-
-    def begin_epoch(self):
+            train = self.dls.train
+            if getattr(train, "sharded", False):
+                # Producer and streaming loaders have no dataset, only this rank's batches
+                self.total_batches = len(train)
+                self.total_examples = (
+                    self.total_batches * self.args.train_batch_size * self.gpus
+                )
+            else:
+                self.total_examples = len(self.dls.train_ds)
+                self.total_batches = math.floor(
+                    self.total_examples / self.args.train_batch_size / self.gpus
+                )
+            self.log_every_batches = max(math.floor(self.total_batches / 25), 1)
+            self._prepare_probe()
+
+    def before_epoch(self):
         self.experiment.iteration(self.epoch, total=self.args.epochs)
 
     def after_validate(self):
@@ -60,76 +66,108 @@ class DeepkitCallback(Callback):
             )
             self.experiment.log_metric("train_loss", self.smooth_loss)
             self.experiment.log_metric("raw_loss", self.loss)
+            self._flush_insights()
             if self.learn.train_iter % self.log_every_batches == 0:  # log some insights
-                b, _ = self.valid_dl.one_batch()
-                with torch.no_grad():
-                    model = (
-                        self.learn.model.module
-                        if hasattr(self.learn.model, "module")
-                        else self.learn.model
-                    )
-                    kls = model.__class__
-                    model.__class__ = CalbertForMaskedLM
-
-                    try:
-                        sources = [
-                            self.tokenizer.decode(x[0]).replace("<pad>", "") for x in b
-                        ]
-                        masks = b[:, 1]
-                        filt = masks != -100
-                        labels = [
-                            self.tokenizer.convert_ids_to_tokens(
-                                masks[idx][filt[idx]], skip_special_tokens=False
-                            )
-                            for idx, f in enumerate(filt)
-                        ]
-
-                        _, prediction_scores = model(b)
-                        if prediction_scores.size(0) == 0:
-                            return  # weird bug?
-                        log.info(prediction_scores.size())
-                        log.info(filt.size())
-                        log.info(self.learn.training)
-                        log.info(self.learn.train_iter)
-                        predicteds = [
-                            self.tokenizer.convert_ids_to_tokens(
-                                torch.argmax(pscore[filt[i]], dim=1),
-                                skip_special_tokens=False,
-                            )
-                            for i, pscore in enumerate(prediction_scores)
-                        ]
-                        insight = [
-                            {
-                                "text": source,
-                                "correct+predicted": list(
-                                    zip(labels[idx], predicteds[idx])
-                                ),
-                            }
-                            for idx, source in enumerate(sources)
-                        ]
-                        self.experiment.log_insight(insight, name="predictions")
-                    except Exception as e:
-                        log.error(f"Error during reporting: {e}")
-                    finally:
-                        model.__class__ = kls
+                self._submit_insights()
+
+    def _prepare_probe(self):
+        "Tokenize, mask and decode a fixed probe batch once, so insights are comparable across runs"
+        n = min(self.n_preds, len(self.dls.valid_ds))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        if n == 0:
+            # Nothing to probe when checkpoints are evaluated externally
+            log.info("No validation set to probe, logging no insights")
+            self.probe = None
+            return
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.cfg.seed)
+            self.probe = torch.stack([self.dls.valid_ds[i][0] for i in range(n)]).cpu()
+
+        self.probe_filter = self.probe[:, 1] != IGNORE_INDEX
+        self.probe_sources = [
+            self.tokenizer.decode(x[0]).replace("<pad>", "") for x in self.probe
+        ]
+        self.probe_labels = [
+            self.tokenizer.convert_ids_to_tokens(
+                x[1][f], skip_special_tokens=False
+            )
+            for x, f in zip(self.probe, self.probe_filter)
+        ]
+
+        model = self._unwrapped_model()
+        self.probe_model = CalbertForMaskedLM(model.config).eval()
+
+    def _unwrapped_model(self):
+        return (
+            self.learn.model.module
+            if hasattr(self.learn.model, "module")
+            else self.learn.model
+        )
+
+    def _submit_insights(self):
+        "Snapshot the weights and predict the probe batch on a side thread"
+        if self.probe is None:
+            return
+        if self.pending is not None:
+            return  # the previous insight is still running, skip this one
+        snapshot = {
+            k: v.detach().to("cpu", copy=True)
+            for k, v in self._unwrapped_model().state_dict().items()
+        }
+        self.pending = self.executor.submit(self._predict, snapshot)
+
+    def _predict(self, snapshot):
+        self.probe_model.load_state_dict(snapshot)
+        with torch.no_grad():
+            _, prediction_scores = self.probe_model(self.probe)
+        predicteds = [
+            self.tokenizer.convert_ids_to_tokens(
+                torch.argmax(pscore[f], dim=1), skip_special_tokens=False,
+            )
+            for pscore, f in zip(prediction_scores, self.probe_filter)
+        ]
+        return [
+            {"text": source, "correct+predicted": list(zip(labels, predicted))}
+            for source, labels, predicted in zip(
+                self.probe_sources, self.probe_labels, predicteds
+            )
+        ]
+
+    def _flush_insights(self, wait=False):
+        "Log the last insight from the training thread once it is ready"
+        if self.pending is None or not (wait or self.pending.done()):
+            return
+        try:
+            self.experiment.log_insight(self.pending.result(), name="predictions")
+        except Exception as e:
+            log.error(f"Error during reporting: {e}")
+        finally:
+            self.pending = None
 
     def after_epoch(self):
         if self.run:
             self.experiment.iteration(self.epoch + 1, total=self.args.epochs)
             name = f"model_{self.epoch}"
-            self.learn.save(name)
+            self.learn.save(name, with_opt=self._with_opt())
             self.experiment.add_output_file(
                 str(self.learn.path / "models" / f"{name}.pth")
             )
 
     def after_fit(self):
         if self.run:
-            self.learn.save("final")
+            self._flush_insights(wait=True)
+            self.executor.shutdown()
+            self.learn.save("final", with_opt=self._with_opt())
             self.experiment.add_output_file(
                 str(self.learn.path / "models" / "final.pth")
             )
         self.run = True
 
+    def _with_opt(self) -> bool:
+        # Rank 0 only holds its own shard of a sharded optimizer's state
+        return not isinstance(self.learn.opt, ShardedOptimizer)
+
     def _write_stats(self):
         metric_names = list(self.recorder.metric_names).copy()
         values = list(self.recorder.log).copy()
@@ -142,5 +180,6 @@ class DeepkitCallback(Callback):
         assert len(values) == len(metric_names)
 
         for n, s in zip(metric_names, values):
-            if n not in ["epoch"]:
+            # Without validation (validation.mode=external) its metrics are None
+            if n not in ["epoch"] and s is not None:
                 self.experiment.log_metric(n, float(f"{s:.6f}"))
@@ -0,0 +1,178 @@
+"""Export models for serving workers that share one read-only copy of the weights.
+
+Loading `pytorch_model.bin` unpickles a private fp32 copy of every weight in every
+worker. `python -m calbert serving_export` writes the weights once more, in fp32, bf16
+or fp16, into a flat `weights.bin` (with their names, shapes and offsets in
+`weights.json`) that `load` maps into memory instead of reading. The mapping is
+copy-on-write and the weights are never written to, so every process mapping the file
+shares the same pages of the page cache: workers loading it on their own, and workers
+forked after the parent loaded it alike.
+
+bf16 weights run as they are on CPUs. fp16 ones are meant for GPUs, or to be loaded
+with a `dtype` to compute in, at the cost of a private copy.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers import AlbertConfig, AlbertForMaskedLM, AlbertTokenizer
+
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+# numpy has no bfloat16, so its bits are stored and mapped as int16
+_NUMPY = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.bool: np.bool_,
+}
+
+ALIGNMENT = 64
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Export a model with weights serving workers map instead of load"
+    )
+    parser.add_argument(
+        "--model-path",
+        required=True,
+        type=Path,
+        help="The directory of the model, as exported by `train --export-path`",
+    )
+    parser.add_argument(
+        "--out", required=True, type=Path, help="Where to export the serving model",
+    )
+    parser.add_argument(
+        "--dtype",
+        default="bf16",
+        choices=list(DTYPES),
+        help="Precision to store the weights in: bf16 for CPUs, fp16 for GPUs",
+    )
+    return parser
+
+
+def cast_state_dict(
+    state: Dict[str, torch.Tensor], dtype: str
+) -> Dict[str, torch.Tensor]:
+    "`state` with its floating point tensors in `dtype` (fp32, bf16 or fp16)"
+    if dtype not in DTYPES:
+        raise ValueError(f"Invalid dtype {dtype}: must be one of {', '.join(DTYPES)}")
+    return {
+        name: t.to(DTYPES[dtype]) if t.is_floating_point() else t
+        for name, t in state.items()
+    }
+
+
+def save_weights(model: nn.Module, directory: Path, dtype: str = "bf16") -> int:
+    """Write the weights of `model` in `dtype` into `directory`/weights.bin, returning its size.
+
+    Tied weights are written once and mapped back to every name they go by.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    state = model.state_dict()
+    tensors, written, offset = {}, {}, 0
+    with open(directory / "weights.bin", "wb") as f:
+        for name, t in state.items():
+            key = (t.data_ptr(), t.dtype, tuple(t.shape))
+            if key not in written:
+                t = cast_state_dict({name: t}, dtype)[name].detach().cpu().contiguous()
+                data = (t.view(torch.int16) if t.dtype == torch.bfloat16 else t).numpy()
+                offset += -offset % ALIGNMENT
+                f.seek(offset)
+                f.write(data.tobytes())
+                written[key] = dict(
+                    offset=offset,
+                    shape=list(t.shape),
+                    dtype=str(t.dtype).split(".")[1],
+                )
+                offset += data.nbytes
+            tensors[name] = written[key]
+    manifest = dict(dtype=dtype, tensors=tensors)
+    (directory / "weights.json").write_text(json.dumps(manifest, indent=2))
+    return offset
+
+
+def load_weights(directory: Path) -> Dict[str, torch.Tensor]:
+    "The tensors of `directory`/weights.bin, mapped copy-on-write rather than read"
+    directory = Path(directory)
+    manifest = json.loads((directory / "weights.json").read_text())
+    data = np.memmap(directory / "weights.bin", dtype=np.uint8, mode="c")
+    weights = {}
+    for name, entry in manifest["tensors"].items():
+        dtype = getattr(torch, entry["dtype"])
+        itemsize = np.dtype(_NUMPY[dtype]).itemsize
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = entry["offset"]
+        array = data[start : start + count * itemsize].view(_NUMPY[dtype])
+        t = torch.from_numpy(array.reshape(entry["shape"]))
+        weights[name] = t.view(torch.bfloat16) if dtype == torch.bfloat16 else t
+    return weights
+
+
+def _assign(model: nn.Module, name: str, tensor: torch.Tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model
+    if module_name:
+        module = functools.reduce(getattr, module_name.split("."), model)
+    if attr in module._parameters:
+        module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attr] = tensor
+
+
+def load(
+    directory: Path, dtype: torch.dtype = None
+) -> Tuple[AlbertForMaskedLM, AlbertTokenizer]:
+    """The model and tokenizer exported by `serving_export` into `directory`, for inference.
+
+    The weights stay in the precision they were exported in, and shared with every other
+    process mapping them, unless `dtype` asks for another one. Load it before forking
+    workers for them to share the tokenizer too.
+    """
+    directory = Path(directory)
+    model = AlbertForMaskedLM(AlbertConfig.from_pretrained(str(directory)))
+    for name, tensor in load_weights(directory).items():
+        _assign(model, name, tensor if dtype is None else tensor.to(dtype))
+    model.tie_weights()
+    tokenizer = AlbertTokenizer.from_pretrained(str(directory))
+    return model.eval(), tokenizer
+
+
+def export(
+    model: AlbertForMaskedLM, tokenizer: AlbertTokenizer, path: Path, dtype: str = "bf16"
+) -> int:
+    "Export `model` and `tokenizer` into `path` in HuggingFace format and as mappable weights"
+    from calbert.training import export as export_pretrained
+
+    export_pretrained(model, tokenizer, path, dtype=dtype)
+    return save_weights(model, path, dtype)
+
+
+def run(args, cfg) -> dict:
+    model_path = normalize_path(args.model_path)
+    out = normalize_path(args.out)
+    model = AlbertForMaskedLM.from_pretrained(str(model_path)).eval()
+    tokenizer = AlbertTokenizer.from_pretrained(str(model_path))
+    size = export(model, tokenizer, out, args.dtype)
+    original = os.path.getsize(model_path / "pytorch_model.bin")
+    log.info(
+        f"Exported {model_path} to {out} in {args.dtype}: {size / 2 ** 20:.1f} MiB "
+        f"of weights to map, from a {original / 2 ** 20:.1f} MiB pytorch_model.bin"
+    )
+    return dict(size=size, original_size=original)
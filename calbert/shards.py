@@ -0,0 +1,139 @@
+"""Write text corpora as compressed corpus shards.
+
+`python -m calbert shard --input dist/data/train.txt` writes `dist/data/train.shard`:
+the lines of the corpus in independently compressed blocks (zstd frames when
+`zstandard` is installed, zlib streams otherwise) with an index of the blocks, which
+`calbert.dataset.ShardReader` reads back. Training, validation and every other command
+taking a `train.txt` or `valid.txt` take a shard instead.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import List
+
+from calbert.dataset import SHARD_MAGIC, SHARD_TRAILER, codec, line_pairs
+from calbert.streaming import line_blocks, read_block_lines
+from calbert.utils import normalize_path, ordered_map
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Compress text corpora into randomly accessible shards"
+    )
+    parser.add_argument(
+        "--input",
+        required=True,
+        type=Path,
+        nargs="+",
+        help="Text files to compress, e.g. train.txt and valid.txt",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        default=None,
+        help="Where to write NAME.shard (defaults to next to each input)",
+    )
+    parser.add_argument(
+        "--block-size-mb",
+        type=float,
+        default=4,
+        help="Uncompressed size of each block, the unit of random access",
+    )
+    parser.add_argument(
+        "--codec",
+        default="auto",
+        choices=["auto", "zstd", "zlib"],
+        help="auto uses zstd if zstandard is installed, and zlib otherwise",
+    )
+    parser.add_argument("--level", type=int, default=None, help="Compression level")
+    parser.add_argument(
+        "--threads", type=int, default=4, help="Blocks compressed at the same time",
+    )
+    return parser
+
+
+def default_codec() -> str:
+    try:
+        import zstandard  # noqa: F401
+
+        return "zstd"
+    except ImportError:
+        return "zlib"
+
+
+def write_shard(
+    path: Path,
+    out: Path,
+    block_size: int = 4 * 2 ** 20,
+    codec_name: str = "zstd",
+    level: int = None,
+    min_length: int = 8,
+    threads: int = 4,
+) -> List[list]:
+    """Write the text file at `path` as a corpus shard at `out`, returning its block index.
+
+    Blocks of about `block_size` bytes, ending at line ends, are compressed on `threads`
+    threads. The shard is written to a temporary file and renamed into place.
+    """
+    if level is None:
+        level = 3 if codec_name == "zstd" else 6
+    compress = codec(codec_name, level)[0]
+
+    def encode(block):
+        lines = read_block_lines(path, block)
+        pairs = sum(1 for line in lines for _ in line_pairs(line, min_length))
+        data = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        return compress(data), block, pairs
+
+    blocks = []
+    tmp = Path(f"{out}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(SHARD_MAGIC)
+        for data, (start, end), pairs in ordered_map(
+            encode, line_blocks(path, block_size), threads
+        ):
+            blocks.append([f.tell(), len(data), end - start, pairs])
+            f.write(data)
+        index = json.dumps(
+            dict(codec=codec_name, min_length=min_length, blocks=blocks)
+        ).encode("utf-8")
+        f.write(index)
+        f.write(SHARD_TRAILER.pack(len(index), SHARD_MAGIC))
+    os.replace(tmp, out)
+    return blocks
+
+
+def run(args, cfg) -> List[dict]:
+    codec_name = default_codec() if args.codec == "auto" else args.codec
+    reports = []
+    for path in args.input:
+        path = normalize_path(path)
+        out_dir = normalize_path(args.out_dir) if args.out_dir else path.parent
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out = out_dir / f"{path.stem}.shard"
+        start = time.perf_counter()
+        blocks = write_shard(
+            path,
+            out,
+            block_size=int(args.block_size_mb * 2 ** 20),
+            codec_name=codec_name,
+            level=args.level,
+            threads=args.threads,
+        )
+        seconds = time.perf_counter() - start
+        size, shard_size = os.path.getsize(path), os.path.getsize(out)
+        log.info(
+            f"{path} -> {out}: {len(blocks)} {codec_name} blocks, "
+            f"{size / 2 ** 20:.1f} -> {shard_size / 2 ** 20:.1f} MiB "
+            f"({size / max(shard_size, 1):.1f}x smaller) in {seconds:.1f}s"
+        )
+        reports.append(
+            dict(path=str(out), blocks=len(blocks), size=size, shard_size=shard_size)
+        )
+    return reports
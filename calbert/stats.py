@@ -0,0 +1,295 @@
+"""Statistics of a corpus as the training pipeline tokenizes it, to choose its settings by.
+
+`python -m calbert stats --tokenizer-path ... --input dist/data/train.txt` tokenizes
+every sentence pair of a text file (or corpus shard) like `Tokenize` does, with the
+configured tokenizer, over a pool of processes. Each process summarizes its blocks of
+the corpus in a `Sketch` whose size doesn't depend on how much text it saw, and the
+sketches are merged into the report: how long pairs are, how many each candidate
+`training.max_seq_length` would truncate, how much of every batch is padding, how
+often pieces are unknown (and which words are), and how much of the corpus the most
+frequent pieces cover, for `vocab.max_size`.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+from pathlib import Path
+from typing import Dict, List
+
+from calbert.dataset import line_pairs
+from calbert.streaming import BlockShuffler
+from calbert.tokenizer import load as load_tokenizer
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Token length, truncation, padding and vocabulary statistics of a corpus"
+    )
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        required=True,
+        help="The path to the sentencepiece *model* (ca.{uncased|cased}.VOCABSIZE.model)",
+    )
+    parser.add_argument(
+        "--input",
+        required=True,
+        type=Path,
+        help="The corpus, a text file like train.txt or a corpus shard",
+    )
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[64, 128, 256, 512],
+        help="Candidate max_seq_length values to report truncation and padding for",
+    )
+    parser.add_argument(
+        "--vocab-sizes",
+        type=int,
+        nargs="+",
+        default=[8000, 16000, 30000],
+        help="Candidate vocabulary sizes to report the coverage of the top pieces for",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Processes tokenizing")
+    parser.add_argument(
+        "--block-size-mb",
+        type=float,
+        default=4,
+        help="Size of the blocks of a text file handed to each process at a time",
+    )
+    parser.add_argument(
+        "--top-unknown",
+        type=int,
+        default=50,
+        help="How many of the most frequent words with unknown pieces to track",
+    )
+    parser.add_argument(
+        "--out", type=Path, default=None, help="Where to write the report as JSON",
+    )
+    return parser
+
+
+class HeavyHitters:
+    """The approximately most frequent of a stream of items, in `capacity` counters.
+
+    Misra-Gries: every item appearing more than `n / (capacity + 1)` times in a stream
+    of `n` is kept, its count underestimated by at most that much. Two summaries merge
+    into one of the concatenated streams with the same guarantee.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+
+    def add(self, item: str, count: int = 1):
+        if item in self.counts or len(self.counts) < self.capacity:
+            self.counts[item] = self.counts.get(item, 0) + count
+            return
+        self.counts[item] = count
+        self._trim()
+
+    def merge(self, other: "HeavyHitters") -> "HeavyHitters":
+        for item, count in other.counts.items():
+            self.counts[item] = self.counts.get(item, 0) + count
+        self._trim()
+        return self
+
+    def _trim(self):
+        if len(self.counts) <= self.capacity:
+            return
+        # Take the (capacity + 1)th largest count off every counter and drop the spent
+        cut = sorted(self.counts.values(), reverse=True)[self.capacity]
+        self.counts = {k: c - cut for k, c in self.counts.items() if c > cut}
+
+    def most_common(self, n: int = None) -> List[tuple]:
+        return sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))[:n]
+
+
+class Sketch:
+    """A mergeable summary of the tokenized sentence pairs of (part of) a corpus.
+
+    Counts pairs by token length up to `max_length` (longer ones share the last
+    bucket), pieces by id, and the words with unknown pieces in a `HeavyHitters`, so
+    its size only depends on those and on the vocabulary, never on the corpus.
+    """
+
+    def __init__(self, vocab_size: int, max_length: int = 4096, top_unknown: int = 50):
+        self.max_length = max_length
+        self.lengths = [0] * (max_length + 1)
+        self.pieces = [0] * vocab_size
+        self.pairs, self.tokens, self.unknown = 0, 0, 0
+        self.unknown_words = HeavyHitters(top_unknown)
+
+    def add(self, length: int, pieces: List[int], unknown: int):
+        "Count a pair of `length` tokens in all, its `pieces` and `unknown` of them unknown"
+        self.pairs += 1
+        self.lengths[min(length, self.max_length)] += 1
+        for i in pieces:
+            self.pieces[i] += 1
+        self.tokens += len(pieces)
+        self.unknown += unknown
+
+    def merge(self, other: "Sketch") -> "Sketch":
+        self.lengths = [a + b for a, b in zip(self.lengths, other.lengths)]
+        self.pieces = [a + b for a, b in zip(self.pieces, other.pieces)]
+        self.pairs += other.pairs
+        self.tokens += other.tokens
+        self.unknown += other.unknown
+        self.unknown_words.merge(other.unknown_words)
+        return self
+
+    def quantile(self, q: float) -> int:
+        "The length of the shortest `q` share of the pairs"
+        target, seen = q * self.pairs, 0
+        for length, count in enumerate(self.lengths):
+            seen += count
+            if count and seen >= target:
+                return length
+        return self.max_length
+
+    def truncated(self, length: int) -> float:
+        "The share of pairs longer than `length` tokens"
+        return sum(self.lengths[length + 1 :]) / max(self.pairs, 1)
+
+    def padding(self, length: int) -> float:
+        "The share of positions that are padding when every pair is padded to `length`"
+        real = sum(min(n, length) * count for n, count in enumerate(self.lengths))
+        return 1 - real / max(self.pairs * length, 1)
+
+    def coverage(self, size: int) -> float:
+        "The share of the tokens that are one of the `size` most frequent pieces"
+        return sum(sorted(self.pieces, reverse=True)[:size]) / max(self.tokens, 1)
+
+
+_shuffler, _tokenizer, _top_unknown = None, None, 50
+
+
+def sketch_pairs(pairs, tokenizer, top_unknown: int = 50) -> Sketch:
+    "The `Sketch` of `pairs` tokenized by `tokenizer` as `Tokenize` does, before truncation"
+    sketch = Sketch(len(tokenizer), top_unknown=top_unknown)
+    unk_id = tokenizer.unk_token_id
+    for pair in pairs:
+        first = tokenizer.encode(pair.first, add_special_tokens=False)
+        second = tokenizer.encode(pair.second, add_special_tokens=False)
+        length = len(first) + len(second) + tokenizer.num_added_tokens(pair=True)
+        pieces = first + second
+        unknown = pieces.count(unk_id)
+        sketch.add(length, pieces, unknown)
+        if unknown:
+            for word in f"{pair.first} {pair.second}".split():
+                if unk_id in tokenizer.encode(word, add_special_tokens=False):
+                    sketch.unknown_words.add(word)
+    return sketch
+
+
+def _sketch_block(block: int) -> Sketch:
+    pairs = (
+        pair
+        for lines in _shuffler.block_lines([block])
+        for line in lines
+        for pair in line_pairs(line, _shuffler.min_length)
+    )
+    return sketch_pairs(pairs, _tokenizer, _top_unknown)
+
+
+def scan(
+    path: Path,
+    tokenizer,
+    workers: int = 4,
+    block_size: int = 4 * 2 ** 20,
+    top_unknown: int = 50,
+) -> Sketch:
+    """The merged `Sketch` of all the sentence pairs of the corpus at `path`.
+
+    The corpus is split in blocks (a shard's own, or line-aligned ones of about
+    `block_size` bytes of a text file), sketched by a pool of `workers` processes, or in
+    this one if there are none.
+    """
+    global _shuffler, _tokenizer, _top_unknown
+    _shuffler = BlockShuffler(path, block_size=block_size, threads=0)
+    _tokenizer, _top_unknown = tokenizer, top_unknown
+    blocks = range(len(_shuffler.blocks))
+    total = Sketch(len(tokenizer), top_unknown=top_unknown)
+    if not workers:
+        for block in blocks:
+            total.merge(_sketch_block(block))
+        return total
+    # Forked workers inherit the tokenizer instead of unpickling one each
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        for sketch in pool.imap_unordered(_sketch_block, blocks):
+            total.merge(sketch)
+    return total
+
+
+def report(sketch: Sketch, lengths: List[int], vocab_sizes: List[int], cfg) -> dict:
+    "The statistics of `sketch`, for the candidate `lengths` and `vocab_sizes`"
+    max_seq_length = cfg.training.max_seq_length
+    probability = cfg.training.masked_lm_prob
+    lengths = sorted(set(lengths) | {max_seq_length})
+    return dict(
+        pairs=sketch.pairs,
+        tokens=sketch.tokens,
+        length_quantiles={
+            str(q): sketch.quantile(q) for q in [0.5, 0.9, 0.95, 0.99, 0.999, 1.0]
+        },
+        length_histogram={
+            str(n): count for n, count in enumerate(sketch.lengths) if count
+        },
+        truncated={str(n): sketch.truncated(n) for n in lengths},
+        padding={str(n): sketch.padding(n) for n in lengths},
+        max_seq_length=max_seq_length,
+        max_seq_length_padding=sketch.padding(max_seq_length),
+        masked_per_pair=probability * sketch.tokens / max(sketch.pairs, 1),
+        unknown_rate=sketch.unknown / max(sketch.tokens, 1),
+        unknown_words=sketch.unknown_words.most_common(),
+        pieces_used=sum(1 for count in sketch.pieces if count),
+        vocab_size=len(sketch.pieces),
+        coverage={str(n): sketch.coverage(n) for n in sorted(vocab_sizes)},
+    )
+
+
+def run(args, cfg) -> dict:
+    tokenizer = load_tokenizer(cfg, normalize_path(args.tokenizer_path))
+    path = normalize_path(args.input)
+    log.info(f"Scanning {path} on {args.workers} processes")
+    sketch = scan(
+        path,
+        tokenizer,
+        workers=args.workers,
+        block_size=int(args.block_size_mb * 2 ** 20),
+        top_unknown=args.top_unknown,
+    )
+    stats = report(sketch, args.lengths, args.vocab_sizes, cfg)
+    log.info(
+        f"{stats['pairs']} pairs, {stats['tokens']} tokens. Pair length quantiles: "
+        + ", ".join(f"{q}: {n}" for q, n in stats["length_quantiles"].items())
+    )
+    for n in stats["truncated"]:
+        log.info(
+            f"max_seq_length {n}: {stats['truncated'][n]:.2%} of pairs truncated, "
+            f"{stats['padding'][n]:.2%} of positions padding"
+        )
+    log.info(
+        f"masked_lm_prob {cfg.training.masked_lm_prob} masks "
+        f"{stats['masked_per_pair']:.1f} tokens per pair on average"
+    )
+    log.info(
+        f"{stats['unknown_rate']:.4%} of the tokens are unknown, most often in: "
+        + ", ".join(word for word, _ in stats["unknown_words"][:10])
+    )
+    log.info(
+        f"{stats['pieces_used']} of {stats['vocab_size']} pieces used. "
+        + ", ".join(
+            f"the top {n} cover {share:.2%}" for n, share in stats["coverage"].items()
+        )
+    )
+    if args.out:
+        out = normalize_path(args.out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(stats, indent=2))
+    return stats
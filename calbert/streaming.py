@@ -0,0 +1,354 @@
+"""Block-shuffled streaming over the training corpus, with bounded memory and sequential reads.
+
+The corpus is split in large line-aligned blocks of bytes. Every epoch visits them in a
+new seeded order, reading each one front to back, and mixes the sentence pairs of the
+blocks through a bounded shuffle buffer. Ranks and loader workers each stream their own
+blocks, so nothing but the buffers is ever held in memory.
+
+A corpus shard (see `calbert.dataset.ShardReader`) is already split in compressed
+blocks, which are streamed as they are, decompressed ahead on threads.
+
+`StreamCheckpointCallback` saves where the stream is along with the model, for a
+restarted run (`train --resume`) to pick the epoch up where it stopped.
+"""
+
+__all__ = [
+    "line_blocks",
+    "read_block_lines",
+    "block_pair_counts",
+    "BlockShuffler",
+    "StreamingDL",
+    "StreamCheckpointCallback",
+]
+
+import hashlib
+import json
+import logging
+import os
+import random
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import torch
+from fastai.basics import Callback, get_model
+from fastai.distributed import rank_distrib
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from calbert.dataset import SentencePair, ShardReader, is_shard, line_pairs
+from calbert.lamb import ShardedOptimizer
+
+log = logging.getLogger(__name__)
+
+
+def line_blocks(path: Path, block_size: int) -> List[Tuple[int, int]]:
+    "Split `path` in (start, end) byte ranges of about `block_size` bytes, ending at line ends"
+    size = os.path.getsize(path)
+    blocks, start = [], 0
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + block_size, size))
+            f.readline()  # finish the line we landed in
+            end = min(f.tell(), size)
+            blocks.append((start, end))
+            start = end
+    return blocks
+
+
+def read_block_lines(path: Path, block: Tuple[int, int]) -> List[str]:
+    "The lines of text of a (start, end) byte range of `path`, as `line_blocks` splits it"
+    start, end = block
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8").splitlines()
+
+
+def block_pair_counts(
+    path: Path, blocks: List[Tuple[int, int]], min_length: int = 8, cache_dir: Path = None
+) -> List[int]:
+    """The number of sentence pairs in each of `blocks` of `path`.
+
+    Counting takes a pass over the corpus, so it is cached in `cache_dir` (if given),
+    keyed by the file's size and modification time and the blocks.
+    """
+    cache = None
+    if cache_dir is not None:
+        stat = os.stat(path)
+        key = repr((str(Path(path).resolve()), stat.st_size, stat.st_mtime, blocks, min_length))
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        cache = Path(cache_dir) / f"blocks-{key}.json"
+        if cache.exists():
+            return json.loads(cache.read_text())
+    counts = [
+        sum(
+            1
+            for line in read_block_lines(path, block)
+            for _ in line_pairs(line, min_length)
+        )
+        for block in blocks
+    ]
+    if cache is not None:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(counts))
+        os.replace(tmp, cache)
+    return counts
+
+
+class BlockShuffler:
+    """The sentence pairs of the corpus at `path` in a shuffled order that only needs sequential reads.
+
+    Each epoch permutes the blocks of about `block_size` bytes (or the blocks of a
+    corpus shard, decompressed on `threads` threads) with a seed derived from `seed`
+    and the epoch, and mixes the pairs read from them through a buffer of
+    `buffer_size` pairs. The same epoch always streams in the same order.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        block_size: int = 8 * 2 ** 20,
+        buffer_size: int = 100_000,
+        seed: int = 42,
+        min_length: int = 8,
+        threads: int = 2,
+    ):
+        self.path = path
+        self.reader = ShardReader(path) if is_shard(path) else None
+        if self.reader is not None:
+            self.blocks = self.reader.blocks
+        else:
+            self.blocks = line_blocks(path, block_size)
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.min_length = min_length
+        self.threads = threads
+
+    def block_lines(self, blocks: List[int]) -> Iterator[List[str]]:
+        "The lines of each of `blocks`, in order"
+        if self.reader is not None:
+            return self.reader.lines(blocks, self.threads)
+        return (read_block_lines(self.path, self.blocks[block]) for block in blocks)
+
+    def pair_counts(self, cache_dir: Path = None) -> List[int]:
+        "The number of sentence pairs in each block, from the shard's index if it has them"
+        if self.reader is None:
+            return block_pair_counts(self.path, self.blocks, self.min_length, cache_dir)
+        if self.reader.min_length == self.min_length:
+            return self.reader.pair_counts()
+        return [
+            sum(1 for line in lines for _ in line_pairs(line, self.min_length))
+            for lines in self.block_lines(range(len(self.blocks)))
+        ]
+
+    def permutation(self, epoch: int) -> List[int]:
+        "The order in which `epoch` visits the blocks"
+        order = list(range(len(self.blocks)))
+        random.Random(f"{self.seed}-{epoch}").shuffle(order)
+        return order
+
+    def shard(self, epoch: int, shard: int = 0, shards: int = 1) -> List[int]:
+        "The blocks streamed by `shard` of `shards` in `epoch`"
+        return self.permutation(epoch)[shard::shards]
+
+    def stream(
+        self, epoch: int, shard: int = 0, shards: int = 1, skip: int = 0
+    ) -> Iterator[SentencePair]:
+        "The pairs of `shard` of `shards` in `epoch`, leaving out the first `skip` of them"
+        rng = random.Random(f"{self.seed}-{epoch}-{shard}")
+        buffer, position = [], 0
+        for lines in self.block_lines(self.shard(epoch, shard, shards)):
+            for line in lines:
+                for pair in line_pairs(line, self.min_length):
+                    if len(buffer) < self.buffer_size:
+                        buffer.append(pair)
+                        continue
+                    i = rng.randrange(len(buffer))
+                    pair, buffer[i] = buffer[i], pair
+                    position += 1
+                    if position > skip:
+                        yield pair
+        rng.shuffle(buffer)
+        yield from buffer[max(skip - position, 0) :]
+
+
+class _Batches(IterableDataset):
+    "The batches of one epoch of a rank, each loader worker streaming its own blocks"
+
+    def __init__(self, dl: "StreamingDL", epoch: int, quota: int, skip: int):
+        self.dl, self.epoch, self.quota, self.skip = dl, epoch, quota, skip
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info else (0, 1)
+        dl = self.dl
+        # Batches come from the workers in turn, so this one already served every workers-th
+        done = len(range(worker, self.skip, workers))
+        pairs = dl.shuffler.stream(
+            self.epoch,
+            shard=dl.rank * workers + worker,
+            shards=dl.world_size * workers,
+            skip=done * dl.batch_size,
+        )
+        for _ in range(self.quota - done):
+            batch = []
+            for pair in pairs:
+                for tfm in dl.tfms:
+                    pair = tfm(pair)
+                batch.append(pair)
+                if len(batch) == dl.batch_size:
+                    break
+            x = torch.stack(batch)
+            yield x, torch.zeros(len(x), dtype=torch.long)
+
+
+class StreamingDL:
+    """Training batches of this rank streamed from a `BlockShuffler`, in a new order every epoch.
+
+    Every rank gets the same number of batches per epoch (or data-parallel training
+    would hang), which the pair counts of the blocks tell ahead of time. Quacks like
+    the fastai loaders the `Learner` needs and is already sharded, so the `DDPTrainer`
+    leaves it alone. `state_dict` and `load_state_dict` resume an epoch where it stopped.
+    """
+
+    sharded = True
+    n_inp = 1
+    dataset = None
+
+    def __init__(
+        self,
+        shuffler: BlockShuffler,
+        tfms: list,
+        batch_size: int,
+        rank: int = 0,
+        world_size: int = 1,
+        num_workers: int = 4,
+        prefetch_factor: int = 2,
+        device=None,
+        cache_dir: Path = None,
+    ):
+        self.shuffler = shuffler
+        self.tfms = tfms
+        self.batch_size = batch_size
+        self.rank, self.world_size = rank, world_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.device = device
+        self.counts = shuffler.pair_counts(cache_dir)
+        self.epoch, self.batches = 0, 0
+        if len(self.shuffler.blocks) < self.world_size * self.workers:
+            raise ValueError(
+                f"{len(self.shuffler.blocks)} blocks can't feed {self.world_size} ranks "
+                f"of {self.workers} workers: use a smaller block size"
+            )
+
+    @property
+    def workers(self) -> int:
+        return max(self.num_workers, 1)
+
+    def quota(self, epoch: int) -> int:
+        "The batches each worker of each rank streams in `epoch`: what the scarcest one can fill"
+        shards = self.world_size * self.workers
+        return min(
+            sum(self.counts[b] for b in self.shuffler.shard(epoch, shard, shards))
+            // self.batch_size
+            for shard in range(shards)
+        )
+
+    def __len__(self):
+        return self.quota(self.epoch) * self.workers - self.batches
+
+    def to(self, device):
+        self.device = device
+        return self
+
+    def state_dict(self) -> dict:
+        return {"epoch": self.epoch, "batches": self.batches}
+
+    def load_state_dict(self, state: dict):
+        self.epoch, self.batches = state["epoch"], state["batches"]
+
+    def __iter__(self):
+        quota = self.quota(self.epoch)
+        if self.rank == 0 and self.batches == 0:
+            total = sum(self.counts)
+            used = quota * self.workers * self.world_size * self.batch_size
+            log.info(
+                f"Epoch {self.epoch}: streaming {used} of {total} sentence pairs "
+                f"in {len(self.shuffler.blocks)} shuffled blocks"
+            )
+        options = {}
+        if self.num_workers:  # torch refuses it without workers
+            options["prefetch_factor"] = self.prefetch_factor
+        loader = DataLoader(
+            _Batches(self, self.epoch, quota, self.batches),
+            batch_size=None,
+            num_workers=self.num_workers,
+            pin_memory=self.device is not None and torch.device(self.device).type == "cuda",
+            **options,
+        )
+        for x, y in loader:
+            self.batches += 1
+            if self.device is not None:
+                x, y = x.to(self.device, non_blocking=True), y.to(self.device)
+            yield x, y
+        self.epoch, self.batches = self.epoch + 1, 0
+
+
+class StreamCheckpointCallback(Callback):
+    """A `Callback` checkpointing the model with the position of its `StreamingDL`.
+
+    Every `every` training steps and after every epoch, rank 0 atomically writes the
+    model's weights, the optimizer state (unless sharded) and the loader's `state_dict`
+    (the same on every rank) to `models/stream.pth` under the learner's path. `restore`
+    loads them back on every rank, so a restarted run resumes the epoch where it stopped
+    instead of starting it over.
+    """
+
+    def __init__(self, every: int = 1000):
+        self.every = every
+
+    @property
+    def path(self) -> Path:
+        return self.learn.path / self.learn.model_dir / "stream.pth"
+
+    def after_batch(self):
+        if self.training and self.every and self.dls.train.batches % self.every == 0:
+            self._save()
+
+    def after_epoch(self):
+        self._save()
+
+    def _save(self):
+        if rank_distrib() != 0:
+            return
+        state = {
+            "model": get_model(self.learn.model).state_dict(),
+            "stream": self.dls.train.state_dict(),
+        }
+        # Rank 0 only holds its own shard of a sharded optimizer's state
+        if self.learn.opt is not None and not isinstance(
+            self.learn.opt, ShardedOptimizer
+        ):
+            state["opt"] = self.learn.opt.state_dict()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(state, tmp)
+        os.replace(tmp, self.path)
+
+    def restore(self) -> int:
+        "Load the last checkpoint, if there is one, returning the epochs it completed"
+        if not self.path.exists():
+            return 0
+        device = next(self.learn.model.parameters()).device
+        state = torch.load(self.path, map_location=device)
+        get_model(self.learn.model).load_state_dict(state["model"])
+        if "opt" in state:
+            if self.learn.opt is None:
+                self.learn.create_opt()
+            self.learn.opt.load_state_dict(state["opt"])
+        self.dls.train.load_state_dict(state["stream"])
+        log.info(
+            f"Resuming from {self.path}: epoch {state['stream']['epoch']}, "
+            f"after {state['stream']['batches']} of its batches"
+        )
+        return state["stream"]["epoch"]
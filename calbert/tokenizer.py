@@ -3,16 +3,21 @@ import logging
 import argparse
 import collections
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import sentencepiece as spm
-from transformers import AlbertTokenizer
 
 from .utils import normalize_path
 
+if TYPE_CHECKING:
+    from transformers import AlbertTokenizer
+
 log = logging.getLogger(__name__)
 
 
-def load(cfg, vocab_path: Path) -> AlbertTokenizer:
+def load(cfg, vocab_path: Path) -> "AlbertTokenizer":
+    from transformers import AlbertTokenizer  # slow import, training a tokenizer doesn't need it
+
     return AlbertTokenizer(str(vocab_path.absolute()), keep_accents=True, do_lower_case=cfg.vocab.lowercase)
 
 
@@ -24,7 +29,7 @@ def arguments() -> argparse.ArgumentParser:
     return parser
 
 
-def train(args, cfg) -> AlbertTokenizer:
+def train(args, cfg) -> str:
     log.info(f"Training tokenizer: {args}")
 
     out_dir = normalize_path(args.out_dir)
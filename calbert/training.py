@@ -2,14 +2,14 @@ from pathlib import Path
 from collections import ChainMap
 from typing import Tuple, List
 import argparse
+import os
 import logging
 from functools import partial
 
 from fastprogress import fastprogress
-import deepkit
 import torch
 import torch.nn as nn
-from fastai2.basics import (
+from fastai.basics import (
     Learner,
     Transform,
     random,
@@ -17,30 +17,51 @@ from fastai2.basics import (
     to_device,
     default_device,
 )
-from fastai2.callback import progress, schedule, fp16
-from fastai2.callback.all import SaveModelCallback, ReduceLROnPlateau
-from fastai2.distributed import (
+from fastai.callback import progress, schedule, fp16
+from fastai.callback.all import SaveModelCallback, ReduceLROnPlateau
+from fastai.distributed import (
     rank_distrib,
     DistributedTrainer,
-    distrib_ctx,
     num_distrib,
 )
-from fastai2.metrics import accuracy, Perplexity
-from fastai2.data.core import TfmdDL, DataLoaders, Datasets
-from fastai2.text.data import TensorText
-from fastai2.optimizer import Lamb
+from fastai.metrics import accuracy
+from fastai.data.core import TfmdDL, DataLoaders, Datasets
+from fastai.text.data import TensorText
+from fastai.optimizer import Lamb
 
 from transformers import (
     AlbertConfig,
     AlbertForMaskedLM,
+    AlbertTokenizer,
 )
 from transformers.modeling_albert import AlbertMLMHead
 
-from calbert.reporting import DeepkitCallback
-from calbert.dataset import CalbertDataset, Tokenize, dataloaders as build_dataloaders
+from calbert.curriculum import CurriculumCallback
+from calbert.distributed import distrib_ctx
+from calbert.lamb import ShardedLamb
+from calbert.producer import SharedBatchDL, ring_path, run_nonce, start_producer
+from calbert.precision import PRECISIONS, to_precision
+from calbert.profiling import ProfilingCallback
+from calbert.serving import DTYPES, cast_state_dict
+from calbert.streaming import BlockShuffler, StreamCheckpointCallback, StreamingDL
+from calbert.dataset import (
+    CalbertDataset,
+    PackedCalbertDataset,
+    Tokenize,
+    dataloader as build_dataloader,
+    loader_options,
+    transforms,
+)
 from calbert.model import CalbertForMaskedLM
-from calbert.tokenizer import AlbertTokenizer, load as load_tokenizer
+from calbert.tokenizer import load as load_tokenizer
 from calbert.utils import normalize_path
+from calbert.validation import (
+    CheckpointCallback,
+    DevicePerplexity,
+    PeriodicValidationCallback,
+    cached_eval_set,
+    eval_dataloader,
+)
 
 fastprogress.MAX_COLS = 80
 
@@ -69,12 +90,18 @@ def arguments() -> argparse.ArgumentParser:
         type=Path,
         help="The optional output directory where to save the model in HuggingFace format",
     )
+    parser.add_argument(
+        "--export-dtype",
+        default="fp32",
+        choices=list(DTYPES),
+        help="Precision of the exported weights (they're loaded back in fp32)",
+    )
 
     parser.add_argument(
         "--train-batch-size",
-        default=128,
+        default=None,
         type=int,
-        help="Batch size across all GPUs/CPUs for training.",
+        help="Batch size across all GPUs/CPUs for training (defaults to training.batch_size).",
     )
     parser.add_argument(
         "--eval-batch-size",
@@ -94,13 +121,35 @@ def arguments() -> argparse.ArgumentParser:
     )
 
     parser.add_argument(
-        "--fp16", action="store_true", help="Whether to use 16-bit (mixed) precision",
+        "--precision",
+        default="fp32",
+        choices=PRECISIONS,
+        help="Train in fp32, bf16 autocast (CPU or GPU) or fp16 mixed precision (GPU)",
+    )
+    parser.add_argument(
+        "--fp16", action="store_true", help="Same as --precision fp16",
     )
     parser.add_argument(
         "--deepkit",
         action="store_true",
         help="Whether to log metrics and insights to Deepkit",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Whether to record per-step timings, throughput and profiler traces",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=Path("profile"),
+        type=Path,
+        help="Where to write the profiling JSONL files and traces",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the last checkpoint of a streamed run (data.shuffle_blocks)",
+    )
     parser.add_argument(
         "--gpu", default=None, type=int,
     )
@@ -115,22 +164,182 @@ def albert_config(cfg, args) -> AlbertConfig:
     return AlbertConfig(vocab_size=cfg.vocab.max_size, **dict(cfg.model))
 
 
-def initialize_model(cfg, args, tokenizer: AlbertTokenizer) -> CalbertForMaskedLM:
+def initialize_model(
+    cfg, args, tokenizer: AlbertTokenizer, **config_overrides
+) -> CalbertForMaskedLM:
     config = albert_config(cfg, args)
+    for key, value in config_overrides.items():
+        setattr(config, key, value)
     model = CalbertForMaskedLM(config)
 
     model_to_resize = (
         model.module if hasattr(model, "module") else model
     )  # Take care of distributed/parallel training
     model_to_resize.resize_token_embeddings(len(tokenizer))
+    if cfg.training.get("activation_checkpointing", False):
+        model.checkpoint_activations()
+    if cfg.training.get("fused_attention", False):
+        model.use_fused_attention()
     return to_device(model, default_device())
 
 
+def train_dataset(
+    args, cfg, tokenizer: AlbertTokenizer, max_seq_len: int, max_items=None, start=0
+) -> CalbertDataset:
+    if cfg.training.get("pack_sequences", False):
+        return PackedCalbertDataset(
+            args.train_path,
+            tokenizer=tokenizer,
+            max_seq_len=max_seq_len,
+            max_items=max_items,
+            start=start,
+        )
+    return CalbertDataset(args.train_path, max_items=max_items, start=start)
+
+
 def dataloaders(args, cfg, tokenizer: AlbertTokenizer, max_items=None) -> DataLoaders:
-    train_ds = CalbertDataset(args.train_path, max_items=max_items,)
-    valid_ds = CalbertDataset(args.valid_path, max_items=max_items,)
+    tfms = transforms(tokenizer, cfg)
+    options = loader_options(cfg)
+    if cfg.get("data", {}).get("shuffle_blocks", False):
+        train_dl = streaming_dataloader(args, cfg, tfms)
+    else:
+        train_ds = train_dataset(
+            args, cfg, tokenizer, cfg.training.max_seq_length, max_items=max_items
+        )
+        if cfg.get("producer", {}).get("enabled", False):
+            train_dl = producer_dataloader(args, cfg, tokenizer, train_ds)
+        else:
+            train_dl = build_dataloader(
+                train_ds, tfms, batch_size=args.train_batch_size, **options
+            )
+
+    validation = cfg.get("validation", None)
+    if validation is not None and validation.mode == "external":
+        # Checkpoints are evaluated by `python -m calbert evaluate --watch` instead
+        examples = torch.empty(0, 4, cfg.training.max_seq_length, dtype=torch.int16)
+        valid_dl = eval_dataloader(examples, batch_size=args.eval_batch_size)
+    elif validation is not None and validation.mode == "cached":
+        examples = cached_eval_set(
+            args.valid_path,
+            tokenizer,
+            cache_dir=normalize_path(Path(validation.cache_dir)),
+            max_seq_len=cfg.training.max_seq_length,
+            probability=cfg.training.masked_lm_prob,
+            max_items=validation.max_items,
+            stratified=validation.stratified,
+            seed=cfg.seed,
+        )
+        valid_dl = eval_dataloader(examples, batch_size=args.eval_batch_size)
+    else:
+        valid_ds = CalbertDataset(args.valid_path, max_items=max_items,)
+        valid_dl = build_dataloader(
+            valid_ds, tfms, batch_size=args.eval_batch_size, **options
+        )
 
-    return build_dataloaders(args, cfg, tokenizer, train_ds, valid_ds)
+    return DataLoaders(train_dl, valid_dl)
+
+
+def producer_dataloader(
+    args, cfg, tokenizer: AlbertTokenizer, train_ds: CalbertDataset
+) -> SharedBatchDL:
+    "This rank's training batches, from the data producer of its host (started by local rank 0)"
+    if cfg.training.get("seq_length_schedule", None):
+        # The curriculum swaps in loaders of its own, which would bypass the producer
+        raise ValueError("The data producer can't be combined with training.seq_length_schedule")
+    world_size = max(num_distrib(), 1)
+    local_world = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    local_rank = int(os.environ.get("LOCAL_RANK", rank_distrib()))
+    name = f"calbert-{os.environ.get('MASTER_PORT', os.getpid())}"
+    directory = cfg.producer.directory
+    nonce = run_nonce()
+    if local_rank == 0:
+        start_producer(
+            train_ds,
+            tokenizer,
+            name,
+            max_seq_len=cfg.training.max_seq_length,
+            probability=cfg.training.masked_lm_prob,
+            batch_size=args.train_batch_size,
+            local_world=local_world,
+            node_rank=rank_distrib() // local_world,
+            nnodes=world_size // local_world,
+            slots=cfg.producer.slots,
+            workers=cfg.producer.workers,
+            directory=directory,
+            nonce=nonce,
+        )
+    return SharedBatchDL(
+        ring_path(name, local_rank, directory), device=default_device(), nonce=nonce
+    )
+
+
+def streaming_dataloader(args, cfg, tfms: list) -> StreamingDL:
+    "This rank's training batches, streamed in shuffled blocks of the corpus"
+    if cfg.training.get("pack_sequences", False) or cfg.get("producer", {}).get(
+        "enabled", False
+    ):
+        raise ValueError(
+            "data.shuffle_blocks can't be combined with packed sequences or the data producer"
+        )
+    if args.max_items:
+        raise ValueError("data.shuffle_blocks streams every pair, it can't take --max-items")
+    if cfg.training.get("seq_length_schedule", None):
+        # The curriculum swaps in loaders of its own, which would read the corpus instead
+        raise ValueError("data.shuffle_blocks can't be combined with training.seq_length_schedule")
+    world_size = max(num_distrib(), 1)
+    shuffler = BlockShuffler(
+        args.train_path,
+        block_size=int(cfg.data.block_size_mb * 2 ** 20),
+        buffer_size=cfg.data.shuffle_buffer,
+        seed=cfg.seed,
+        threads=cfg.data.get("decompress_threads", 2),
+    )
+    return StreamingDL(
+        shuffler,
+        tfms,
+        batch_size=args.train_batch_size,
+        rank=rank_distrib(),
+        world_size=world_size,
+        device=default_device(),
+        **loader_options(cfg),
+        cache_dir=normalize_path(Path(cfg.get("validation", {}).get("cache_dir", "cache"))),
+    )
+
+
+def phase_dataloader(
+    args,
+    cfg,
+    tokenizer: AlbertTokenizer,
+    max_seq_len: int,
+    batch_size: int,
+    start: int = 0,
+    max_items=None,
+) -> TfmdDL:
+    """A training loader of sequences of up to `max_seq_len` tokens, for a curriculum phase.
+
+    It starts at the `start`th example, where the previous phases left off.
+    """
+    train_ds = train_dataset(
+        args, cfg, tokenizer, max_seq_len, max_items=max_items, start=start
+    )
+    return build_dataloader(
+        train_ds,
+        transforms(tokenizer, cfg, max_seq_len),
+        batch_size=batch_size,
+        **loader_options(cfg),
+    )
+
+
+def optimizer(cfg):
+    "The optimizer to train with, sharding Lamb's state across ranks if configured"
+    if sharded_optimizer(cfg):
+        return partial(ShardedLamb, lr=0.1, wd=cfg.training.weight_decay)
+    return partial(Lamb, lr=0.1, wd=cfg.training.weight_decay)
+
+
+def sharded_optimizer(cfg) -> bool:
+    "Whether each rank only keeps its share of the optimizer state"
+    return cfg.training.get("shard_optimizer", False) and num_distrib() > 1
 
 
 def get_learner(
@@ -145,16 +354,60 @@ def get_learner(
         dataloaders,
         model,
         loss_func=lambda out, _: out[0],
-        opt_func=partial(Lamb, lr=0.1, wd=cfg.training.weight_decay),
-        metrics=[Perplexity()],
+        opt_func=optimizer(cfg),
+        metrics=[DevicePerplexity()],
     )
     cbs = []
+    if isinstance(dataloaders.train, StreamingDL):
+        every = cfg.data.get("checkpoint_every_n_steps", 1000)
+        cbs.append(StreamCheckpointCallback(every=every))
     if use_deepkit:
+        from calbert.reporting import DeepkitCallback
+
         cbs.extend([DeepkitCallback(args, cfg, tokenizer)])
+    if args.profile:
+        cbs.append(
+            ProfilingCallback(
+                normalize_path(args.profile_dir),
+                log_every=cfg.profiling.log_every,
+                trace_start=cfg.profiling.trace_start,
+                trace_steps=cfg.profiling.trace_steps,
+            )
+        )
+    external = cfg.get("validation", {}).get("mode", "full") == "external"
+    if external and not use_deepkit:  # which already saves them
+        cbs.append(CheckpointCallback())
+    every_n_steps = cfg.get("validation", {}).get("every_n_steps", 0)
+    if every_n_steps and not external:
+        cbs.append(PeriodicValidationCallback(dataloaders.valid, every=every_n_steps))
+    seq_schedule = cfg.training.get("seq_length_schedule", None)
+    if seq_schedule:
+        cbs.append(
+            CurriculumCallback(
+                seq_schedule,
+                partial(phase_dataloader, args, cfg, tokenizer, max_items=args.max_items),
+                max_seq_length=cfg.training.max_seq_length,
+                batch_size=args.train_batch_size,
+            )
+        )
     learner.add_cbs(cbs)
     return learner
 
 
+def export(
+    model: CalbertForMaskedLM, tokenizer: AlbertTokenizer, path: Path, dtype: str = "fp32"
+):
+    "Save `model` and `tokenizer` in HuggingFace format into `path`, the weights in `dtype`"
+    path.mkdir(parents=True, exist_ok=True)
+    model_to_save = model.module if hasattr(model, "module") else model
+    model_to_save.__class__ = AlbertForMaskedLM
+    torch.save(
+        cast_state_dict(model_to_save.state_dict(), dtype), path / "pytorch_model.bin"
+    )
+    model_to_save.config.to_json_file(path / "config.json")
+    tokenizer.save_pretrained(path)
+
+
 def set_config(experiment, key, val):
     if key not in ["_resolver_cache", "content", "flags"] and val is not None:
         if isinstance(val, int) or isinstance(val, float):
@@ -164,17 +417,21 @@ def set_config(experiment, key, val):
 
 
 def train(args, cfg) -> Learner:
+    if args.train_batch_size is None:
+        args.train_batch_size = cfg.training.get("batch_size", 128)
     if torch.cuda.is_available():
         n_gpu = torch.cuda.device_count()
         if args.gpu is None:
-            args.gpu = list(range(n_gpu))[0]
+            args.gpu = int(os.environ.get("LOCAL_RANK", 0))
         torch.cuda.set_device(args.gpu)
     else:
         n_gpu = None
-        args.gpu = -1
+        args.gpu = None  # data parallel over gloo, see `python -m calbert launch`
 
     use_deepkit = args.deepkit and rank_distrib() == 0
     if use_deepkit:
+        import deepkit
+
         experiment = deepkit.experiment()
 
         for key, val in vars(args).items():
@@ -205,13 +462,17 @@ def train(args, cfg) -> Learner:
 
     model = initialize_model(cfg, args, tokenizer=tokenizer)
 
+    if args.resume and not cfg.get("data", {}).get("shuffle_blocks", False):
+        raise ValueError("--resume needs data.shuffle_blocks=True")
+
     dls = dataloaders(args, cfg, tokenizer=tokenizer, max_items=args.max_items)
     dls.to(default_device())
 
     learn = get_learner(args, cfg, dataloaders=dls, model=model, tokenizer=tokenizer, use_deepkit=use_deepkit)
 
     if args.fp16:
-        learn = learn.to_fp16()
+        args.precision = "fp16"
+    learn = to_precision(learn, args.precision)
 
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -230,28 +491,36 @@ def train(args, cfg) -> Learner:
         else:
             log.info("Processing all sentence pairs")
         log.info(
-            "GPUs: %s, 16-bits training: %s", torch.cuda.device_count(), args.fp16,
+            "GPUs: %s, precision: %s", torch.cuda.device_count(), args.precision,
         )
 
     if num_distrib() > 1:
         DistributedTrainer.fup = True
 
-    with learn.distrib_ctx(
-        cuda_id=args.gpu
-    ):  # distributed traing requires "-m fastai2.launch"
-        log.info(f"Training in distributed data parallel context on GPU {args.gpu}")
-        learn.fit_one_cycle(args.epochs, lr_max=cfg.training.learning_rate)
+    with distrib_ctx(
+        learn, cuda_id=args.gpu, **dict(cfg.get("distributed", {}))
+    ):  # distributed training requires "-m fastai.launch" or "-m calbert launch"
+        device = f"GPU {args.gpu}" if args.gpu is not None else "CPU"
+        log.info(
+            f"Training in distributed data parallel context on {device}, "
+            f"rank {rank_distrib()} of {max(num_distrib(), 1)}, "
+            f"{torch.get_num_threads()} threads"
+        )
+        epochs = args.epochs
+        if args.resume:
+            # The one-cycle schedule is laid over the epochs left
+            epochs -= learn.stream_checkpoint.restore()
+        if epochs > 0:
+            learn.fit_one_cycle(epochs, lr_max=cfg.training.learning_rate)
+
+    if isinstance(dls.train, SharedBatchDL):
+        dls.train.close()
 
     learn.model.eval()
 
     if args.export_path:
         args.export_path = normalize_path(args.export_path)
-        args.export_path.mkdir(parents=True, exist_ok=True)
-        model_to_save = model.module if hasattr(model, "module") else model
-        model_to_save.__class__ = AlbertForMaskedLM
-        torch.save(model_to_save.state_dict(), args.export_path / "pytorch_model.bin")
-        model_to_save.config.to_json_file(args.export_path / "config.json")
-        tokenizer.save_pretrained(args.export_path)
+        export(model, tokenizer, args.export_path, dtype=args.export_dtype)
         if use_deepkit:
             for file in args.export_path.glob("*"):
                 args.experiment.add_output_file(str(file))
@@ -0,0 +1,336 @@
+"""Find the batch size and loader settings giving the best training throughput on this host.
+
+`python -m calbert tune` probes the largest batch a training step of the configured model
+fits in memory at a sequence length, then sweeps loader workers and prefetch depth over
+the real training set, and writes the winners to `config/tuned/NAME.yaml`, to train with
+`python -m calbert train ... tuned=NAME`.
+"""
+
+import argparse
+import logging
+import platform
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import torch
+from omegaconf import OmegaConf
+
+from calbert.benchmark import isolated
+from calbert.dataset import IGNORE_INDEX, dataloader as build_dataloader, transforms
+from calbert.lamb import Lamb
+from calbert.streaming import BlockShuffler, StreamingDL
+from calbert.tokenizer import load as load_tokenizer
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+TUNED_CONFIGS = Path(__file__).parent.parent / "config" / "tuned"
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Tune the batch size and loader workers for training throughput"
+    )
+    parser.add_argument(
+        "--tokenizer-path",
+        type=Path,
+        required=True,
+        help="The path to the sentencepiece *model* (ca.{uncased|cased}.VOCABSIZE.model)",
+    )
+    parser.add_argument(
+        "--train-path", required=True, type=Path, help="Where the train.txt file lives",
+    )
+    parser.add_argument(
+        "--seq-len",
+        type=int,
+        default=None,
+        help="Sequence length to tune for (defaults to training.max_seq_length)",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="Probe training steps in fp32 or under bf16 autocast",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=4096)
+    parser.add_argument(
+        "--multiple", type=int, default=8, help="Keep the batch size a multiple of this",
+    )
+    parser.add_argument(
+        "--memory-fraction",
+        type=float,
+        default=0.8,
+        help="Share of the GPU memory, or of the available RAM on CPU, a step may use",
+    )
+    parser.add_argument(
+        "--nproc-per-node",
+        type=int,
+        default=1,
+        help="Ranks that will share this host's RAM when training on CPUs",
+    )
+    parser.add_argument(
+        "--workers", type=str, default="0,1,2,4,8", help="Loader workers to try",
+    )
+    parser.add_argument(
+        "--prefetch", type=str, default="2,4", help="Batches prefetched per worker to try",
+    )
+    parser.add_argument(
+        "--batches", type=int, default=20, help="Batches timed for each loader setting",
+    )
+    parser.add_argument(
+        "--max-items",
+        type=int,
+        default=20000,
+        help="Sentence pairs of the training set to sweep the loader settings over",
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        default=None,
+        help="Name of the override file (defaults to MODEL-slSEQ_LEN)",
+    )
+    parser.add_argument("--out-dir", type=Path, default=TUNED_CONFIGS)
+    return parser
+
+
+def largest(fits: Callable[[int], bool], maximum: int, multiple: int = 8) -> int:
+    """The largest batch size up to `maximum` for which `fits` holds, or 0 if none does.
+
+    Doubles the batch size until it doesn't fit, then bisects down to a `multiple`.
+    """
+    lo, bs = 0, 1
+    while bs <= maximum and fits(bs):
+        lo, bs = bs, bs * 2
+    if lo < multiple:
+        return lo
+    # Bisect over multiples: `lo` fits, `hi` doesn't (or is over the maximum)
+    lo, hi = lo // multiple, min(-(-bs // multiple), maximum // multiple + 1)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(mid * multiple):
+            lo = mid
+        else:
+            hi = mid
+    return lo * multiple
+
+
+def synthetic_batch(batch_size: int, seq_len: int, vocab_size: int, probability: float):
+    "A full-length (so worst case) masked batch of random tokens"
+    ids = torch.randint(vocab_size, (batch_size, seq_len))
+    masked = torch.rand(batch_size, seq_len) < probability
+    labels = torch.where(masked, ids, torch.full_like(ids, IGNORE_INDEX))
+    return torch.stack([ids, labels, torch.ones_like(ids), torch.zeros_like(ids)], dim=1)
+
+
+def train_steps(model, batch: torch.Tensor, precision: str, steps: int = 2) -> float:
+    "Seconds per training step of `model` on `batch`, after a first one allocating the optimizer state"
+    optimizer = Lamb([p for p in model.parameters() if p.requires_grad])
+    elapsed = 0.0
+    for step in range(steps):
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        if precision == "bf16":
+            with torch.autocast(batch.device.type, dtype=torch.bfloat16):
+                loss = model(batch)[0]
+        else:
+            loss = model(batch)[0]
+        loss.backward()
+        optimizer.step()
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+        if step:
+            elapsed += time.perf_counter() - start
+    return elapsed / max(steps - 1, 1)
+
+
+def _available_memory() -> int:
+    "Bytes of RAM available to new allocations on this host"
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("Can't tell the available memory from /proc/meminfo")
+
+
+class Prober:
+    "Tells whether a training step at a batch size fits the memory budget, and how fast it runs"
+
+    def __init__(self, args, cfg, tokenizer):
+        self.args, self.cfg, self.tokenizer = args, cfg, tokenizer
+        self.cuda = torch.cuda.is_available()
+        if self.cuda:
+            total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            self.budget = total * args.memory_fraction
+        else:
+            self.budget = _available_memory() * args.memory_fraction / args.nproc_per_node
+        self.speeds = {}
+
+    def _step(self, batch_size: int) -> float:
+        from calbert.training import initialize_model
+
+        model = initialize_model(self.cfg, self.args, self.tokenizer).train()
+        batch = synthetic_batch(
+            batch_size,
+            self.args.seq_len,
+            len(self.tokenizer),
+            self.cfg.training.masked_lm_prob,
+        ).to(next(model.parameters()).device)
+        return train_steps(model, batch, self.args.precision)
+
+    def _run(self, batch_size: int) -> Tuple[float, int]:
+        "Seconds per step and peak memory, raising `MemoryError` if the step runs out of it"
+        if not self.cuda:
+            # On CPUs running out of memory kills the process, so probe in another one
+            return isolated(self._step, batch_size)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        try:
+            seconds = self._step(batch_size)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            raise MemoryError(str(e))
+        finally:
+            torch.cuda.empty_cache()
+        return seconds, torch.cuda.max_memory_allocated()
+
+    def __call__(self, batch_size: int) -> bool:
+        try:
+            seconds, peak = self._run(batch_size)
+        except MemoryError:
+            log.info(f"Batch size {batch_size}: out of memory")
+            return False
+        fits = peak <= self.budget
+        log.info(
+            f"Batch size {batch_size}: {peak / 2 ** 20:.0f} MiB of "
+            f"{self.budget / 2 ** 20:.0f}, {batch_size / seconds:.1f} samples/s"
+            + ("" if fits else " (over budget)")
+        )
+        if fits:
+            self.speeds[batch_size] = batch_size / seconds
+        return fits
+
+
+def sweep(make_dl: Callable, settings: List[Tuple[int, int]], batches: int):
+    """Samples/sec of the loaders `make_dl(num_workers, prefetch_factor)` of every setting.
+
+    Times `batches` batches after the first one, which only tells how long workers
+    take to start.
+    """
+    results = []
+    for workers, prefetch in settings:
+        dl = make_dl(workers, prefetch)
+        iterator = iter(dl)
+        next(iterator)
+        samples, start = 0, time.perf_counter()
+        for _, (x, _) in zip(range(batches), iterator):
+            samples += len(x)
+        speed = samples / (time.perf_counter() - start)
+        log.info(f"{workers} workers prefetching {prefetch}: {speed:.1f} samples/s")
+        results.append((workers, prefetch, speed))
+        del iterator
+    return results
+
+
+def best(results: List[Tuple[int, int, float]], tolerance: float = 0.05) -> Tuple[int, int, float]:
+    "The setting with the fewest workers, then the least prefetching, within `tolerance` of the fastest"
+    fastest = max(speed for _, _, speed in results)
+    return min(
+        (r for r in results if r[2] >= fastest * (1 - tolerance)), key=lambda r: (r[0], r[1])
+    )
+
+
+def loader_factory(args, cfg, tokenizer, batch_size: int) -> Callable:
+    "Builds the training loader `train` would use, with given workers and prefetch depth"
+    tfms = transforms(tokenizer, cfg, args.seq_len)
+    data = cfg.get("data", {})
+    if data.get("shuffle_blocks", False):
+        shuffler = BlockShuffler(
+            args.train_path,
+            block_size=int(data.block_size_mb * 2 ** 20),
+            buffer_size=data.shuffle_buffer,
+            seed=cfg.seed,
+            threads=data.get("decompress_threads", 2),
+        )
+        cache_dir = normalize_path(Path(cfg.get("validation", {}).get("cache_dir", "cache")))
+        return lambda workers, prefetch: StreamingDL(
+            shuffler,
+            tfms,
+            batch_size,
+            num_workers=workers,
+            prefetch_factor=prefetch,
+            cache_dir=cache_dir,
+        )
+
+    from calbert.training import train_dataset
+
+    ds = train_dataset(args, cfg, tokenizer, args.seq_len, max_items=args.max_items)
+    return lambda workers, prefetch: build_dataloader(
+        ds, tfms, batch_size, num_workers=workers, prefetch_factor=prefetch
+    )
+
+
+def override(batch_size: int, num_workers: int, prefetch_factor: int, comment: str) -> str:
+    "A Hydra config of the tuned settings"
+    settings = OmegaConf.create(
+        {
+            "training": {"batch_size": batch_size},
+            "data": {"num_workers": num_workers, "prefetch_factor": prefetch_factor},
+        }
+    )
+    return f"# {comment}\n{settings.pretty()}"
+
+
+def run(args, cfg) -> dict:
+    args.tokenizer_path = normalize_path(args.tokenizer_path)
+    args.train_path = normalize_path(args.train_path)
+    args.seq_len = args.seq_len or cfg.training.max_seq_length
+    tokenizer = load_tokenizer(cfg, args.tokenizer_path)
+
+    log.info(
+        f"Probing the largest batch of {args.seq_len} tokens for model {cfg.model.name}"
+    )
+    prober = Prober(args, cfg, tokenizer)
+    batch_size = largest(prober, args.max_batch_size, args.multiple)
+    if batch_size == 0:
+        raise ValueError(f"Not even a single sequence of {args.seq_len} tokens fits in memory")
+    step_speed = prober.speeds[batch_size]
+
+    settings = [
+        (int(w), int(p))
+        for w in args.workers.split(",")
+        for p in (args.prefetch.split(",") if int(w) else ["2"])
+    ]
+    workers, prefetch, loader_speed = best(
+        sweep(loader_factory(args, cfg, tokenizer, batch_size), settings, args.batches)
+    )
+    log.info(
+        f"Best: batch size {batch_size} ({step_speed:.1f} samples/s per step), "
+        f"{workers} workers prefetching {prefetch} ({loader_speed:.1f} samples/s)"
+    )
+    if loader_speed < step_speed:
+        log.warning("The loader is slower than the training step: training will be input-bound")
+
+    name = args.name or f"{cfg.model.name}-sl{args.seq_len}"
+    out = normalize_path(args.out_dir) / f"{name}.yaml"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(
+        override(
+            batch_size,
+            workers,
+            prefetch,
+            comment=(
+                f"Tuned by `python -m calbert tune` on {platform.node()} for model "
+                f"{cfg.model.name} at {args.seq_len} tokens ({args.precision})"
+            ),
+        )
+    )
+    log.info(f"Wrote {out}: train with `python -m calbert train ... tuned={name}`")
+    return dict(
+        batch_size=batch_size,
+        num_workers=workers,
+        prefetch_factor=prefetch,
+        step_samples_per_sec=step_speed,
+        loader_samples_per_sec=loader_speed,
+    )
@@ -1,8 +1,13 @@
 "Random utils used here and there"
 
-__all__ = ["normalize_path"]
+__all__ = ["normalize_path", "ordered_map", "rss"]
 
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
 from hydra.utils import to_absolute_path
 
 
@@ -12,3 +17,28 @@ def normalize_path(p: Path) -> Path:
         return Path(to_absolute_path(str(p)))
     except AttributeError:  # if we're not in Hydra
         return p.absolute()
+
+
+def rss() -> int:
+    "Current resident set size of this process in bytes"
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def ordered_map(fn: Callable, items: Iterable, threads: int) -> Iterator:
+    """`map(fn, items)` on `threads` threads, in order, with at most twice as many in flight.
+
+    Unlike `ThreadPoolExecutor.map`, it doesn't submit all of `items` upfront, so only a
+    bounded number of results wait in memory. With no threads, it's a plain `map`.
+    """
+    if threads <= 0:
+        yield from map(fn, items)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,254 @@
+"A fixed, pre-tokenized and pre-masked validation set, cached on disk, and cheap metrics over it"
+
+__all__ = [
+    "subsample",
+    "eval_set",
+    "cached_eval_set",
+    "EvalSet",
+    "eval_dataloader",
+    "DevicePerplexity",
+    "PeriodicValidationCallback",
+    "CheckpointCallback",
+]
+
+import hashlib
+import logging
+import math
+import os
+import random
+from collections import defaultdict
+from pathlib import Path
+from typing import List
+
+import torch
+from fastai.basics import Callback, Metric, default_device, to_device
+from fastai.data.core import TfmdDL
+from fastai.distributed import rank_distrib
+from torch.utils.data import Dataset
+from transformers import AlbertTokenizer
+
+from calbert.dataset import (
+    IGNORE_INDEX,
+    SentencePair,
+    Tokenize,
+    mask_tokens,
+    sentence_pairs,
+)
+
+log = logging.getLogger(__name__)
+
+
+def subsample(
+    pairs: List[SentencePair], max_items: int, stratified: bool, seed: int
+) -> List[SentencePair]:
+    """At most `max_items` of `pairs`, in their original order.
+
+    Either the first ones or, if `stratified`, a seeded sample drawing from every
+    (power of two) length bucket in proportion to its size.
+    """
+    if not max_items or len(pairs) <= max_items:
+        return pairs
+    if not stratified:
+        return pairs[:max_items]
+    buckets = defaultdict(list)
+    for i, pair in enumerate(pairs):
+        buckets[int(math.log2(len(pair.first) + len(pair.second)))].append(i)
+    rng = random.Random(seed)
+    chosen = []
+    for bucket in sorted(buckets):
+        indices = buckets[bucket]
+        chosen.extend(rng.sample(indices, round(max_items * len(indices) / len(pairs))))
+    return [pairs[i] for i in sorted(chosen)]
+
+
+def eval_set(
+    pairs: List[SentencePair],
+    tokenizer: AlbertTokenizer,
+    max_seq_len: int,
+    probability: float,
+    seed: int,
+) -> torch.Tensor:
+    "Tokenize and mask `pairs` once, with a seeded generator, into a compact (N, 4, `max_seq_len`) tensor"
+    tokenize = Tokenize(tokenizer, max_seq_len=max_seq_len)
+    generator = torch.Generator().manual_seed(seed)
+    dtype = torch.int16 if len(tokenizer) <= torch.iinfo(torch.int16).max else torch.int32
+    examples = torch.empty(len(pairs), 4, max_seq_len, dtype=dtype)
+    for i, pair in enumerate(pairs):
+        ids, attention_mask, token_type_ids = tokenize(pair)
+        masked_ids, labels = mask_tokens(
+            ids.clone(),
+            tok=tokenizer,
+            ignore_index=IGNORE_INDEX,
+            probability=probability,
+            generator=generator,
+        )
+        examples[i] = torch.stack([masked_ids, labels, attention_mask, token_type_ids])
+    return examples
+
+
+def _fingerprint(*parts) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, Path):
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        else:
+            digest.update(repr(part).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def cached_eval_set(
+    path: Path,
+    tokenizer: AlbertTokenizer,
+    cache_dir: Path,
+    max_seq_len: int,
+    probability: float,
+    max_items: int = None,
+    stratified: bool = True,
+    seed: int = 42,
+) -> torch.Tensor:
+    """The evaluation set of `path`, built once and cached in `cache_dir`.
+
+    The cache is keyed by the contents of `path`, the vocabulary and every setting,
+    so changing any of them builds a new one.
+    """
+    key = _fingerprint(
+        Path(path),
+        len(tokenizer),
+        tokenizer.mask_token_id,
+        max_seq_len,
+        probability,
+        max_items,
+        stratified,
+        seed,
+    )
+    cache = Path(cache_dir) / f"eval-{key}.pt"
+    if cache.exists():
+        log.info(f"Loading the evaluation set from {cache}")
+        return torch.load(cache)
+
+    # Only a stratified sample needs every pair to draw from
+    pairs = sentence_pairs(path, max_items=None if stratified else max_items)
+    pairs = subsample(list(pairs), max_items, stratified, seed)
+    log.info(f"Building an evaluation set of {len(pairs)} sentence pairs into {cache}")
+    examples = eval_set(pairs, tokenizer, max_seq_len, probability, seed)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    # Ranks may race to build it: each writes its own file and atomically renames it
+    tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+    torch.save(examples, tmp)
+    os.replace(tmp, cache)
+    return examples
+
+
+class EvalSet(Dataset):
+    "Serves the examples of a compact evaluation set as the training pipeline does"
+
+    def __init__(self, examples: torch.Tensor):
+        self.examples = examples
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i].long(), 0
+
+
+def eval_dataloader(examples: torch.Tensor, batch_size: int) -> TfmdDL:
+    return TfmdDL(
+        EvalSet(examples), batch_size=batch_size, device=default_device(), pin_memory=True
+    )
+
+
+def _weighted(loss: torch.Tensor, count: torch.Tensor) -> torch.Tensor:
+    "The mean `loss` of `count` tokens times `count`, without the NaN of batches with none masked"
+    return torch.where(count > 0, loss * count, torch.zeros_like(loss))
+
+
+class DevicePerplexity(Metric):
+    """Token-weighted perplexity of the masked tokens, accumulated on the device.
+
+    Nothing is copied to the host until `value` is read, once per validation.
+    """
+
+    def reset(self):
+        self.total, self.count = 0.0, 0
+
+    def accumulate(self, learn):
+        count = (learn.xb[0][:, 1] != IGNORE_INDEX).sum()
+        self.total = self.total + _weighted(learn.loss.detach(), count)
+        self.count = self.count + count
+
+    @property
+    def value(self):
+        if not torch.is_tensor(self.count) or self.count.item() == 0:
+            return None
+        return torch.exp(self.total / self.count).item()
+
+    @property
+    def name(self):
+        return "perplexity"
+
+
+class PeriodicValidationCallback(Callback):
+    """A `Callback` evaluating the model on `dl` every `every` training steps, on rank 0.
+
+    Runs its own loop over the unwrapped model so that it doesn't disturb the epoch's
+    state, and accumulates the loss on the device.
+    """
+
+    def __init__(self, dl: TfmdDL, every: int):
+        self.eval_dl = dl
+        self.every = every
+
+    def before_fit(self):
+        self.step = 0
+
+    def after_batch(self):
+        if not self.training:
+            return
+        self.step += 1
+        if self.step % self.every == 0 and rank_distrib() == 0:
+            loss, perplexity = self.evaluate()
+            log.info(
+                f"[step {self.step}] validation loss {loss:.4f}, perplexity {perplexity:.2f}"
+            )
+
+    def evaluate(self):
+        model = getattr(self.learn.model, "module", self.learn.model)
+        model.eval()
+        total, count = 0.0, 0
+        with torch.no_grad():
+            for xb, _ in self.eval_dl:
+                xb = to_device(xb, next(model.parameters()).device)
+                n = (xb[:, 1] != IGNORE_INDEX).sum()
+                total = total + _weighted(model(xb)[0], n)
+                count = count + n
+        model.train()
+        loss = (total / count).item() if torch.is_tensor(count) and count.item() else math.nan
+        return loss, math.exp(loss)
+
+
+class CheckpointCallback(Callback):
+    """A `Callback` saving the model's weights after every epoch and at the end, on rank 0.
+
+    Writes `models/model_{epoch}.pth` and `models/final.pth` under the learner's path,
+    each atomically, for `python -m calbert evaluate --watch` to pick up.
+    """
+
+    def _save(self, name: str):
+        if rank_distrib() != 0:
+            return
+        directory = self.learn.path / self.learn.model_dir
+        directory.mkdir(parents=True, exist_ok=True)
+        model = getattr(self.learn.model, "module", self.learn.model)
+        path = directory / f"{name}.pth"
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save({"model": model.state_dict()}, tmp)
+        os.replace(tmp, path)
+
+    def after_epoch(self):
+        self._save(f"model_{self.epoch}")
+
+    def after_fit(self):
+        self._save("final")
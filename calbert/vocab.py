@@ -0,0 +1,258 @@
+"""Prune the vocabulary of an exported model down to the pieces a target corpus uses.
+
+The SentencePiece model is unigram: text is split along its most likely segmentation,
+so dropping pieces that no segmentation of the corpus uses leaves the segmentation of
+that corpus unchanged. The kept rows of the word embeddings and of the (tied) MLM
+decoder are gathered into smaller ones, and a reduced SentencePiece model with the
+same pieces, in the same order, becomes the new tokenizer.
+"""
+
+import argparse
+import logging
+import statistics
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+from transformers import AlbertForMaskedLM, AlbertTokenizer
+
+from calbert.benchmark import timed
+from calbert.utils import normalize_path
+
+log = logging.getLogger(__name__)
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Keep only the vocabulary a corpus uses in an exported model"
+    )
+    parser.add_argument(
+        "--model-path",
+        required=True,
+        type=Path,
+        help="The directory of the model, as exported by `train --export-path`",
+    )
+    parser.add_argument(
+        "--corpus",
+        required=True,
+        type=Path,
+        help="Text of the target domain, one line each",
+    )
+    parser.add_argument(
+        "--out", required=True, type=Path, help="Where to export the pruned model",
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=1,
+        help="Keep the pieces appearing at least this many times in the corpus",
+    )
+    parser.add_argument(
+        "--max-lines", type=int, default=None, help="Lines of the corpus to scan",
+    )
+    parser.add_argument(
+        "--verify-lines",
+        type=int,
+        default=200,
+        help="Lines of the corpus to check the pruned model's outputs on",
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    return parser
+
+
+def _model_proto():
+    try:
+        from sentencepiece import sentencepiece_model_pb2
+    except ImportError as e:
+        raise ImportError(
+            "Pruning the vocabulary edits SentencePiece models, which needs "
+            "sentencepiece>=0.1.91 and protobuf (pip install protobuf)"
+        ) from e
+    return sentencepiece_model_pb2.ModelProto()
+
+
+def _lines(path: Path, max_lines: int = None):
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if max_lines is not None and i >= max_lines:
+                break
+            line = line.strip()
+            if line:
+                yield line
+
+
+def piece_counts(tokenizer: AlbertTokenizer, lines) -> Counter:
+    "How many times each piece id appears in the tokenization of `lines`"
+    counts = Counter()
+    for line in lines:
+        counts.update(tokenizer.encode(line, add_special_tokens=False))
+    return counts
+
+
+def kept_ids(
+    tokenizer: AlbertTokenizer, counts: Counter, min_count: int = 1
+) -> List[int]:
+    "The ids, in order, of the special pieces and those used at least `min_count` times"
+    proto = _model_proto()
+    proto.ParseFromString(tokenizer.sp_model.serialized_model_proto())
+    normal = proto.SentencePiece.NORMAL
+    return [
+        i
+        for i, piece in enumerate(proto.pieces)
+        if piece.type != normal or counts[i] >= min_count
+    ]
+
+
+def pruned_sentencepiece(tokenizer: AlbertTokenizer, ids: List[int]) -> bytes:
+    "A serialized SentencePiece model with only the pieces of `ids`, in the same order"
+    proto = _model_proto()
+    proto.ParseFromString(tokenizer.sp_model.serialized_model_proto())
+    if proto.trainer_spec.model_type != proto.trainer_spec.UNIGRAM:
+        raise ValueError(
+            "Only unigram SentencePiece models keep their segmentation when pruned"
+        )
+    pieces = [proto.pieces[i] for i in ids]
+    del proto.pieces[:]
+    proto.pieces.extend(pieces)
+    proto.trainer_spec.vocab_size = len(pieces)
+    return proto.SerializeToString()
+
+
+def prune_embeddings(model: AlbertForMaskedLM, ids: List[int]) -> AlbertForMaskedLM:
+    "Keep only the rows of `ids` of the word embeddings and the MLM decoder, in place"
+    index = torch.tensor(ids, dtype=torch.long)
+    embeddings = model.get_input_embeddings()
+    pruned = nn.Embedding(
+        len(ids), embeddings.embedding_dim, padding_idx=embeddings.padding_idx
+    )
+    pruned.weight.data = embeddings.weight.data[index].clone()
+    model.set_input_embeddings(pruned)
+
+    head = model.predictions
+    head.bias = nn.Parameter(head.bias.data[index].clone())
+    head.decoder = nn.Linear(head.decoder.in_features, len(ids))
+    head.decoder.bias = head.bias
+    model.config.vocab_size = len(ids)
+    model.tie_weights()
+    return model
+
+
+def pruned_tokenizer(
+    tokenizer: AlbertTokenizer, ids: List[int], directory: Path
+) -> AlbertTokenizer:
+    "A tokenizer like `tokenizer` with only the pieces of `ids`, its model saved in `directory`"
+    path = Path(directory) / "spiece.model"
+    path.write_bytes(pruned_sentencepiece(tokenizer, ids))
+    return AlbertTokenizer(
+        str(path),
+        do_lower_case=tokenizer.do_lower_case,
+        remove_space=tokenizer.remove_space,
+        keep_accents=tokenizer.keep_accents,
+    )
+
+
+def _encode(tokenizer: AlbertTokenizer, line: str) -> torch.Tensor:
+    return torch.tensor([tokenizer.encode(line, max_length=512)])
+
+
+def verify(
+    old_model, old_tok, new_model, new_tok, ids: List[int], lines, strict: bool = True
+) -> Tuple[float, float]:
+    """Check that the pruned model tokenizes and predicts `lines` like the original one.
+
+    Returns the share of the lines tokenized differently, and the largest difference
+    between the original scores of the kept pieces and the pruned ones on the others.
+    When `strict`, a line tokenized differently raises `ValueError` instead.
+    """
+    new_id = {old: new for new, old in enumerate(ids)}
+    index = torch.tensor(ids, dtype=torch.long)
+    worst, checked, changed = 0.0, 0, 0
+    with torch.no_grad():
+        for line in lines:
+            checked += 1
+            old, new = _encode(old_tok, line), _encode(new_tok, line)
+            if [new_id.get(i) for i in old[0].tolist()] != new[0].tolist():
+                if strict:
+                    raise ValueError(
+                        f"The pruned tokenizer splits this line differently: {line}"
+                    )
+                changed += 1
+                continue
+            expected = old_model(old)[0][..., index]
+            worst = max(worst, (new_model(new)[0] - expected).abs().max().item())
+    return changed / max(checked, 1), worst
+
+
+def _size(model: nn.Module) -> int:
+    # Tied weights (the embeddings and the MLM decoder) are counted once
+    tensors = {t.data_ptr(): t for t in model.state_dict().values()}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def _decoder_ms(model: AlbertForMaskedLM, repeat: int) -> float:
+    "Median milliseconds of the MLM head over a batch of 8 sequences of 128 tokens"
+    hidden = torch.randn(8, 128, model.config.hidden_size)
+    with torch.no_grad():
+        seconds = timed(lambda: model.predictions(hidden), repeat)
+    return statistics.median(seconds) * 1000
+
+
+def run(args, cfg) -> dict:
+    from calbert.training import export
+
+    model_path = normalize_path(args.model_path)
+    tokenizer = AlbertTokenizer.from_pretrained(str(model_path))
+    model = AlbertForMaskedLM.from_pretrained(str(model_path)).eval()
+
+    corpus = normalize_path(args.corpus)
+    counts = piece_counts(tokenizer, _lines(corpus, args.max_lines))
+    ids = kept_ids(tokenizer, counts, args.min_count)
+    log.info(
+        f"The corpus uses {len(counts)} of {len(tokenizer)} pieces, keeping {len(ids)}"
+    )
+
+    report = dict(vocab_size=len(tokenizer), size=_size(model))
+    report["decoder_ms"] = _decoder_ms(model, args.repeat)
+    original = AlbertForMaskedLM.from_pretrained(str(model_path)).eval()
+    pruned = prune_embeddings(model, ids)
+    with tempfile.TemporaryDirectory() as tmp:
+        new_tokenizer = pruned_tokenizer(tokenizer, ids, tmp)
+        # Only lines that were scanned are guaranteed to keep their pieces, and only
+        # with --min-count 1: with a higher one, report how many lines changed
+        verify_lines = args.verify_lines
+        if args.max_lines is not None:
+            verify_lines = min(verify_lines, args.max_lines)
+        changed, difference = verify(
+            original,
+            tokenizer,
+            pruned,
+            new_tokenizer,
+            ids,
+            _lines(corpus, verify_lines),
+            strict=args.min_count <= 1,
+        )
+        export(pruned, new_tokenizer, normalize_path(args.out))
+
+    report.update(
+        pruned_vocab_size=len(ids),
+        pruned_size=_size(pruned),
+        pruned_decoder_ms=_decoder_ms(pruned, args.repeat),
+        max_difference=difference,
+        changed_lines=changed,
+    )
+    log.info(
+        f"Vocabulary {report['vocab_size']} -> {report['pruned_vocab_size']} pieces, "
+        f"model {report['size'] / 2 ** 20:.1f} -> "
+        f"{report['pruned_size'] / 2 ** 20:.1f} MiB, "
+        f"MLM head {report['decoder_ms']:.2f} -> {report['pruned_decoder_ms']:.2f} ms. "
+        f"In-domain outputs differ by at most {difference:.2e}"
+    )
+    if changed:
+        log.info(
+            f"With --min-count {args.min_count}, {changed:.2%} of the "
+            f"{verify_lines} lines checked are split differently"
+        )
+    return report
@@ -0,0 +1,81 @@
+import os
+import signal
+
+import pytest
+
+from calbert.benchmark import compare, isolated, synthetic_text
+
+
+def results(**values):
+    return {
+        "results": {
+            name: {"value": value, "unit": unit, "higher_is_better": hib}
+            for name, (value, unit, hib) in values.items()
+        }
+    }
+
+
+@pytest.mark.describe("benchmark.synthetic_text")
+class TestSyntheticText:
+    @pytest.mark.it("Generates the same corpus for the same seed")
+    def test_deterministic(self):
+        assert synthetic_text(20, seed=1) == synthetic_text(20, seed=1)
+        assert synthetic_text(20, seed=1) != synthetic_text(20, seed=2)
+
+    @pytest.mark.it("Generates lines made of sentences")
+    def test_sentences(self):
+        for line in synthetic_text(20, seed=1):
+            assert line[-1] in ".?!"
+
+
+@pytest.mark.describe("benchmark.compare")
+class TestCompare:
+    @pytest.mark.it("Flags throughput drops beyond the threshold")
+    def test_throughput_regression(self):
+        baseline = results(tokenize=(1000.0, "examples/s", True))
+        candidate = results(tokenize=(800.0, "examples/s", True))
+        assert compare(baseline, candidate, threshold=0.1) == ["tokenize"]
+        assert compare(baseline, candidate, threshold=0.3) == []
+
+    @pytest.mark.it("Flags step time increases beyond the threshold")
+    def test_latency_regression(self):
+        baseline = results(model_step=(100.0, "ms/step", False))
+        assert compare(baseline, results(model_step=(95.0, "ms/step", False)), 0.1) == []
+        assert compare(baseline, results(model_step=(120.0, "ms/step", False)), 0.1) == [
+            "model_step"
+        ]
+
+    @pytest.mark.it("Ignores benchmarks missing from either file")
+    def test_missing(self):
+        baseline = results(tokenize=(1000.0, "examples/s", True))
+        assert compare(baseline, results(), threshold=0.1) == []
+
+    @pytest.mark.it("Compares against a zero baseline without dividing by it")
+    def test_zero_baseline(self):
+        baseline = results(recompiles=(0.0, "count", False), hits=(0.0, "hits", True))
+        assert compare(baseline, baseline, threshold=0.1) == []
+        candidate = results(recompiles=(2.0, "count", False), hits=(3.0, "hits", True))
+        assert compare(baseline, candidate, threshold=0.1) == ["recompiles"]
+
+
+def fail(error):
+    raise error
+
+
+@pytest.mark.describe("benchmark.isolated")
+class TestIsolated:
+    @pytest.mark.it("Returns the result of the function run in another process")
+    def test_result(self):
+        assert isolated(sum, [1, 2])[0] == 3
+
+    @pytest.mark.it("Raises MemoryError when the process is killed or runs out of memory")
+    def test_out_of_memory(self):
+        with pytest.raises(MemoryError):
+            isolated(lambda: os.kill(os.getpid(), signal.SIGKILL))
+        with pytest.raises(MemoryError):
+            isolated(fail, MemoryError())
+
+    @pytest.mark.it("Raises RuntimeError for any other failure")
+    def test_error(self):
+        with pytest.raises(RuntimeError):
+            isolated(fail, ValueError("wrong shape"))
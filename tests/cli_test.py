@@ -0,0 +1,51 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+# Modules that take seconds to import and that utility commands must not pay for
+HEAVY_MODULES = ["torch", "transformers", "fastai", "deepkit", "tensorboardX"]
+
+
+def imported_modules(*argv):
+    "Top-level modules imported by `python -m calbert *argv`"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "calbert", *argv],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0, result.stderr
+    modules = {
+        line.split("|")[-1].strip().split(".")[0]
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return modules
+
+
+@pytest.mark.describe("python -m calbert")
+class TestStartup:
+    @pytest.mark.it("Lists the commands without importing any of them")
+    def test_help(self):
+        modules = imported_modules("--help")
+        assert not modules & set(HEAVY_MODULES)
+
+    @pytest.mark.it("Parses download_data arguments without heavy imports")
+    def test_download_data_help(self):
+        modules = imported_modules("download_data", "--help")
+        assert not modules & set(HEAVY_MODULES)
+
+    @pytest.mark.it("Parses tokenizer arguments without heavy imports")
+    def test_tokenizer_help(self):
+        modules = imported_modules("tokenizer", "--help")
+        assert not modules & set(HEAVY_MODULES)
+
+    @pytest.mark.it("Parses launch arguments without heavy imports")
+    def test_launch_help(self):
+        modules = imported_modules("launch", "--help")
+        assert not modules & set(HEAVY_MODULES)
@@ -0,0 +1,84 @@
+import pytest
+from fastai.basics import Callback, TfmdDL
+
+from calbert.curriculum import CurriculumCallback, Phase, examples_before, phases
+
+from .model_test import masked_batch
+from .profiling_test import tiny_learner
+
+SCHEDULE = [
+    {"fraction": 0.9, "max_seq_length": 128},
+    {"fraction": 0.1, "max_seq_length": 512},
+]
+
+
+@pytest.mark.describe("curriculum.phases")
+class TestPhases:
+    @pytest.mark.it("Splits the steps by fraction, the last phase running to the end")
+    def test_steps(self):
+        result = phases(SCHEDULE, total_steps=1001, max_seq_length=512, batch_size=8)
+        assert [(p.start, p.end) for p in result] == [(0, 901), (901, 1001)]
+
+    @pytest.mark.it("Keeps the token positions per step constant")
+    def test_batch_size(self):
+        result = phases(SCHEDULE, total_steps=100, max_seq_length=512, batch_size=8)
+        assert result == [Phase(0, 90, 128, 32), Phase(90, 100, 512, 8)]
+
+    @pytest.mark.it("Normalizes the fractions")
+    def test_normalize(self):
+        schedule = [{**p, "fraction": p["fraction"] * 10} for p in SCHEDULE]
+        assert phases(schedule, 100, 512, 8) == phases(SCHEDULE, 100, 512, 8)
+
+    @pytest.mark.it("Skips phases too short to get any step")
+    def test_empty(self):
+        schedule = [{"fraction": 0.001, "max_seq_length": 64}] + SCHEDULE
+        assert [p.max_seq_length for p in phases(schedule, 10, 512, 8)] == [128, 512]
+
+    @pytest.mark.it("Rejects phases longer than max_seq_length")
+    def test_too_long(self):
+        with pytest.raises(ValueError):
+            phases([{"fraction": 1, "max_seq_length": 1024}], 10, 512, 8)
+
+
+@pytest.mark.describe("curriculum.examples_before")
+class TestExamplesBefore:
+    @pytest.mark.it("Counts the examples of every rank in the steps before")
+    def test_count(self):
+        result = phases(SCHEDULE, total_steps=100, max_seq_length=512, batch_size=8)
+        assert examples_before(result, 0) == 0
+        assert examples_before(result, 90) == 90 * 32
+        assert examples_before(result, 95, world_size=2) == 2 * (90 * 32 + 5 * 8)
+
+
+class Shapes(Callback):
+    def before_fit(self):
+        self.shapes = []
+
+    def after_batch(self):
+        if self.training:
+            self.shapes.append(tuple(self.xb[0].shape))
+
+
+@pytest.mark.describe("curriculum.CurriculumCallback")
+class TestCurriculumCallback:
+    @pytest.mark.it("Trains each phase on its lengths, continuing through the data")
+    def test_learner(self):
+        starts = []
+
+        def make_dl(max_seq_len, batch_size, start):
+            starts.append(start)
+            items = [(x, 0) for x in masked_batch(bs=32, seq_len=max_seq_len)]
+            return TfmdDL(items, bs=batch_size)
+
+        schedule = [
+            {"fraction": 0.5, "max_seq_length": 4},
+            {"fraction": 0.5, "max_seq_length": 8},
+        ]
+        curriculum = CurriculumCallback(
+            schedule, make_dl, max_seq_length=8, batch_size=2
+        )
+        learn = tiny_learner(n=8, bs=2, cbs=[curriculum, Shapes()])
+        learn.fit(2, lr=1e-3)
+        # 4 steps per epoch: 4 at 4 tokens in batches of 4, then 4 at 8 tokens in 2
+        assert learn.shapes.shapes == [(4, 4, 4)] * 4 + [(2, 4, 8)] * 4
+        assert starts == [0, 16]
@@ -2,10 +2,17 @@ import pytest
 
 import random
 
-from calbert.dataset import CalbertDataset, Tokenize, Mask, Ignore, SentencePair
-from fastai2.data.all import DataLoader, TfmdDL, Datasets, Transform, stop
-from fastai2.text.data import TensorText
-from fastai2.basics import L
+from calbert.dataset import (
+    CalbertDataset,
+    PackedCalbertDataset,
+    Tokenize,
+    Mask,
+    Ignore,
+    SentencePair,
+)
+from fastai.data.all import DataLoader, TfmdDL, Datasets, Transform, stop
+from fastai.text.data import TensorText
+from fastai.basics import L
 
 from .conftest import InputData, folder
 from .tokenizer_test import train_tokenizer
@@ -51,6 +58,14 @@ class TestCalbertDataset:
         except StopIteration:
             assert True
 
+    @pytest.mark.it("Starts at a given pair, going round to the ones before it")
+    def test_start(self, dataset):
+        pairs = list(CalbertDataset(dataset))
+        assert list(CalbertDataset(dataset, start=1)) == pairs[1:] + pairs[:1]
+        assert list(CalbertDataset(dataset, start=len(pairs) + 1)) == list(
+            CalbertDataset(dataset, start=1)
+        )
+
 
 @pytest.mark.describe("dataset.Tokenization")
 class TestTokenization:
@@ -76,3 +91,40 @@ class TestMask:
 
         assert inputs[0].size(0) == 12
         assert tokenizer.mask_token_id in inputs[0]
+
+
+@pytest.mark.describe("dataset.PackedCalbertDataset")
+class TestPacking:
+    @pytest.mark.it("Packs consecutive pairs up to the maximum length")
+    def test_packs(self, dataset, tokenizer):
+        pairs = list(CalbertDataset(dataset))
+        packed = list(PackedCalbertDataset(dataset, tokenizer, max_seq_len=256))
+
+        assert len(packed) < len(pairs)
+        for example in packed:
+            assert len(example.input_ids) <= 256
+            assert len(example.input_ids) == len(example.token_type_ids)
+            assert example.input_ids[0] == tokenizer.cls_token_id
+            assert example.input_ids[-1] == tokenizer.sep_token_id
+
+        n_cls = sum(e.input_ids.count(tokenizer.cls_token_id) for e in packed)
+        assert n_cls == len(pairs)
+
+    @pytest.mark.it("Keeps the token types of every packed pair")
+    def test_token_types(self, dataset, tokenizer):
+        example = next(iter(PackedCalbertDataset(dataset, tokenizer, max_seq_len=256)))
+        for i, token in enumerate(example.input_ids):
+            if token == tokenizer.cls_token_id:
+                assert example.token_type_ids[i] == 0
+        assert set(example.token_type_ids) == {0, 1}
+
+    @pytest.mark.it("Pads packed sequences only at the tail")
+    def test_tokenize_packed(self, dataset, tokenizer):
+        tfms = [Tokenize(tokenizer, max_seq_len=256)]
+        ds = Datasets(PackedCalbertDataset(dataset, tokenizer, max_seq_len=256), tfms=tfms)
+        ids, attention_mask, token_type_ids = ds[0][0]
+        n = attention_mask.sum().item()
+
+        assert ids.size(0) == 256
+        assert attention_mask[:n].all() and not attention_mask[n:].any()
+        assert (ids[n:] == tokenizer.pad_token_id).all()
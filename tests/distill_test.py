@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import pytest
+import torch
+
+from calbert.dataset import IGNORE_INDEX
+from calbert.distill import (
+    DistillSet,
+    cached_teacher_targets,
+    distillation_loss,
+    load_teacher,
+    masked_offsets,
+)
+from calbert.model import CalbertForMaskedLM
+
+from .conftest import folder
+from .model_test import masked_batch, tiny_config
+
+
+@pytest.fixture(scope="module")
+def teacher_path():
+    with folder() as d:
+        torch.manual_seed(0)
+        CalbertForMaskedLM(tiny_config()).save_pretrained(d)
+        yield Path(d)
+
+
+def examples():
+    batch = masked_batch(bs=6)
+    batch[3, 1, 2:4] = batch[3, 0, 2:4]  # a few more masked tokens
+    return batch.to(torch.int16)
+
+
+@pytest.mark.describe("distill.distillation_loss")
+class TestDistillationLoss:
+    @pytest.mark.it("Is zero when the student agrees with the teacher on its top tokens")
+    def test_agree(self):
+        scores = torch.randn(5, 50)
+        top = scores.topk(8, dim=-1)
+        loss = distillation_loss(scores, top.values, top.indices, temperature=2.0)
+        assert loss.item() == pytest.approx(0.0, abs=1e-6)
+
+    @pytest.mark.it("Grows as the student disagrees")
+    def test_disagree(self):
+        teacher = torch.randn(5, 50)
+        top = teacher.topk(8, dim=-1)
+        nearby = teacher + 0.1 * torch.randn(5, 50)
+        close = distillation_loss(nearby, top.values, top.indices, 2.0)
+        far = distillation_loss(torch.randn(5, 50), top.values, top.indices, 2.0)
+        assert 0 < close.item() < far.item()
+
+
+@pytest.mark.describe("distill.cached_teacher_targets")
+class TestTeacherTargets:
+    @pytest.mark.it("Caches the teacher's top logits of every masked token, once")
+    def test_cache(self, teacher_path):
+        teacher = load_teacher(teacher_path)
+        x = examples()
+        offsets = masked_offsets(x)
+        assert list(offsets[1:] - offsets[:-1]) == [1, 1, 1, 3, 1, 1]
+        with folder() as cache_dir:
+            targets = cached_teacher_targets(
+                teacher, teacher_path, x, cache_dir, top_k=4, batch_size=4
+            )
+            cached = cached_teacher_targets(teacher, teacher_path, x, cache_dir, top_k=4)
+            assert len(list(Path(cache_dir).glob("teacher-*"))) == 1
+
+            values, indices, hidden = targets.batch([3, 0], "cpu")
+            assert values.shape == indices.shape == (4, 4)
+            assert hidden is None
+            with torch.no_grad():
+                scores = teacher(x[[3, 0]].long())[1]
+            expected = scores[x[[3, 0], 1] != IGNORE_INDEX].topk(4, dim=-1)
+            assert torch.equal(indices, expected.indices)
+            assert torch.allclose(values.float(), expected.values, atol=1e-2)
+            assert torch.equal(cached.batch([3, 0], "cpu")[1], indices)
+
+    @pytest.mark.it("Also caches the teacher's last hidden states if asked to")
+    def test_hidden(self, teacher_path):
+        teacher = load_teacher(teacher_path, output_hidden_states=True)
+        with folder() as cache_dir:
+            targets = cached_teacher_targets(
+                teacher, teacher_path, examples(), cache_dir, top_k=4, hidden=True
+            )
+            _, _, hidden = targets.batch([1, 3], "cpu")
+            assert hidden.shape == (4, 32)
+
+
+@pytest.mark.describe("distill.DistillSet")
+class TestDistillSet:
+    @pytest.mark.it("Serves examples with their index as target")
+    def test_items(self):
+        x, i = DistillSet(examples())[4]
+        assert x.dtype == torch.long and x.shape == (4, 8)
+        assert i == 4
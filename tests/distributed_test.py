@@ -0,0 +1,109 @@
+import pytest
+import torch
+
+from .launch_test import launch
+
+TRAINING = """
+import os
+import sys
+import torch
+from fastai.basics import Callback, DataLoaders, Learner, MSELossFlat, TfmdDL
+from calbert.distributed import DDPTrainer, distrib_ctx
+
+
+class RecordBytes(Callback):
+    order = DDPTrainer.order + 1
+
+    def before_fit(self):
+        self.sent = []
+
+    def after_batch(self):
+        if not self.training:
+            return
+        trainer = next(cb for cb in self.learn.cbs if isinstance(cb, DDPTrainer))
+        self.sent.append(trainer.stats.bytes)
+
+
+torch.manual_seed(0)
+x = torch.randn(64, 32)
+items = list(zip(x, x.sum(1, keepdim=True)))
+dls = DataLoaders(TfmdDL(items, bs=8, shuffle=True), TfmdDL(items, bs=8), device="cpu")
+model = torch.nn.Sequential(torch.nn.Linear(32, 32), torch.nn.Linear(32, 1))
+learn = Learner(dls, model, loss_func=MSELossFlat(), cbs=RecordBytes())
+with distrib_ctx(learn, cuda_id=None, comm_hook=sys.argv[2], powersgd_start_iter=2):
+    learn.fit(1, lr=0.01)
+torch.save(
+    {"state": learn.model.state_dict(), "sent": learn.record_bytes.sent},
+    os.path.join(sys.argv[1], os.environ["RANK"] + ".pt"),
+)
+"""
+
+CHECKPOINTED = """
+import os
+import sys
+import torch
+from fastai.basics import DataLoaders, Learner, TfmdDL
+from fastai.distributed import DistributedTrainer
+from transformers import AlbertConfig
+from calbert.distributed import distrib_ctx
+from calbert.model import CalbertForMaskedLM
+
+torch.manual_seed(0)
+config = AlbertConfig(
+    vocab_size=50,
+    embedding_size=16,
+    hidden_size=32,
+    intermediate_size=64,
+    num_attention_heads=4,
+    num_hidden_layers=3,
+    max_position_embeddings=16,
+)
+ids = torch.randint(5, 50, (32, 8))
+batches = torch.stack([ids, ids, torch.ones_like(ids), torch.zeros_like(ids)], dim=1)
+items = [(b, torch.zeros(1)) for b in batches]
+dls = DataLoaders(TfmdDL(items, bs=4, shuffle=True), TfmdDL(items, bs=4), device="cpu")
+model = CalbertForMaskedLM(config).checkpoint_activations()
+learn = Learner(dls, model, loss_func=lambda out, _: out[0])
+DistributedTrainer.fup = True  # as training does on more than one process
+with distrib_ctx(learn, cuda_id=None):
+    learn.fit(1, lr=0.01)
+torch.save(
+    learn.model.state_dict(), os.path.join(sys.argv[1], os.environ["RANK"] + ".pt")
+)
+"""
+
+HOOKS = ["none", "fp16", "powersgd"]
+
+def train(tmp_path, hook):
+    out = tmp_path / hook
+    out.mkdir()
+    assert launch(TRAINING, str(out), hook) == 0
+    return [torch.load(out / f"{rank}.pt") for rank in range(2)]
+
+
+@pytest.mark.describe("distributed.DDPTrainer")
+class TestCommHooks:
+    @pytest.mark.it("Keeps ranks in sync with every communication hook")
+    @pytest.mark.parametrize("hook", HOOKS)
+    def test_in_sync(self, tmp_path, hook):
+        first, second = train(tmp_path, hook)
+        for key in first["state"]:
+            assert torch.equal(first["state"][key], second["state"][key])
+
+    @pytest.mark.it("Counts fewer bytes sent when compressing gradients")
+    def test_bytes(self, tmp_path):
+        sent = {hook: train(tmp_path, hook)[0]["sent"] for hook in HOOKS}
+        assert all(b > 0 for b in sent["none"])
+        assert sum(sent["fp16"]) * 2 == sum(sent["none"])
+        assert sent["powersgd"][-1] < sent["none"][-1]
+
+
+
+@pytest.mark.describe("distributed.DDPTrainer")
+class TestCheckpointing:
+    @pytest.mark.it("Trains a checkpointed model with unused parameters in sync")
+    def test_in_sync(self, tmp_path):
+        assert launch(CHECKPOINTED, str(tmp_path)) == 0
+        first, second = [torch.load(tmp_path / f"{rank}.pt") for rank in range(2)]
+        for key in first:
+            assert torch.equal(first[key], second[key])
@@ -0,0 +1,97 @@
+import json
+import math
+from pathlib import Path
+
+import pytest
+import torch
+
+from calbert.evaluation import checkpoints, evaluate, load_checkpoint, watch
+from calbert.model import CalbertForMaskedLM
+
+from .conftest import folder
+from .model_test import masked_batch, tiny_config
+
+
+def touch(directory, *names):
+    for name in names:
+        (Path(directory) / name).write_bytes(b"")
+
+
+@pytest.mark.describe("evaluation.checkpoints")
+class TestCheckpoints:
+    @pytest.mark.it("Lists checkpoints by epoch, and the final one last")
+    def test_order(self):
+        with folder() as d:
+            touch(d, "final.pth", "model_10.pth", "model_2.pth", "model_x.pth", "other.pth")
+            assert [p.name for p in checkpoints(d)] == [
+                "model_2.pth",
+                "model_10.pth",
+                "final.pth",
+            ]
+
+
+@pytest.mark.describe("evaluation.watch")
+class TestWatch:
+    @pytest.mark.it("Evaluates each checkpoint once, across restarts")
+    def test_once(self):
+        evaluated = []
+
+        def evaluate_checkpoint(path):
+            evaluated.append(path.name)
+            return {"loss": 1.0}
+
+        with folder() as d:
+            metrics_file = Path(d) / "metrics.jsonl"
+            touch(d, "model_0.pth", "model_1.pth")
+            watch(d, evaluate_checkpoint, metrics_file, once=True)
+            touch(d, "final.pth")
+            records = watch(d, evaluate_checkpoint, metrics_file, once=True)
+            assert [r["checkpoint"] for r in records] == ["final.pth"]
+            lines = [json.loads(l) for l in metrics_file.read_text().splitlines()]
+        assert evaluated == ["model_0.pth", "model_1.pth", "final.pth"]
+        assert [(r["epoch"], r["loss"]) for r in lines] == [(0, 1.0), (1, 1.0), (None, 1.0)]
+
+    @pytest.mark.it("Waits for checkpoints to settle, until the final one")
+    def test_watch(self):
+        with folder() as d:
+            touch(d, "model_0.pth", "final.pth")
+            records = watch(
+                d, lambda path: {"loss": 1.0}, Path(d) / "m.jsonl", interval=0.01
+            )
+        assert [r["checkpoint"] for r in records] == ["model_0.pth", "final.pth"]
+
+    @pytest.mark.it("Retries checkpoints it can't load yet")
+    def test_retry(self):
+        attempts = []
+
+        def evaluate_checkpoint(path):
+            attempts.append(path.name)
+            if len(attempts) == 1:
+                raise EOFError("truncated")
+            return {"loss": 1.0}
+
+        with folder() as d:
+            touch(d, "final.pth")
+            records = watch(d, evaluate_checkpoint, Path(d) / "m.jsonl", interval=0.01)
+        assert attempts == ["final.pth", "final.pth"] and len(records) == 1
+
+
+@pytest.mark.describe("evaluation.evaluate")
+class TestEvaluate:
+    @pytest.mark.it("Reports the loss of the model saved in a checkpoint")
+    def test_evaluate(self):
+        torch.manual_seed(0)
+        model = CalbertForMaskedLM(tiny_config())
+        batch = masked_batch(bs=4)
+        with folder() as d:
+            path = Path(d) / "model_0.pth"
+            torch.save({"model": model.state_dict()}, path)
+            torch.manual_seed(1)
+            metrics = evaluate(
+                load_checkpoint(CalbertForMaskedLM(tiny_config()), path), batch, 2
+            )
+        with torch.no_grad():
+            expected = model.eval()(batch)[0].item()
+        assert metrics["loss"] == pytest.approx(expected, rel=1e-5)
+        assert metrics["perplexity"] == pytest.approx(math.exp(expected), rel=1e-5)
+        assert 0 <= metrics["accuracy"] <= 1 and metrics["tokens"] == 4
@@ -0,0 +1,148 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from calbert import index as index_command
+from calbert.index import IVFPQIndex, brute_force, kmeans, recall_at_k
+from calbert.model import CalbertForMaskedLM
+from calbert.training import export
+
+from .conftest import InputData, folder
+from .model_test import tiny_config
+from .tokenizer_test import train_tokenizer
+
+
+def blobs(n, dim=8, centers=8, seed=0):
+    rng = np.random.RandomState(seed)
+    means = rng.randn(centers, dim) * 5
+    return (means[rng.randint(centers, size=n)] + rng.randn(n, dim)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return blobs(2000)
+
+
+@pytest.fixture(scope="module")
+def index(vectors):
+    index = IVFPQIndex.train(vectors, nlist=8, m=4)
+    index.add(vectors)
+    return index
+
+
+@pytest.mark.describe("index.kmeans")
+class TestKMeans:
+    @pytest.mark.it("Finds well separated clusters")
+    def test_clusters(self):
+        rng = np.random.RandomState(0)
+        means = np.array([[0.0, 0.0], [100.0, 0.0], [0.0, 100.0]])
+        x = np.concatenate([m + rng.randn(50, 2) for m in means])
+        centroids = kmeans(x, 3)
+        distances = np.linalg.norm(centroids[:, None] - means[None], axis=-1)
+        assert (distances.min(0) < 1).all()
+
+
+@pytest.mark.describe("index.recall_at_k")
+class TestRecall:
+    @pytest.mark.it("Counts the true neighbours found")
+    def test_recall(self):
+        found = np.array([[1, 2, 3], [4, 5, 6]])
+        expected = np.array([[3, 2, 9], [7, 8, 9]])
+        assert recall_at_k(found, expected, 3) == pytest.approx(2 / 6)
+        assert recall_at_k(expected, expected, 3) == 1.0
+
+
+@pytest.mark.describe("index.IVFPQIndex")
+class TestIVFPQIndex:
+    @pytest.mark.it("Finds most true nearest neighbours, more as it probes more lists")
+    def test_recall(self, vectors, index):
+        queries = blobs(50, seed=1)
+        expected = brute_force(vectors, queries, 10)
+        one, _ = index.search(queries, k=10, nprobe=1)
+        every, distances = index.search(queries, k=10, nprobe=8)
+        assert recall_at_k(every, expected, 10) >= recall_at_k(one, expected, 10)
+        assert recall_at_k(every, expected, 10) > 0.6
+        assert (np.diff(distances, axis=1) >= 0).all()
+
+    @pytest.mark.it("Marks missing neighbours")
+    def test_missing(self):
+        index = IVFPQIndex.train(blobs(300), nlist=4, m=2)
+        index.add(blobs(3, seed=2))
+        ids, distances = index.search(blobs(2, seed=3), k=5, nprobe=4)
+        assert (ids[:, 3:] == -1).all() and np.isinf(distances[:, 3:]).all()
+        assert sorted(ids[0, :3].tolist()) == [0, 1, 2]
+
+    @pytest.mark.it("Saves, loads memory-mapped and grows incrementally")
+    def test_save(self, vectors, index):
+        queries = blobs(20, seed=1)
+        with folder() as d:
+            index.save(Path(d))
+            loaded = IVFPQIndex.load(Path(d))
+            assert isinstance(loaded.segments[0]["codes"], np.memmap)
+            expected = index.search(queries, 10, 4)
+            for a, b in zip(expected, loaded.search(queries, 10, 4)):
+                assert np.array_equal(a, b)
+
+            more = blobs(500, seed=4)
+            ids = loaded.add(more)
+            assert ids.tolist() == list(range(2000, 2500))
+            loaded.save(Path(d))
+            assert len(list(Path(d).glob("segment-*.codes.npy"))) == 2
+            reloaded = IVFPQIndex.load(Path(d))
+            assert len(reloaded) == 2500
+            found, _ = reloaded.search(more[:50], k=10, nprobe=8)
+            assert np.mean([i + 2000 in f for i, f in enumerate(found)]) > 0.9
+
+
+@pytest.fixture(scope="module")
+def model_path():
+    with InputData("train") as train_file:
+        with folder() as tokenizer_dir, folder() as d:
+            tokenizer = train_tokenizer((train_file, tokenizer_dir))[0]
+            torch.manual_seed(0)
+            # Long enough for the windows of the encoder run uses
+            config = tiny_config(vocab_size=len(tokenizer), max_position_embeddings=512)
+            model = CalbertForMaskedLM(config)
+            export(model, tokenizer, Path(d))
+            yield Path(d)
+
+
+def add(model_path, index_dir, lines):
+    added = index_dir.parent / "added.txt"
+    added.write_text("".join(f"{line}\n" for line in lines), encoding="utf-8")
+    args = index_command.arguments().parse_args(
+        [
+            "--model-path",
+            str(model_path),
+            "--index-dir",
+            str(index_dir),
+            "--add",
+            str(added),
+            "--nlist",
+            "4",
+            "--subquantizers",
+            "4",
+        ]
+    )
+    index_command.run(args, OmegaConf.create({"seed": 0}))
+
+
+@pytest.mark.describe("index.run")
+class TestRun:
+    @pytest.mark.it("Drops the texts of an add interrupted before saving the index")
+    def test_interrupted(self, model_path, tmp_path):
+        index_dir = tmp_path / "index"
+        first = [f"Aquesta és la frase número {i}." for i in range(20)]
+        second = [f"I aquesta altra, la {i}." for i in range(5)]
+        add(model_path, index_dir, first)
+        with open(index_dir / "texts.txt", "a", encoding="utf-8") as f:
+            f.write("Una frase que no arriba a l'índex.\n")
+        add(model_path, index_dir, second)
+
+        texts = (index_dir / "texts.txt").read_text(encoding="utf-8").splitlines()
+        assert texts == first + second
+        assert len(IVFPQIndex.load(index_dir)) == len(texts)
+        assert not list(index_dir.glob("*.tmp"))
@@ -0,0 +1,120 @@
+import pytest
+import torch
+
+from calbert.inference import EarlyExitAlbert, SlidingWindowEncoder, owners, spans
+from calbert.model import CalbertForMaskedLM
+
+from .conftest import InputData, folder
+from .model_test import masked_batch, tiny_config
+from .tokenizer_test import train_tokenizer
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return CalbertForMaskedLM(tiny_config()).eval()
+
+
+def run(model, batch, **kwargs):
+    ids, _, attention_mask, token_type_ids = batch.permute(1, 0, 2)
+    positions = kwargs.pop("positions", None)
+    depth = kwargs.pop("depth", None)
+    return EarlyExitAlbert(model, **kwargs)(
+        ids, attention_mask, token_type_ids, positions=positions, depth=depth
+    )
+
+
+@pytest.mark.describe("inference.EarlyExitAlbert")
+class TestEarlyExitAlbert:
+    @pytest.mark.it("Predicts like the model when running every layer")
+    def test_full_depth(self, model):
+        batch = masked_batch()
+        scores, depths = run(model, batch)
+        with torch.no_grad():
+            expected = model(batch)[1]
+        assert torch.allclose(scores, expected, atol=1e-5)
+        assert depths.tolist() == [3, 3]
+
+    @pytest.mark.it("Runs a fixed depth")
+    def test_fixed_depth(self, model):
+        batch = masked_batch()
+        scores, depths = run(model, batch, depth=1, confidence=0.0)
+        assert depths.tolist() == [1, 1]
+        assert not torch.allclose(scores, run(model, batch)[0])
+
+    @pytest.mark.it("Stops each example when it is confident enough")
+    def test_confidence(self, model):
+        batch = masked_batch()
+        assert run(model, batch, confidence=0.0)[1].tolist() == [1, 1]
+        assert run(model, batch, confidence=1.01)[1].tolist() == [3, 3]
+        # Without tokens of interest, the first example is confident right away
+        positions = torch.ones(2, 8, dtype=torch.bool)
+        positions[0] = False
+        scores, depths = run(model, batch, confidence=0.999, positions=positions)
+        assert depths.tolist() == [1, 3]
+        assert torch.allclose(scores[0], run(model, batch, depth=1)[0][0], atol=1e-5)
+        assert torch.allclose(scores[1], run(model, batch)[0][1], atol=1e-5)
+
+    @pytest.mark.it("Stops once representations stop changing, after min_layers")
+    def test_tolerance(self, model):
+        batch = masked_batch()
+        assert run(model, batch, tolerance=1e6, min_layers=2)[1].tolist() == [2, 2]
+        assert run(model, batch, tolerance=0.0)[1].tolist() == [3, 3]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+@pytest.mark.describe("inference.spans")
+class TestSpans:
+    @pytest.mark.it("Covers a document with overlapping windows")
+    def test_spans(self):
+        assert spans(30, 14, 10) == [(0, 14), (10, 24), (20, 30)]
+        assert spans(14, 14, 10) == [(0, 14)]
+        assert spans(0, 14, 10) == [(0, 0)]
+
+    @pytest.mark.it("Gives each token the window where it has the most context")
+    def test_owners(self):
+        owner = owners(30, spans(30, 14, 10))
+        assert owner.tolist() == [0] * 12 + [1] * 10 + [2] * 8
+
+
+@pytest.mark.describe("inference.SlidingWindowEncoder")
+class TestSlidingWindowEncoder:
+    def encoder(self, tokenizer, **kwargs):
+        torch.manual_seed(0)
+        model = CalbertForMaskedLM(tiny_config(vocab_size=len(tokenizer)))
+        return SlidingWindowEncoder(model, tokenizer, **kwargs)
+
+    def documents(self, tokenizer, lengths):
+        torch.manual_seed(1)
+        return [torch.randint(5, len(tokenizer), (n,)).tolist() for n in lengths]
+
+    @pytest.mark.it("Encodes a short document like the model")
+    def test_short(self, tokenizer):
+        encoder = self.encoder(tokenizer, overlap=4)
+        ids = self.documents(tokenizer, [9])[0]
+        with torch.no_grad():
+            expected = encoder.model.albert(
+                torch.tensor([[tokenizer.cls_token_id] + ids + [tokenizer.sep_token_id]])
+            )[0][0, 1:-1]
+        (output,) = encoder([ids])
+        assert torch.allclose(output, expected, atol=1e-5)
+
+    @pytest.mark.it("Encodes every token of long documents, batched or one at a time")
+    def test_long(self, tokenizer):
+        encoder = self.encoder(tokenizer, overlap=4, batch_size=3, scores=True)
+        documents = self.documents(tokenizer, [40, 5, 0, 23])
+        outputs = encoder(documents)
+        assert [o.shape for o in outputs] == [(n, len(tokenizer)) for n in [40, 5, 0, 23]]
+        for ids, output in zip(documents, outputs):
+            assert torch.allclose(encoder([ids])[0], output, atol=1e-5)
+
+    @pytest.mark.it("Refuses an overlap as long as a window")
+    def test_overlap(self, tokenizer):
+        with pytest.raises(ValueError):
+            self.encoder(tokenizer, overlap=14)
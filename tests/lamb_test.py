@@ -0,0 +1,102 @@
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from calbert.lamb import ShardedLamb, partition
+from calbert.training import optimizer
+from .launch_test import launch
+
+SHARDED = """
+import os
+import sys
+import torch
+import torch.distributed as dist
+from omegaconf import OmegaConf
+from calbert.lamb import ShardedOptimizer
+from calbert.training import optimizer
+
+dist.init_process_group("gloo", init_method="env://")
+
+
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Linear(8, 16), torch.nn.Tanh(), torch.nn.Linear(16, 16),
+        torch.nn.Tanh(), torch.nn.Linear(16, 1),
+    )
+
+
+def config(shard):
+    return OmegaConf.from_dotlist(
+        ["training.weight_decay=0.01", f"training.shard_optimizer={shard}"]
+    )
+
+
+sharded, reference = model(), model()
+sharded_opt = optimizer(config(True))(list(sharded.parameters()), lr=0.01)
+reference_opt = optimizer(config(False))(list(reference.parameters()), lr=0.01)
+assert isinstance(sharded_opt, ShardedOptimizer)
+assert not isinstance(reference_opt, ShardedOptimizer)
+for step in range(5):
+    # every rank sees the same batch, as if gradients had been averaged
+    torch.manual_seed(step + 1)
+    x = torch.randn(32, 8)
+    for m, opt in ((sharded, sharded_opt), (reference, reference_opt)):
+        opt.zero_grad()
+        m(x).pow(2).mean().backward()
+        opt.step()
+
+for a, b in zip(sharded.parameters(), reference.parameters()):
+    assert torch.allclose(a, b, atol=1e-6), (a - b).abs().max()
+
+state = sum(s["grad_avg"].numel() for s in sharded_opt.state.values() if s)
+total = sum(p.numel() for p in sharded.parameters())
+torch.save({"state": state, "total": total}, os.path.join(sys.argv[1], os.environ["RANK"] + ".pt"))
+"""
+
+
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Tanh(), torch.nn.Linear(8, 1))
+
+
+@pytest.mark.describe("lamb.partition")
+class TestPartition:
+    @pytest.mark.it("Assigns every index to exactly one bin")
+    def test_complete(self):
+        bins = partition([5, 3, 8, 1, 1, 7], 3)
+        assert sorted(i for b in bins for i in b) == list(range(6))
+
+    @pytest.mark.it("Balances the total size of the bins")
+    def test_balanced(self):
+        sizes = [5, 3, 8, 1, 1, 7]
+        totals = [sum(sizes[i] for i in b) for b in partition(sizes, 3)]
+        assert max(totals) - min(totals) <= max(sizes)
+
+
+@pytest.mark.describe("lamb.ShardedLamb")
+class TestShardedLamb:
+    @pytest.mark.it("Behaves like the optimizer training uses without a process group")
+    def test_single_process(self):
+        cfg = OmegaConf.from_dotlist(["training.weight_decay=0.01"])
+        sharded, reference = model(), model()
+        sharded_opt = ShardedLamb(list(sharded.parameters()), lr=0.01, wd=0.01)
+        reference_opt = optimizer(cfg)(list(reference.parameters()), lr=0.01)
+        x = torch.randn(16, 4)
+        for m, opt in ((sharded, sharded_opt), (reference, reference_opt)):
+            for _ in range(3):
+                opt.zero_grad()
+                m(x).pow(2).mean().backward()
+                opt.step()
+        for a, b in zip(sharded.parameters(), reference.parameters()):
+            assert torch.equal(a, b)
+
+    @pytest.mark.it(
+        "Matches the unsharded optimizer across gloo ranks while splitting its state"
+    )
+    def test_sharded(self, tmp_path):
+        assert launch(SHARDED, str(tmp_path)) == 0
+        results = [torch.load(tmp_path / f"{rank}.pt") for rank in range(2)]
+        total = results[0]["total"]
+        assert sum(r["state"] for r in results) == total
+        assert all(r["state"] < total for r in results)
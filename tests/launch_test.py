@@ -0,0 +1,81 @@
+import socket
+import sys
+import textwrap
+
+import pytest
+import torch
+
+from calbert.launch import spawn
+
+ALL_REDUCE = """
+import os
+import torch
+import torch.distributed as dist
+
+dist.init_process_group("gloo", init_method="env://")
+value = torch.ones(1) * (dist.get_rank() + 1)
+dist.all_reduce(value)
+assert value.item() == 3, value
+assert int(os.environ["LOCAL_RANK"]) == dist.get_rank()
+assert torch.get_num_threads() == 1
+"""
+
+FAILING = """
+import os
+import sys
+import time
+
+if os.environ["RANK"] == "1":
+    sys.exit(3)
+time.sleep(60)
+"""
+
+TRAINING = """
+import os
+import sys
+import torch
+from fastai.basics import DataLoaders, Learner, MSELossFlat, TfmdDL
+from calbert.distributed import distrib_ctx
+
+torch.manual_seed(0)
+x = torch.randn(64, 4)
+items = list(zip(x, x.sum(1, keepdim=True)))
+dls = DataLoaders(TfmdDL(items, bs=8, shuffle=True), TfmdDL(items, bs=8), device="cpu")
+learn = Learner(dls, torch.nn.Linear(4, 1), loss_func=MSELossFlat())
+with distrib_ctx(learn, cuda_id=None):
+    learn.fit(1, lr=0.1)
+torch.save(learn.model.state_dict(), os.path.join(sys.argv[1], os.environ["RANK"] + ".pt"))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch(script, *args, nproc=2):
+    return spawn(
+        [sys.executable, "-c", textwrap.dedent(script), *args],
+        nproc_per_node=nproc,
+        master_port=free_port(),
+        threads_per_proc=1,
+    )
+
+
+@pytest.mark.describe("launch.spawn")
+class TestSpawn:
+    @pytest.mark.it("Starts the ranks of a gloo process group, one thread each")
+    def test_all_reduce(self):
+        assert launch(ALL_REDUCE) == 0
+
+    @pytest.mark.it("Stops every rank and reports the exit code when one fails")
+    def test_failure(self):
+        assert launch(FAILING) == 3
+
+    @pytest.mark.it("Trains a model data-parallel on CPU, keeping ranks in sync")
+    def test_training(self, tmp_path):
+        assert launch(TRAINING, str(tmp_path)) == 0
+        first, second = [torch.load(tmp_path / f"{rank}.pt") for rank in range(2)]
+        for key in first:
+            assert torch.equal(first[key], second[key])
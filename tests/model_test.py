@@ -0,0 +1,103 @@
+import pytest
+
+import torch
+from transformers import AlbertConfig
+
+from calbert.model import (
+    HAS_SDPA,
+    CalbertForMaskedLM,
+    CheckpointedAlbertLayerGroup,
+    FusedAlbertAttention,
+)
+
+
+def tiny_config(**overrides):
+    config = dict(
+        vocab_size=50,
+        embedding_size=16,
+        hidden_size=32,
+        intermediate_size=64,
+        num_attention_heads=4,
+        num_hidden_layers=3,
+        max_position_embeddings=16,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+    )
+    config.update(overrides)
+    return AlbertConfig(**config)
+
+
+def masked_batch(bs=2, seq_len=8, vocab_size=50):
+    torch.manual_seed(0)
+    ids = torch.randint(5, vocab_size, (bs, seq_len))
+    labels = torch.full_like(ids, -100)
+    labels[:, 1] = ids[:, 1]
+    attention_mask = torch.ones_like(ids)
+    attention_mask[0, -2:] = 0
+    token_type_ids = torch.zeros_like(ids)
+    return torch.stack([ids, labels, attention_mask, token_type_ids], dim=1)
+
+
+def loss_and_grads(model, batch):
+    model.zero_grad()
+    loss = model(batch)[0]
+    loss.backward()
+    return loss.item(), [
+        p.grad.clone() if p.grad is not None else None for p in model.parameters()
+    ]
+
+
+@pytest.mark.describe("model.CalbertForMaskedLM")
+class TestCheckpointing:
+    @pytest.mark.it("Checkpoints the shared layer group")
+    def test_checkpoint_activations(self):
+        model = CalbertForMaskedLM(tiny_config()).checkpoint_activations()
+        for group in model.albert.encoder.albert_layer_groups:
+            assert isinstance(group, CheckpointedAlbertLayerGroup)
+
+    @pytest.mark.it("Computes the same loss and gradients when checkpointed")
+    def test_checkpointed_gradients(self):
+        torch.manual_seed(0)
+        model = CalbertForMaskedLM(tiny_config()).train()
+        batch = masked_batch()
+
+        loss, grads = loss_and_grads(model, batch)
+        model.checkpoint_activations()
+        checkpointed_loss, checkpointed_grads = loss_and_grads(model, batch)
+
+        assert checkpointed_loss == pytest.approx(loss)
+        for g, cg in zip(grads, checkpointed_grads):
+            assert (g is None) == (cg is None)
+            assert g is None or torch.allclose(g, cg, atol=1e-6)
+
+    @pytest.mark.it("Keeps the state dict keys so exports are unaffected")
+    def test_state_dict(self):
+        model = CalbertForMaskedLM(tiny_config())
+        keys = set(model.state_dict().keys())
+        assert set(model.checkpoint_activations().state_dict().keys()) == keys
+
+
+@pytest.mark.describe("model.CalbertForMaskedLM")
+class TestFusedAttention:
+    @pytest.mark.it("Routes self-attention through the fused attention")
+    def test_use_fused_attention(self):
+        model = CalbertForMaskedLM(tiny_config()).use_fused_attention()
+        for group in model.albert.encoder.albert_layer_groups:
+            for layer in group.albert_layers:
+                assert isinstance(layer.attention, FusedAlbertAttention)
+
+    @pytest.mark.skipif(not HAS_SDPA, reason="Fused attention needs torch>=2.0")
+    @pytest.mark.it("Computes the same loss and gradients with padding as eager attention")
+    def test_fused_gradients(self):
+        torch.manual_seed(0)
+        model = CalbertForMaskedLM(tiny_config()).train()
+        batch = masked_batch()
+
+        loss, grads = loss_and_grads(model, batch)
+        model.use_fused_attention()
+        fused_loss, fused_grads = loss_and_grads(model, batch)
+
+        assert fused_loss == pytest.approx(loss, abs=1e-5)
+        for g, fg in zip(grads, fused_grads):
+            assert (g is None) == (fg is None)
+            assert g is None or torch.allclose(g, fg, atol=1e-5)
@@ -0,0 +1,127 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from calbert.dataset import SentencePair
+from calbert.producer import Ring, SharedBatchDL, ring_path, start_producer
+
+from .conftest import InputData, folder
+from .tokenizer_test import train_tokenizer
+
+WORDS = "porto posat sutura metges perdius corda insegura dubte camí massa".split()
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+def pairs(n):
+    return [
+        SentencePair(f"La {WORDS[i % 10]} i la {WORDS[(i * 3) % 10]}.", "Sens dubte.")
+        for i in range(n)
+    ]
+
+
+def consume(path, epochs, results):
+    dl = SharedBatchDL(path, timeout=60)
+    seen = []
+    for _ in range(epochs):
+        seen.append([x.numpy() for x, _ in dl])
+    dl.close()
+    results.put((len(dl), seen))
+
+
+@pytest.mark.describe("producer.Ring")
+class TestRing:
+    @pytest.mark.it("Hands batches over in order, with end of epoch markers")
+    def test_round_trip(self):
+        with folder() as d:
+            ring = Ring.create(ring_path("test", 0, d), 4, 2, 8, np.int16)
+            reader = Ring.attach(ring.path)
+            batches = [np.full((2, 4, 8), i, dtype=np.int16) for i in range(3)]
+            for batch in batches:
+                ring.put(batch)
+            ring.put(None)
+            for batch in batches:
+                assert np.array_equal(reader.get(), batch)
+            assert reader.get() is None
+
+    @pytest.mark.it("Makes the producer wait when the consumer falls behind")
+    def test_backpressure(self):
+        with folder() as d:
+            ring = Ring.create(ring_path("test", 0, d), 2, 1, 4, np.int16)
+            batch = np.zeros((1, 4, 4), dtype=np.int16)
+            ring.put(batch)
+            ring.put(batch)
+            with pytest.raises(TimeoutError):
+                ring.put(batch, timeout=0.05)
+            Ring.attach(ring.path).get()
+            ring.put(batch, timeout=0.05)
+
+    @pytest.mark.it("Waits for the ring of its own run rather than a stale one")
+    def test_stale(self):
+        with folder() as d:
+            path = ring_path("test", 0, d)
+            Ring.create(path, 2, 1, 4, np.int16, nonce=1)
+            with pytest.raises(TimeoutError):
+                Ring.attach(path, timeout=0.05, nonce=2)
+            ring = Ring.create(path, 2, 1, 4, np.int16, nonce=2)
+            ring.put(np.ones((1, 4, 4), dtype=np.int16))
+            assert Ring.attach(path, timeout=1, nonce=2).get().sum() == 16
+
+    @pytest.mark.it("Stops a consumer whose producer closed the ring")
+    def test_closed(self):
+        with folder() as d:
+            ring = Ring.create(ring_path("test", 0, d), 2, 1, 4, np.int16)
+            ring.close()
+            with pytest.raises(EOFError):
+                Ring.attach(ring.path).get(timeout=1)
+
+
+@pytest.mark.describe("producer.start_producer")
+class TestProducer:
+    @pytest.mark.it("Feeds each local rank process its own equal share of batches")
+    def test_ranks(self, tokenizer):
+        with folder() as d:
+            producer = start_producer(
+                pairs(21),
+                tokenizer,
+                "test",
+                max_seq_len=16,
+                probability=0.3,
+                batch_size=2,
+                local_world=2,
+                slots=2,
+                workers=2,
+                directory=d,
+            )
+            results = multiprocessing.Queue()
+            consumers = [
+                multiprocessing.Process(
+                    target=consume, args=(ring_path("test", rank, d), 2, results)
+                )
+                for rank in range(2)
+            ]
+            for c in consumers:
+                c.start()
+            got = [results.get(timeout=60) for _ in consumers]
+            for c in consumers:
+                c.join()
+            producer.join(timeout=10)
+            assert not producer.is_alive()
+
+        for length, epochs in got:
+            assert length == 5  # 21 pairs // (2 per batch * 2 ranks)
+            assert [len(e) for e in epochs] == [5, 5]
+            for batch in epochs[0]:
+                assert batch.shape == (2, 4, 16)
+        first, second = [np.concatenate(epochs[0]) for _, epochs in got]
+        # Each rank gets its own batches
+        assert not np.array_equal(first, second)
+        # Every epoch is masked anew
+        epochs = got[0][1]
+        assert not all(np.array_equal(a, b) for a, b in zip(epochs[0], epochs[1]))
@@ -0,0 +1,48 @@
+import json
+from pathlib import Path
+
+import pytest
+import torch
+from fastai.basics import DataLoaders, Learner, TfmdDL
+
+from calbert.model import CalbertForMaskedLM
+from calbert.profiling import PHASES, ProfilingCallback
+
+from .conftest import folder
+from .model_test import masked_batch, tiny_config
+
+
+def tiny_learner(n: int = 8, bs: int = 2, cbs=None) -> Learner:
+    "A `Learner` of a tiny model over `n` masked examples, in batches of `bs`"
+    torch.manual_seed(0)
+    items = [(x, 0) for x in masked_batch(bs=n)]
+    dls = DataLoaders(TfmdDL(items, bs=bs), TfmdDL(items, bs=bs), device="cpu")
+    return Learner(
+        dls,
+        CalbertForMaskedLM(tiny_config()),
+        loss_func=lambda out, _: out[0],
+        cbs=cbs,
+    )
+
+
+@pytest.mark.describe("profiling.ProfilingCallback")
+class TestProfilingCallback:
+    @pytest.mark.it("Writes a timed record of every training step and a summary")
+    def test_records(self):
+        with folder() as d:
+            learn = tiny_learner(cbs=ProfilingCallback(Path(d), log_every=2))
+            learn.fit(1, lr=1e-3)
+            with open(Path(d) / "rank0.jsonl") as f:
+                records = [json.loads(line) for line in f]
+        steps = [r for r in records if r["type"] == "step"]
+        assert [r["iter"] for r in steps] == [0, 1, 2, 3]
+        for record in steps:
+            assert all(record[phase] >= 0 for phase in PHASES)
+            assert record["step"] >= record["forward"] + record["backward"]
+            assert record["tokens_per_sec"] > 0
+            assert record["peak_memory"] > 0
+        # Only the first example has padding, 2 of its 8 positions
+        assert [r["padding"] for r in steps] == [pytest.approx(1 / 8), 0, 0, 0]
+        summaries = [r for r in records if r["type"] == "summary"]
+        assert [r["iter"] for r in summaries] == [2, 4]
+        assert summaries[0]["bound"] in ["input", "compute"]
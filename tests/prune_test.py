@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+import torch
+
+from calbert.model import CalbertForMaskedLM
+from calbert.prune import albert_layers, importance, load, lowest, perplexity, prune
+
+from .conftest import folder
+from .model_test import masked_batch, tiny_config
+
+
+def model():
+    torch.manual_seed(0)
+    return CalbertForMaskedLM(tiny_config()).eval()
+
+
+def examples():
+    return masked_batch(bs=8)
+
+
+def scores(heads):
+    return {0: torch.tensor(heads, dtype=torch.float)}, {0: torch.arange(64.0) % 7}
+
+
+@pytest.mark.describe("prune.lowest")
+class TestLowest:
+    @pytest.mark.it("Picks the lowest scores, keeping at least one")
+    def test_lowest(self):
+        assert lowest(torch.tensor([3.0, 1.0, 4.0, 0.5]), 0.5) == [1, 3]
+        assert lowest(torch.tensor([3.0, 1.0]), 0.01) == [1]
+        assert lowest(torch.tensor([3.0, 1.0]), 1.0) == []
+
+
+@pytest.mark.describe("prune.importance")
+class TestImportance:
+    @pytest.mark.it("Scores every head and neuron of the shared layer")
+    def test_scores(self):
+        heads, neurons = importance(model(), examples(), batch_size=4)
+        assert list(heads) == list(neurons) == [0]
+        assert heads[0].shape == (4,) and neurons[0].shape == (64,)
+        assert (heads[0] >= 0).all() and (heads[0] > 0).any()
+
+
+@pytest.mark.describe("prune.prune")
+class TestPrune:
+    @pytest.mark.it("Predicts like the model with the pruned heads and neurons zeroed")
+    def test_equivalent(self):
+        heads, neurons = scores([3.0, 0.1, 2.0, 0.2])
+        masked = model()
+        layer = albert_layers(masked)[0]
+        dropped = lowest(neurons[0], 0.5)
+        with torch.no_grad():
+            for h in [1, 3]:
+                layer.attention.dense.weight[:, h * 8 : (h + 1) * 8] = 0
+            layer.ffn_output.weight[:, dropped] = 0
+            expected = masked(examples())[1]
+
+        pruned = prune(model(), heads, neurons, keep_heads=0.5, keep_ffn=0.5)
+        assert pruned.config.intermediate_size == 32
+        assert pruned.config.pruned_heads == {0: [1, 3]}
+        with torch.no_grad():
+            assert torch.allclose(pruned(examples())[1], expected, atol=1e-5)
+
+    @pytest.mark.it("Exports a smaller model that loads back the same")
+    def test_export(self):
+        pruned = prune(model(), *scores([3.0, 0.1, 2.0, 0.2]), 0.5, 0.5)
+        with torch.no_grad():
+            expected = pruned(examples())[1]
+        with folder() as d:
+            pruned.config.to_json_file(Path(d) / "config.json")
+            torch.save(pruned.state_dict(), Path(d) / "pytorch_model.bin")
+            loaded = load(Path(d)).eval()
+        assert loaded.num_parameters() == pruned.num_parameters() < model().num_parameters()
+        with torch.no_grad():
+            assert torch.allclose(loaded(examples())[1], expected, atol=1e-5)
+        assert perplexity(loaded, examples(), 4) > 1
@@ -0,0 +1,83 @@
+import json
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import AlbertForMaskedLM
+
+from calbert.serving import export, load, load_weights, save_weights
+
+from .conftest import InputData, folder
+from .model_test import tiny_config
+from .tokenizer_test import train_tokenizer
+
+X = torch.tensor([[2, 5, 7, 11, 3, 0]])
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+def model(vocab_size=50):
+    torch.manual_seed(0)
+    return AlbertForMaskedLM(tiny_config(vocab_size=vocab_size)).eval()
+
+
+@pytest.mark.describe("serving.save_weights")
+class TestSaveWeights:
+    @pytest.mark.it("Maps back every weight, exactly in fp32")
+    def test_round_trip(self):
+        original = model()
+        with folder() as d:
+            save_weights(original, d, "fp32")
+            weights = load_weights(d)
+            state = original.state_dict()
+            assert set(weights) == set(state)
+            assert all(torch.equal(weights[k], v) for k, v in state.items())
+
+    @pytest.mark.it("Writes tied weights once, in the dtype asked for")
+    def test_tied(self):
+        with folder() as d:
+            save_weights(model(), d, "bf16")
+            tensors = json.loads((Path(d) / "weights.json").read_text())["tensors"]
+            embeddings = tensors["albert.embeddings.word_embeddings.weight"]
+            assert tensors["predictions.decoder.weight"] == embeddings
+            assert embeddings["dtype"] == "bfloat16"
+            assert load_weights(d)["predictions.bias"].dtype == torch.bfloat16
+
+
+@pytest.mark.describe("serving.load")
+class TestLoad:
+    @pytest.mark.it("Predicts like the exported model")
+    def test_outputs(self, tokenizer):
+        original = model(len(tokenizer))
+        with torch.no_grad():
+            expected = original(X)[0]
+        with folder() as d:
+            export(original, tokenizer, Path(d), "fp32")
+            served, served_tokenizer = load(Path(d))
+            assert len(served_tokenizer) == len(tokenizer)
+            assert served.predictions.decoder.weight is (
+                served.albert.embeddings.word_embeddings.weight
+            )
+            with torch.no_grad():
+                assert torch.allclose(served(X)[0], expected, atol=1e-5)
+
+    @pytest.mark.it("Keeps bf16 weights in bf16, or computes in the dtype asked for")
+    def test_bf16(self, tokenizer):
+        original = model(len(tokenizer))
+        with torch.no_grad():
+            expected = original(X)[0]
+        with folder() as d:
+            export(original, tokenizer, Path(d), "bf16")
+            served = load(Path(d))[0]
+            assert next(served.parameters()).dtype == torch.bfloat16
+            upcast = load(Path(d), dtype=torch.float32)[0]
+            with torch.no_grad():
+                assert torch.allclose(upcast(X)[0], expected, atol=0.1)
+            pretrained = AlbertForMaskedLM.from_pretrained(d).eval()
+            with torch.no_grad():
+                assert torch.allclose(pretrained(X)[0], upcast(X)[0], atol=1e-5)
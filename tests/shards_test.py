@@ -0,0 +1,97 @@
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from calbert.dataset import ShardReader, is_shard, sentence_pairs
+from calbert.shards import write_shard
+from calbert.streaming import BlockShuffler, block_pair_counts, line_blocks
+
+from .conftest import folder
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    with folder() as d:
+        path = Path(d) / "train.txt"
+        path.write_text(
+            "".join(
+                f"La frase {i} és curta. I la segona {i} també. Però n'hi ha {i % 3}.\n"
+                for i in range(300)
+            ),
+            encoding="utf-8",
+        )
+        yield path
+
+
+@pytest.fixture(scope="module")
+def shard(corpus):
+    out = corpus.with_suffix(".shard")
+    write_shard(corpus, out, block_size=1000, codec_name="zlib", threads=2)
+    yield out
+
+
+@pytest.mark.describe("shards.write_shard")
+class TestWriteShard:
+    @pytest.mark.it("Compresses the lines in blocks the reader gives back in order")
+    def test_round_trip(self, corpus, shard):
+        reader = ShardReader(shard)
+        assert is_shard(shard) and not is_shard(corpus)
+        assert len(reader) > 5
+        lines = [line for block in reader.lines(threads=2) for line in block]
+        assert lines == corpus.read_text(encoding="utf-8").splitlines()
+        assert shard.stat().st_size < corpus.stat().st_size
+
+    @pytest.mark.it("Reads any block on its own")
+    def test_random_access(self, shard):
+        reader = ShardReader(shard)
+        everything = list(reader.lines(threads=0))
+        assert reader.read(3) == everything[3]
+        assert reader.read(len(reader) - 1) == everything[-1]
+
+    @pytest.mark.it("Indexes the number of sentence pairs of each block")
+    def test_pair_counts(self, corpus, shard):
+        counts = ShardReader(shard).pair_counts()
+        assert sum(counts) == sum(1 for _ in sentence_pairs(corpus))
+        assert counts == block_pair_counts(corpus, line_blocks(corpus, 1000))
+
+    @pytest.mark.it("Compresses with zstd")
+    def test_zstd(self, corpus):
+        pytest.importorskip("zstandard")
+        out = corpus.with_suffix(".zst.shard")
+        write_shard(corpus, out, block_size=1000, codec_name="zstd")
+        reader = ShardReader(out)
+        assert reader.codec == "zstd"
+        lines = [line for block in reader.lines() for line in block]
+        assert lines == corpus.read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.describe("dataset.ShardReader")
+class TestShardReader:
+    @pytest.mark.it("Gives the same sentence pairs as the text file")
+    def test_sentence_pairs(self, corpus, shard):
+        assert list(sentence_pairs(shard)) == list(sentence_pairs(corpus))
+
+    @pytest.mark.it("Refuses files that aren't shards")
+    def test_not_a_shard(self, corpus):
+        with pytest.raises(ValueError):
+            ShardReader(corpus)
+
+
+@pytest.mark.describe("streaming.BlockShuffler over a shard")
+class TestShardShuffler:
+    @pytest.mark.it("Streams the same pairs as over the text file, by the shard's blocks")
+    def test_stream(self, corpus, shard):
+        text = BlockShuffler(corpus, block_size=1000, buffer_size=20, seed=1)
+        sharded = BlockShuffler(shard, buffer_size=20, seed=1)
+        assert len(sharded.blocks) == len(ShardReader(shard))
+        assert sharded.pair_counts() == text.pair_counts()
+        first = Counter(pair.first for pair in sharded.stream(0))
+        assert first == Counter(pair.first for pair in text.stream(0))
+        assert first == Counter(pair.first for pair in sharded.stream(1))
+
+    @pytest.mark.it("Resumes an epoch part-way through")
+    def test_skip(self, shard):
+        shuffler = BlockShuffler(shard, buffer_size=20, seed=1)
+        everything = list(shuffler.stream(0))
+        assert list(shuffler.stream(0, skip=50)) == everything[50:]
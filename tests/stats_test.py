@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+from calbert.dataset import line_pairs, sentence_pairs
+from calbert.stats import HeavyHitters, Sketch, scan, sketch_pairs
+
+from .conftest import InputData, folder
+from .tokenizer_test import train_tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    with folder() as d:
+        path = Path(d) / "train.txt"
+        path.write_text(
+            "".join(
+                f"La frase {i} és curta. I la segona {'molt ' * (i % 7)}llarga. Fi {i}.\n"
+                for i in range(200)
+            ),
+            encoding="utf-8",
+        )
+        yield path
+
+
+@pytest.mark.describe("stats.HeavyHitters")
+class TestHeavyHitters:
+    @pytest.mark.it("Keeps the frequent items of streams it merges")
+    def test_merge(self):
+        stream = ["a"] * 50 + ["b"] * 30 + [str(i) for i in range(100)]
+        first, second = HeavyHitters(5), HeavyHitters(5)
+        for item in stream[::2]:
+            first.add(item)
+        for item in stream[1::2]:
+            second.add(item)
+        merged = first.merge(second)
+        assert len(merged.counts) <= 5
+        assert [item for item, _ in merged.most_common(2)] == ["a", "b"]
+
+
+@pytest.mark.describe("stats.Sketch")
+class TestSketch:
+    @pytest.mark.it("Reports quantiles, truncation, padding and coverage")
+    def test_report(self):
+        sketch = Sketch(10, max_length=20)
+        sketch.add(5, [1, 2], 0)
+        sketch.add(25, [3, 3, 0], 1)
+        other = Sketch(10, max_length=20)
+        other.add(7, [1], 0)
+        sketch.merge(other)
+        assert sketch.pairs == 3 and sketch.tokens == 6 and sketch.unknown == 1
+        assert sketch.quantile(0.5) == 7
+        assert sketch.truncated(6) == pytest.approx(2 / 3)
+        assert sketch.padding(10) == pytest.approx(1 - 22 / 30)
+        assert sketch.coverage(1) == pytest.approx(2 / 6)
+
+
+@pytest.mark.describe("stats.scan")
+class TestScan:
+    @pytest.mark.it("Counts every pair with the lengths the tokenizer gives them")
+    def test_lengths(self, corpus, tokenizer):
+        sketch = scan(corpus, tokenizer, workers=0, block_size=500)
+        pairs = list(sentence_pairs(corpus))
+        assert sketch.pairs == len(pairs)
+        lengths = sorted(len(tokenizer.encode(p.first, p.second)) for p in pairs)
+        assert sketch.quantile(1.0) == lengths[-1]
+        assert sketch.truncated(lengths[0] - 1) == 1.0
+
+    @pytest.mark.it("Gives the same sketch on a pool of processes")
+    def test_workers(self, corpus, tokenizer):
+        alone = scan(corpus, tokenizer, workers=0, block_size=500)
+        pooled = scan(corpus, tokenizer, workers=2, block_size=500)
+        assert pooled.lengths == alone.lengths
+        assert pooled.pieces == alone.pieces
+        assert pooled.unknown == alone.unknown
+
+    @pytest.mark.it("Tracks the words with unknown pieces")
+    def test_unknown(self, tokenizer):
+        line = "Hola bon dia ☃☃☃ a tothom. I ara ☃☃☃ un altre cop."
+        sketch = sketch_pairs(line_pairs(line, min_length=1), tokenizer)
+        assert sketch.unknown > 0
+        assert [word for word, _ in sketch.unknown_words.most_common()] == ["☃☃☃"]
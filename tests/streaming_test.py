@@ -0,0 +1,177 @@
+from collections import Counter
+from pathlib import Path
+
+import pytest
+import torch
+from fastai.basics import Callback, CancelFitException, DataLoaders, Learner
+
+from calbert.dataset import IGNORE_INDEX, Mask, Tokenize, sentence_pairs
+from calbert.model import CalbertForMaskedLM
+from calbert.streaming import (
+    BlockShuffler,
+    StreamCheckpointCallback,
+    StreamingDL,
+    block_pair_counts,
+    line_blocks,
+)
+
+from .conftest import InputData, folder
+from .model_test import tiny_config
+from .tokenizer_test import train_tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    with folder() as d:
+        path = Path(d) / "train.txt"
+        path.write_text(
+            "".join(f"La frase {i} és curta. I la segona {i} també.\n" for i in range(200)),
+            encoding="utf-8",
+        )
+        yield path
+
+
+def unmasked(x):
+    "The token ids before masking"
+    return torch.where(x[:, 1] != IGNORE_INDEX, x[:, 1], x[:, 0])
+
+
+def stream(shuffler, epoch, **kwargs):
+    return [pair.first for pair in shuffler.stream(epoch, **kwargs)]
+
+
+@pytest.mark.describe("streaming.line_blocks")
+class TestLineBlocks:
+    @pytest.mark.it("Covers the whole file in blocks ending at line ends")
+    def test_blocks(self, corpus):
+        blocks = line_blocks(corpus, 500)
+        data = corpus.read_bytes()
+        assert blocks[0][0] == 0 and blocks[-1][1] == len(data)
+        assert all(a[1] == b[0] for a, b in zip(blocks, blocks[1:]))
+        assert all(data[end - 1 : end] == b"\n" for _, end in blocks)
+        assert len(blocks) > 10
+
+
+@pytest.mark.describe("streaming.BlockShuffler")
+class TestBlockShuffler:
+    @pytest.mark.it("Streams every pair once per epoch, in a new order every epoch")
+    def test_epochs(self, corpus):
+        shuffler = BlockShuffler(corpus, block_size=500, buffer_size=20, seed=1)
+        everything = [pair.first for pair in sentence_pairs(corpus)]
+        first, second = stream(shuffler, 0), stream(shuffler, 1)
+        assert sorted(first) == sorted(everything) == sorted(second)
+        assert first != everything
+        assert first != second
+        assert first == stream(BlockShuffler(corpus, block_size=500, buffer_size=20, seed=1), 0)
+
+    @pytest.mark.it("Splits an epoch between shards")
+    def test_shards(self, corpus):
+        shuffler = BlockShuffler(corpus, block_size=500, buffer_size=20)
+        shards = [stream(shuffler, 0, shard=i, shards=3) for i in range(3)]
+        assert Counter(sum(shards, [])) == Counter(stream(shuffler, 0))
+
+    @pytest.mark.it("Resumes an epoch where it stopped")
+    def test_skip(self, corpus):
+        shuffler = BlockShuffler(corpus, block_size=500, buffer_size=20)
+        full = stream(shuffler, 2)
+        for skip in [0, 7, len(full) - 5, len(full)]:
+            assert stream(shuffler, 2, skip=skip) == full[skip:]
+
+
+def loader(corpus, tokenizer, **kwargs):
+    shuffler = BlockShuffler(corpus, block_size=300, buffer_size=20)
+    tfms = [Tokenize(tokenizer, max_seq_len=16), Mask(tok=tokenizer, probability=0.1)]
+    return StreamingDL(shuffler, tfms, batch_size=4, **kwargs)
+
+
+@pytest.mark.describe("streaming.StreamingDL")
+class TestStreamingDL:
+    def loader(self, corpus, tokenizer, **kwargs):
+        return loader(corpus, tokenizer, **kwargs)
+
+    @pytest.mark.it("Serves every rank the same number of batches")
+    def test_ranks(self, corpus, tokenizer):
+        with folder() as cache_dir:
+            dls = [
+                self.loader(
+                    corpus, tokenizer, rank=r, world_size=2, num_workers=2, cache_dir=cache_dir
+                )
+                for r in range(2)
+            ]
+            assert len(list(Path(cache_dir).glob("blocks-*.json"))) == 1
+        assert sum(dls[0].counts) == len(list(sentence_pairs(corpus)))
+        for dl in dls:
+            n = len(dl)
+            batches = list(dl)
+            assert len(batches) == n > 0
+            x, y = batches[0]
+            assert x.shape == (4, 4, 16) and y.shape == (4,)
+        assert len(dls[0]) == len(dls[1])
+
+    @pytest.mark.it("Resumes an epoch from its state")
+    def test_resume(self, corpus, tokenizer):
+        dl = self.loader(corpus, tokenizer, num_workers=0)
+        full = [unmasked(x) for x, _ in dl]
+        dl.load_state_dict({"epoch": 0, "batches": 3})
+        assert len(dl) == len(full) - 3
+        rest = [unmasked(x) for x, _ in dl]
+        assert all(torch.equal(a, b) for a, b in zip(rest, full[3:]))
+        assert dl.state_dict() == {"epoch": 1, "batches": 0}
+
+    @pytest.mark.it("Counts pairs per block")
+    def test_counts(self, corpus):
+        blocks = line_blocks(corpus, 300)
+        assert sum(block_pair_counts(corpus, blocks)) == 200
+
+
+class StopAfter(Callback):
+    order = StreamCheckpointCallback.order + 1
+
+    def __init__(self, n):
+        self.n = n
+
+    def after_batch(self):
+        if self.training and self.dls.train.batches == self.n:
+            raise CancelFitException()
+
+
+def streamed_learner(corpus, tokenizer, path, cbs=None) -> Learner:
+    torch.manual_seed(0)
+    dls = DataLoaders(
+        loader(corpus, tokenizer, num_workers=0), loader(corpus, tokenizer, num_workers=0)
+    )
+    return Learner(
+        dls,
+        CalbertForMaskedLM(tiny_config(vocab_size=len(tokenizer))),
+        loss_func=lambda out, _: out[0],
+        path=path,
+        cbs=[StreamCheckpointCallback(every=2)] + (cbs or []),
+    )
+
+
+@pytest.mark.describe("streaming.StreamCheckpointCallback")
+class TestStreamCheckpointCallback:
+    @pytest.mark.it("Saves the model with where the stream stopped, and restores both")
+    def test_restore(self, corpus, tokenizer):
+        with folder() as d:
+            learn = streamed_learner(corpus, tokenizer, d, cbs=[StopAfter(4)])
+            learn.fit(1, lr=1e-3)
+            saved = torch.load(Path(d) / "models" / "stream.pth")
+            assert saved["stream"] == {"epoch": 0, "batches": 4}
+            assert "opt" in saved
+
+            restarted = streamed_learner(corpus, tokenizer, d)
+            assert restarted.stream_checkpoint.restore() == 0
+            assert restarted.dls.train.state_dict() == {"epoch": 0, "batches": 4}
+            for a, b in zip(learn.model.parameters(), restarted.model.parameters()):
+                assert torch.equal(a, b)
+            restarted.fit(1, lr=1e-3)
+            saved = torch.load(Path(d) / "models" / "stream.pth")
+            assert saved["stream"] == {"epoch": 1, "batches": 0}
@@ -46,7 +46,7 @@ def training_args_cfg():
                 )
 
                 training_config = [
-                    "training.max_seq_length=4",
+                    "training.max_seq_length=16",
                     "training.masked_lm_prob=0.1",
                     "training.weight_decay=0.0",
                     "training.learning_rate=5e-05",
@@ -102,6 +102,51 @@ class TestTraining:
 
         learn.validate()
 
-        perplexity = learn.metrics[0].value.item()
+        perplexity = learn.metrics[0].value
 
         assert perplexity > 0
+
+
+class RecordingExperiment:
+    "Stands in for a Deepkit experiment, keeping what is logged to it"
+
+    def __init__(self):
+        self.metrics, self.insights = [], []
+
+    def iteration(self, *args, **kwargs):
+        pass
+
+    def batch(self, *args, **kwargs):
+        pass
+
+    def add_output_file(self, path):
+        pass
+
+    def log_metric(self, name, value):
+        self.metrics.append(name)
+
+    def log_insight(self, insight, name):
+        self.insights.append(insight)
+
+
+@pytest.mark.describe("reporting.DeepkitCallback")
+class TestDeepkitReporting:
+    @pytest.mark.it("Trains with external validation, logging no insights")
+    def test_external_validation(self, training_args_cfg, tmp_path):
+        args, cfg, tok = training_args_cfg
+        args = argparse.Namespace(**vars(args), experiment=RecordingExperiment())
+        cfg = OmegaConf.merge(
+            cfg, OmegaConf.from_dotlist(["validation.mode=external"])
+        )
+
+        model = training.initialize_model(cfg, args, tokenizer=tok)
+        dls = training.dataloaders(args, cfg, tokenizer=tok, max_items=args.max_items)
+        learn = training.get_learner(
+            args, cfg, dataloaders=dls, model=model, tokenizer=tok, use_deepkit=True
+        )
+        learn.path = tmp_path
+        learn.fit(1)
+
+        assert "train_loss" in args.experiment.metrics
+        assert args.experiment.insights == []
+        assert (tmp_path / "models" / "final.pth").exists()
@@ -0,0 +1,68 @@
+import pytest
+import torch
+import yaml
+
+from calbert.dataset import IGNORE_INDEX
+from calbert.tune import best, largest, override, sweep, synthetic_batch
+
+
+@pytest.mark.describe("tune.largest")
+class TestLargest:
+    @pytest.mark.it("Finds the largest fitting batch size, down to a multiple")
+    def test_largest(self):
+        tried = []
+
+        def fits(bs):
+            tried.append(bs)
+            return bs <= 100
+
+        assert largest(fits, maximum=4096, multiple=8) == 96
+        assert tried[:8] == [1, 2, 4, 8, 16, 32, 64, 128]
+        assert all(bs % 8 == 0 for bs in tried[8:])
+
+    @pytest.mark.it("Stops at the maximum, and finds nothing when nothing fits")
+    def test_bounds(self):
+        assert largest(lambda bs: True, maximum=200, multiple=8) == 200
+        assert largest(lambda bs: bs <= 3, maximum=200, multiple=8) == 2
+        assert largest(lambda bs: False, maximum=200) == 0
+
+
+@pytest.mark.describe("tune.synthetic_batch")
+class TestSyntheticBatch:
+    @pytest.mark.it("Makes full-length masked batches")
+    def test_batch(self):
+        batch = synthetic_batch(3, 16, 100, probability=0.5)
+        assert batch.shape == (3, 4, 16)
+        assert batch[:, 2].all()
+        masked = batch[:, 1] != IGNORE_INDEX
+        assert torch.equal(batch[:, 1][masked], batch[:, 0][masked])
+
+
+@pytest.mark.describe("tune.sweep")
+class TestSweep:
+    @pytest.mark.it("Measures every setting and picks the cheapest of the fastest")
+    def test_sweep(self):
+        def make_dl(workers, prefetch):
+            return [(torch.zeros(4, 4, 8), None)] * 10
+
+        results = sweep(make_dl, [(0, 2), (2, 2), (2, 4)], batches=5)
+        assert [(w, p) for w, p, _ in results] == [(0, 2), (2, 2), (2, 4)]
+        assert all(speed > 0 for _, _, speed in results)
+
+    @pytest.mark.it("Prefers fewer workers and less prefetching within the tolerance")
+    def test_best(self):
+        results = [(0, 2, 50.0), (2, 2, 97.0), (4, 2, 100.0), (2, 4, 99.0)]
+        assert best(results, tolerance=0.05) == (2, 2, 97.0)
+        assert best(results, tolerance=0.0) == (4, 2, 100.0)
+
+
+@pytest.mark.describe("tune.override")
+class TestOverride:
+    @pytest.mark.it("Writes a Hydra config of the tuned settings")
+    def test_override(self):
+        text = override(96, 2, 4, comment="tuned on a laptop")
+        assert text.startswith("# tuned on a laptop\n")
+        assert yaml.safe_load(text) == {
+            "training": {"batch_size": 96},
+            "data": {"num_workers": 2, "prefetch_factor": 4},
+        }
@@ -0,0 +1,107 @@
+import math
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from calbert.dataset import IGNORE_INDEX, SentencePair
+from calbert.validation import (
+    DevicePerplexity,
+    EvalSet,
+    cached_eval_set,
+    eval_set,
+    subsample,
+)
+
+from .conftest import InputData, folder
+from .tokenizer_test import train_tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+def pairs(n):
+    return [SentencePair("a" * (i % 50 + 4), "b" * (i % 7 + 4)) for i in range(n)]
+
+
+@pytest.mark.describe("validation.subsample")
+class TestSubsample:
+    @pytest.mark.it("Keeps everything under the cap")
+    def test_under_cap(self):
+        assert subsample(pairs(10), 20, stratified=True, seed=1) == pairs(10)
+
+    @pytest.mark.it("Takes the first pairs unless stratified")
+    def test_head(self):
+        assert subsample(pairs(100), 10, stratified=False, seed=1) == pairs(10)
+
+    @pytest.mark.it("Samples about max_items pairs across lengths, in order, reproducibly")
+    def test_stratified(self):
+        sample = subsample(pairs(1000), 100, stratified=True, seed=1)
+        assert abs(len(sample) - 100) <= 5
+        assert sample == subsample(pairs(1000), 100, stratified=True, seed=1)
+        assert max(len(p.first) for p in sample) > 40
+        assert min(len(p.first) for p in sample) < 10
+        # Pairs repeat, so they are told apart by identity
+        everything = pairs(1000)
+        position = {id(p): i for i, p in enumerate(everything)}
+        sample = subsample(everything, 100, stratified=True, seed=1)
+        indices = [position[id(p)] for p in sample]
+        assert indices == sorted(indices)
+
+
+@pytest.mark.describe("validation.eval_set")
+class TestEvalSet:
+    @pytest.mark.it("Masks the same way every time for a seed")
+    def test_deterministic(self, tokenizer):
+        sentences = [SentencePair("Porto posat l'esquinç.", "D'altra banda tampoc.")] * 8
+        first = eval_set(sentences, tokenizer, 32, probability=0.5, seed=3)
+        assert torch.equal(first, eval_set(sentences, tokenizer, 32, probability=0.5, seed=3))
+        assert first.shape == (8, 4, 32)
+        assert first.dtype == torch.int16
+        assert (first[:, 1] != IGNORE_INDEX).any()
+
+    @pytest.mark.it("Serves examples as the training pipeline does")
+    def test_eval_set_dataset(self, tokenizer):
+        examples = eval_set([SentencePair("Porto posat.", "Sens dubte.")], tokenizer, 16, 0.5, 3)
+        x, y = EvalSet(examples)[0]
+        assert x.dtype == torch.long and x.shape == (4, 16)
+        assert y == 0
+
+    @pytest.mark.it("Is built once and then loaded from the cache")
+    def test_cache(self, tokenizer):
+        with InputData("valid") as valid_file:
+            with folder() as cache_dir:
+                built = cached_eval_set(valid_file, tokenizer, cache_dir, 32, 0.5)
+                assert len(list(Path(cache_dir).glob("*.pt"))) == 1
+                cached = cached_eval_set(valid_file, tokenizer, cache_dir, 32, 0.5)
+                assert torch.equal(built, cached)
+                other = cached_eval_set(valid_file, tokenizer, cache_dir, 32, 0.5, seed=7)
+                assert len(list(Path(cache_dir).glob("*.pt"))) == 2
+                assert other.shape == built.shape
+
+
+@pytest.mark.describe("validation.DevicePerplexity")
+class TestDevicePerplexity:
+    @pytest.mark.it("Weights the loss of each batch by its masked tokens")
+    def test_weighted(self):
+        metric = DevicePerplexity()
+        metric.reset()
+        for loss, masked in [(1.0, 1), (2.0, 3)]:
+            labels = torch.full((1, 4, 4), IGNORE_INDEX)
+            labels[0, 1, :masked] = 1
+            metric.accumulate(SimpleNamespace(xb=(labels,), loss=torch.tensor(loss)))
+        assert metric.value == pytest.approx(math.exp((1.0 + 2.0 * 3) / 4))
+
+    @pytest.mark.it("Ignores batches without masked tokens, and has no value without any")
+    def test_empty(self):
+        metric = DevicePerplexity()
+        metric.reset()
+        assert metric.value is None
+        labels = torch.full((1, 4, 4), IGNORE_INDEX)
+        metric.accumulate(SimpleNamespace(xb=(labels,), loss=torch.tensor(float("nan"))))
+        assert metric.value is None
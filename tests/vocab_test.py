@@ -0,0 +1,100 @@
+import pytest
+import torch
+from transformers import AlbertForMaskedLM
+
+from calbert.vocab import (
+    _size,
+    kept_ids,
+    piece_counts,
+    prune_embeddings,
+    pruned_tokenizer,
+    verify,
+)
+
+from .conftest import InputData, folder
+from .model_test import tiny_config
+from .tokenizer_test import train_tokenizer
+
+LINES = ["la casa és gran", "el gos i el gat"]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    with InputData("train") as train_file:
+        with folder() as outdir:
+            yield train_tokenizer((train_file, outdir))[0]
+
+
+def model(vocab_size):
+    torch.manual_seed(0)
+    return AlbertForMaskedLM(tiny_config(vocab_size=vocab_size)).eval()
+
+
+@pytest.mark.describe("vocab.prune_embeddings")
+class TestPruneEmbeddings:
+    @pytest.mark.it("Keeps the rows of the kept pieces, with a tied decoder")
+    def test_rows(self):
+        ids = [0, 1, 2, 3, 7, 11, 42]
+        original, pruned = model(50), prune_embeddings(model(50), ids)
+        embeddings = pruned.get_input_embeddings().weight
+        assert embeddings.shape == (7, 16)
+        assert torch.equal(embeddings, original.get_input_embeddings().weight[ids])
+        assert pruned.predictions.decoder.weight is embeddings
+        assert pruned.config.vocab_size == 7
+
+        x = torch.tensor([[2, 3, 7, 42, 3]])
+        new_x = torch.tensor([[2, 3, 4, 6, 3]])
+        with torch.no_grad():
+            expected = original(x)[0][..., ids]
+            assert torch.allclose(pruned(new_x)[0], expected, atol=1e-5)
+
+
+@pytest.mark.describe("vocab.pruned_tokenizer")
+class TestPrunedTokenizer:
+    @pytest.mark.it("Splits the corpus it was pruned for like the original")
+    def test_segmentation(self, tokenizer):
+        pytest.importorskip("sentencepiece.sentencepiece_model_pb2")
+        ids = kept_ids(tokenizer, piece_counts(tokenizer, LINES))
+        assert len(ids) < len(tokenizer)
+        assert tokenizer.pad_token_id in ids and tokenizer.mask_token_id in ids
+        with folder() as d:
+            new_tokenizer = pruned_tokenizer(tokenizer, ids, d)
+            assert len(new_tokenizer) == len(ids)
+            assert new_tokenizer.mask_token_id == ids.index(tokenizer.mask_token_id)
+            original = model(len(tokenizer))
+            pruned = prune_embeddings(model(len(tokenizer)), ids)
+            changed, difference = verify(
+                original, tokenizer, pruned, new_tokenizer, ids, LINES
+            )
+        assert changed == 0
+        assert difference < 1e-4
+
+    @pytest.mark.it("Reports the share of lines split differently when not strict")
+    def test_changed(self, tokenizer):
+        pytest.importorskip("sentencepiece.sentencepiece_model_pb2")
+        # Keep the pieces of the first line only, so the second one changes
+        ids = kept_ids(tokenizer, piece_counts(tokenizer, LINES[:1]))
+        with folder() as d:
+            new_tokenizer = pruned_tokenizer(tokenizer, ids, d)
+            original = model(len(tokenizer))
+            pruned = prune_embeddings(model(len(tokenizer)), ids)
+            with pytest.raises(ValueError):
+                verify(original, tokenizer, pruned, new_tokenizer, ids, LINES)
+            changed, difference = verify(
+                original, tokenizer, pruned, new_tokenizer, ids, LINES, strict=False
+            )
+        assert changed == 0.5
+        assert difference < 1e-4
+
+
+@pytest.mark.describe("vocab._size")
+class TestSize:
+    @pytest.mark.it("Counts tied weights once")
+    def test_tied(self):
+        tiny = model(50)
+        head = tiny.predictions
+        assert head.decoder.weight is tiny.get_input_embeddings().weight
+        assert head.decoder.bias is head.bias
+        untied = sum(t.numel() * 4 for t in tiny.state_dict().values())
+        tied = head.decoder.weight.numel() + head.decoder.bias.numel()
+        assert _size(tiny) == untied - tied * 4